@@ -0,0 +1,9 @@
+"""
+Benchmarks for parselab, run them from the repository root, e.g.
+
+    python3 -m benchmarks.compression
+
+or all of them with results written into JSON file:
+
+    python3 -m benchmarks.suite --output benchmarks.json
+"""
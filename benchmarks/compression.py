@@ -0,0 +1,79 @@
+# -*- encoding: utf-8 -*-
+"""
+Bytes on disk and read throughput of FileCache with different codecs
+"""
+
+import os
+import time
+import random
+import shutil
+import tempfile
+import argparse
+
+from parselab.cache import FileCache
+
+WORDS = ['product', 'price', 'category', 'description', 'manufacturer', 'color',
+         'size', 'weight', 'availability', 'delivery', u'товар', u'цена']
+
+
+def make_page(rnd, size):
+    """
+    Returns synthetic HTML page of about size characters
+    """
+    parts = ['<html><head><title>Catalog</title></head><body><ul>']
+    length = 0
+    while length < size:
+        item = '<li class="item"><a href="/p/%d">%s</a><span class="price">%d.%02d</span></li>\n' % (
+            rnd.randint(1, 10 ** 6), ' '.join(rnd.choice(WORDS) for _ in range(6)),
+            rnd.randint(1, 10000), rnd.randint(0, 99))
+        parts.append(item)
+        length += len(item)
+    parts.append('</ul></body></html>')
+    return ''.join(parts)
+
+
+def run(pages=500, page_size=100000, codecs=(None, 'zlib', 'gzip')):
+    rnd = random.Random(0)
+    corpus = [('http://example.com/%d' % i, make_page(rnd, page_size)) for i in range(pages)]
+    raw_size = sum(len(page.encode('utf-8')) for _, page in corpus)
+    results = []
+
+    for codec in codecs:
+        path = tempfile.mkdtemp()
+        try:
+            cache = FileCache('bench', path, codec=codec)
+            started = time.time()
+            for url, page in corpus:
+                cache.write_to_cache(url, page)
+            write_time = time.time() - started
+
+            disk_size = sum(os.path.getsize(cache.get_cached_filename(url)) for url, _ in corpus)
+
+            started = time.time()
+            for url, _ in corpus:
+                cache.get_file(url)
+            read_time = time.time() - started
+        finally:
+            shutil.rmtree(path)
+
+        results.append({'codec': codec or 'none', 'bytes_on_disk': disk_size,
+                        'ratio': raw_size / float(disk_size),
+                        'write_mb_s': raw_size / write_time / 2 ** 20,
+                        'read_mb_s': raw_size / read_time / 2 ** 20})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--pages', type=int, default=500)
+    parser.add_argument('--page-size', type=int, default=100000)
+    args = parser.parse_args()
+
+    print('%-6s %14s %7s %10s %10s' % ('codec', 'bytes on disk', 'ratio', 'write MB/s', 'read MB/s'))
+    for r in run(args.pages, args.page_size):
+        print('%-6s %14d %7.2f %10.1f %10.1f' % (r['codec'], r['bytes_on_disk'], r['ratio'],
+                                                  r['write_mb_s'], r['read_mb_s']))
+
+
+if __name__ == '__main__':
+    main()
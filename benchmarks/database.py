@@ -0,0 +1,77 @@
+# -*- encoding: utf-8 -*-
+"""
+Statements, bytes sent and Python-side throughput of ParsingDatabase call
+patterns for saving products, against a recording psycopg2 stand-in
+"""
+
+import time
+import argparse
+
+from parselab.parsing import ParsingDatabase, BufferedParsingDatabase
+
+from tests.fakedb import recording_connection
+
+
+def save_products(db, products, attributes):
+    for i in range(products):
+        product_id, _ = db.get_product_id('Product %d' % i, [1, 2], 'SKU%d' % i, 'http://example.com/p/%d' % i,
+                                          db.get_manufacturer_id('Manufacturer %d' % (i % 50)), 100)
+        for j in range(attributes):
+            db.set_attribute_value(product_id, j, 'value %d' % j)
+        db.add_product_image(product_id, 'http://example.com/i/%d.jpg' % i, 0)
+
+
+def queue_products(db, products, attributes):
+    for i in range(products):
+        product_id, _ = db.get_product_id('Product %d' % i, [1, 2], 'SKU%d' % i, 'http://example.com/p/%d' % i,
+                                          db.get_manufacturer_id('Manufacturer %d' % (i % 50)), 100)
+        for j in range(attributes):
+            db.queue_attribute_value(product_id, j, 'value %d' % j)
+        db.queue_product_image(product_id, 'http://example.com/i/%d.jpg' % i, 0)
+
+
+def load_products(db, products, attributes):
+    loader = db.bulk_loader()
+    for i in range(products):
+        url = 'http://example.com/p/%d' % i
+        loader.add_product('SKU%d' % i, 'Product %d' % i, url, i % 50, 100)
+        loader.add_product_to_category(url, 1)
+        loader.add_product_to_category(url, 2)
+        for j in range(attributes):
+            loader.add_attribute_value((i, j, 'value %d' % j, 0))
+    loader.load()
+
+
+def measure(db, func, products, attributes):
+    with recording_connection() as connection:
+        db.connect('dbname=bench')
+        db.project_id = 1
+        started = time.time()
+        func(db, products, attributes)
+        db.close()
+        elapsed = time.time() - started
+    return {'products_s': products / elapsed,
+            'statements_per_product': len(connection.queries) / float(products),
+            'bytes_per_product': connection.bytes / float(products)}
+
+
+def run(products=2000, attributes=10):
+    return {'row_by_row': measure(ParsingDatabase(), save_products, products, attributes),
+            'buffered': measure(BufferedParsingDatabase(), queue_products, products, attributes),
+            'bulk_load': measure(ParsingDatabase(), load_products, products, attributes)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--products', type=int, default=2000)
+    parser.add_argument('--attributes', type=int, default=10, help='Attribute values per product')
+    args = parser.parse_args()
+
+    print('%-12s %12s %16s %14s' % ('', 'products/s', 'statements/prod', 'bytes/prod'))
+    for name, r in sorted(run(args.products, args.attributes).items()):
+        print('%-12s %12.0f %16.2f %14.0f' % (name, r['products_s'], r['statements_per_product'],
+                                               r['bytes_per_product']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+# -*- encoding: utf-8 -*-
+"""
+Warm cache hits of BasicParser.get_page() compared with the sequence
+of cache calls it made before CacheInterface.lookup() was introduced
+"""
+
+import time
+import shutil
+import logging
+import tempfile
+import argparse
+
+from parselab.cache import FileCache
+from parselab.parsing import BasicParser
+
+
+class Parser(BasicParser):
+
+    def __init__(self, cache):
+        BasicParser.__init__(self)
+        self.cache = cache
+        self.net = None
+
+
+def legacy_get_page(parser, url, binary=False):
+    cache = parser.cache
+    parser.sleep()
+    logging.info('Getting page "%s"...' % url)
+    if cache.is_in_cache(url):
+        logging.info('Page found in cache: %s' % cache.get_cached_filename(url))
+        data = cache.get_file(url, binary)
+        if data is None:
+            raise Exception('Cache error, filename: %s' % cache.get_cached_filename(url))
+        return data
+
+
+def measure(func, urls, repeat):
+    started = time.time()
+    for _ in range(repeat):
+        for url in urls:
+            func(url)
+    return len(urls) * repeat / (time.time() - started)
+
+
+def run(pages=2000, page_size=20000, repeat=5):
+    path = tempfile.mkdtemp()
+    try:
+        cache = FileCache('bench', path)
+        urls = ['http://example.com/catalog/%d' % i for i in range(pages)]
+        for url in urls:
+            cache.write_to_cache(url, 'x' * page_size)
+        parser = Parser(cache)
+
+        legacy = measure(lambda url: legacy_get_page(parser, url), urls, repeat)
+        lookup = measure(parser.get_page, urls, repeat)
+    finally:
+        shutil.rmtree(path)
+
+    return {'legacy_pages_s': legacy, 'lookup_pages_s': lookup, 'speedup': lookup / legacy}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--pages', type=int, default=2000)
+    parser.add_argument('--page-size', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    result = run(args.pages, args.page_size, args.repeat)
+    print('legacy get_page: %10.0f pages/s' % result['legacy_pages_s'])
+    print('lookup get_page: %10.0f pages/s' % result['lookup_pages_s'])
+    print('speedup:         %10.2fx' % result['speedup'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+# -*- encoding: utf-8 -*-
+"""
+BasicParser.get_page() with cold and warm FileCache and
+NetworkManager.download_page() in different charsets, against the
+local HTTP stub
+"""
+
+import time
+import shutil
+import tempfile
+import argparse
+
+from parselab.cache import FileCache
+from parselab.network import NetworkManager
+from parselab.parsing import BasicParser
+
+from benchmarks.stub import StubServer
+
+
+class Parser(BasicParser):
+
+    def __init__(self, cache, net):
+        BasicParser.__init__(self)
+        self.cache = cache
+        self.net = net
+
+    def get_sleep_time(self):
+        return 0
+
+
+def measure(func, urls):
+    """
+    Returns throughput, calls/s, and median and 99th percentile latency, ms
+    """
+    latencies = []
+    started = time.time()
+    for url in urls:
+        call_started = time.time()
+        func(url)
+        latencies.append(time.time() - call_started)
+    elapsed = time.time() - started
+    latencies.sort()
+    return {'calls_s': len(urls) / elapsed,
+            'p50_ms': latencies[len(latencies) // 2] * 1000,
+            'p99_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000}
+
+
+def run(pages=200, page_size=20000, latency=0, charsets=(('utf-8', 'header'), ('cp1251', 'meta'),
+                                                             ('utf-8', 'none'))):
+    results = dict()
+    with StubServer(latency=latency, size=page_size) as server:
+        urls = [server.get_url('/catalog/%d' % i) for i in range(pages)]
+        path = tempfile.mkdtemp()
+        try:
+            parser = Parser(FileCache('bench', path), NetworkManager())
+            results['get_page_cold'] = measure(parser.get_page, urls)
+            results['get_page_warm'] = measure(parser.get_page, urls)
+        finally:
+            shutil.rmtree(path)
+
+        net = NetworkManager()
+        for charset, declare in charsets:
+            query = '?charset=%s&declare=%s' % (charset, declare)
+            results['download_page_%s_%s' % (charset, declare)] = measure(
+                net.download_page, [url + query for url in urls])
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--pages', type=int, default=200)
+    parser.add_argument('--page-size', type=int, default=20000)
+    parser.add_argument('--latency', type=float, default=0, help='Latency of the stub server, s')
+    args = parser.parse_args()
+
+    print('%-30s %10s %8s %8s' % ('', 'calls/s', 'p50 ms', 'p99 ms'))
+    for name, r in sorted(run(args.pages, args.page_size, args.latency).items()):
+        print('%-30s %10.0f %8.2f %8.2f' % (name, r['calls_s'], r['p50_ms'], r['p99_ms']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+# -*- encoding: utf-8 -*-
+"""
+Local HTTP server which serves synthetic catalog pages, so benchmarks
+don't depend on the network
+"""
+
+import time
+import random
+import threading
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qsl
+
+from benchmarks.compression import make_page
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Serves GET /<anything>?latency=0.01&size=20000&status=200&charset=utf-8
+    &declare=header, query parameters override defaults of the server.
+    declare is where the charset is declared: header, meta or none.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, delayed ACK would add 40 ms to every response
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = dict(self.server.defaults)
+        params.update(parse_qsl(url.query))
+        time.sleep(float(params['latency']))
+
+        status = int(params['status'])
+        charset = params['charset']
+        page = self.server.get_page(url.path, int(params['size']))
+        if params['declare'] == 'meta':
+            page = page.replace('<head>', '<head><meta charset="%s">' % charset, 1)
+        body = page.encode(charset, 'replace') if status == 200 else b''
+
+        self.send_response(status)
+        if params['declare'] == 'header':
+            self.send_header('Content-Type', 'text/html; charset=%s' % charset)
+        else:
+            self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, latency=0, size=20000, status=200, charset='utf-8', declare='header'):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.defaults = {'latency': latency, 'size': size, 'status': status, 'charset': charset,
+                         'declare': declare}
+        self.pages = dict()
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    def get_page(self, path, size):
+        # Pages are generated once, the same path always has the same content
+        with self.lock:
+            key = (path, size)
+            if key not in self.pages:
+                self.pages[key] = make_page(random.Random(path), size)
+            return self.pages[key]
+
+    def get_url(self, path='/'):
+        return 'http://127.0.0.1:%s%s' % (self.server_address[1], path)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,121 @@
+# -*- encoding: utf-8 -*-
+"""
+Runs all benchmarks offline and writes results into a JSON file, which
+can be compared with results of a previous release
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+
+import parselab
+
+from benchmarks import compression, database, lookup, pages, unhtml
+
+# Parameters of benchmarks, the quick ones are for smoke runs
+PARAMS = {
+    'full': {
+        'unhtml': {'fragments': 2000, 'repeat': 5},
+        'lookup': {'pages': 2000, 'page_size': 20000, 'repeat': 5},
+        'compression': {'pages': 500, 'page_size': 100000},
+        'pages': {'pages': 500, 'page_size': 20000, 'latency': 0},
+        'database': {'products': 5000, 'attributes': 10},
+    },
+    'quick': {
+        'unhtml': {'fragments': 100, 'repeat': 1},
+        'lookup': {'pages': 50, 'page_size': 2000, 'repeat': 1},
+        'compression': {'pages': 20, 'page_size': 5000},
+        'pages': {'pages': 20, 'page_size': 2000, 'latency': 0},
+        'database': {'products': 50, 'attributes': 5},
+    },
+}
+
+BENCHMARKS = {'unhtml': unhtml, 'lookup': lookup, 'compression': compression, 'pages': pages,
+              'database': database}
+
+# Suffixes of metrics where more is better and where less is better, others are not compared
+HIGHER = ('_s', 'speedup', 'ratio')
+LOWER = ('_ms', '_per_product')
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(names=None, quick=False):
+    params = PARAMS['quick' if quick else 'full']
+    results = dict()
+    started = time.time()
+    for name in names or sorted(BENCHMARKS):
+        result = BENCHMARKS[name].run(**params[name])
+        if isinstance(result, list):
+            result = dict((r['codec'], r) for r in result)
+        results[name] = result
+    return {'parselab_version': parselab.__version__, 'commit': get_commit(),
+            'python': platform.python_version(), 'platform': platform.platform(),
+            'started_at': started, 'elapsed': time.time() - started,
+            'params': dict((name, params[name]) for name in results), 'results': results}
+
+
+def flatten(results, prefix=''):
+    """
+    Generates (path, value) of numeric metrics, e.g. ('pages.get_page_warm.calls_s', 1000.0)
+    """
+    for key, value in sorted(results.items()):
+        if isinstance(value, dict):
+            for item in flatten(value, '%s%s.' % (prefix, key)):
+                yield item
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield prefix + key, value
+
+
+def compare(report, baseline, threshold=0.1):
+    """
+    Returns list of (metric, baseline value, value) of metrics which got
+    worse by more than threshold
+    """
+    old = dict(flatten(baseline['results']))
+    regressions = []
+    for key, value in flatten(report['results']):
+        if not old.get(key):
+            continue
+        change = value / float(old[key]) - 1
+        if key.endswith(HIGHER) and change < -threshold or key.endswith(LOWER) and change > threshold:
+            regressions.append((key, old[key], value))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--output', default='benchmarks.json', help='File to write results into')
+    parser.add_argument('--only', action='append', choices=sorted(BENCHMARKS), help='Run only these benchmarks')
+    parser.add_argument('--quick', action='store_true', help='Small inputs, for checking that everything runs')
+    parser.add_argument('--compare', help='Results of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Change which is reported as regression')
+    args = parser.parse_args()
+
+    report = run(args.only, args.quick)
+    with open(args.output, 'wt') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print('Results of %d benchmarks were written into %s in %.0f s' % (len(report['results']), args.output,
+                                                                     report['elapsed']))
+
+    if args.compare:
+        with open(args.compare, 'rt') as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        for key, old, new in regressions:
+            print('%-50s %12.2f -> %12.2f' % (key, old, new))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
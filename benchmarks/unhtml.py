@@ -0,0 +1,77 @@
+# -*- encoding: utf-8 -*-
+"""
+parselab.common.unhtml() compared with replacing keys of unhtml_map one
+by one, over typical product fields and descriptions
+"""
+
+import time
+import random
+import argparse
+
+from functools import reduce
+
+from parselab.common import unhtml, iter_unhtml, unhtml_map
+
+
+def legacy_unhtml(s):
+    return reduce(lambda x, y: x.replace(y, unhtml_map[y]), unhtml_map, s)
+
+
+def get_fragments(count, seed=0):
+    """
+    Returns short fields (names, prices, attribute values) and a few long
+    descriptions, about every tenth word has entities
+    """
+    rnd = random.Random(seed)
+    words = u'Кабель питания Samsung для ноутбука длина размер цвет черный гарантия 12 месяцев 100% медь'.split()
+    entities = [u'&quot;Pro&quot;', u'&laquo;Эко&raquo;', u'5&nbsp;м', u'&lt;b&gt;', u'&amp;', u'&#8212;',
+                u'220&#160;В', u'&amp;lt;', u'&copy;', u'&#124;']
+
+    def get_text(length):
+        return ' '.join(rnd.choice(entities) if rnd.random() < 0.1 else rnd.choice(words) for _ in range(length))
+
+    fragments = []
+    for i in range(count):
+        if i % 20 == 0:
+            fragments.append('\r\n'.join(get_text(12) for _ in range(200)))
+        else:
+            fragments.append(get_text(rnd.randint(1, 8)))
+    return fragments
+
+
+def measure(func, fragments, repeat):
+    started = time.time()
+    for _ in range(repeat):
+        for fragment in fragments:
+            func(fragment)
+    return len(fragments) * repeat / (time.time() - started)
+
+
+def run(fragments=2000, repeat=5):
+    items = get_fragments(fragments)
+    for item in items:
+        assert unhtml(item) == legacy_unhtml(item)
+
+    legacy = measure(legacy_unhtml, items, repeat)
+    current = measure(unhtml, items, repeat)
+    streaming = measure(lambda s: ''.join(iter_unhtml(s[i:i + 4096] for i in range(0, len(s), 4096))),
+                        items, repeat)
+    return {'legacy_calls_s': legacy, 'unhtml_calls_s': current, 'iter_unhtml_calls_s': streaming,
+            'speedup': current / legacy}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--fragments', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    result = run(args.fragments, args.repeat)
+    print('legacy unhtml: %10.0f calls/s' % result['legacy_calls_s'])
+    print('unhtml:        %10.0f calls/s' % result['unhtml_calls_s'])
+    print('iter_unhtml:   %10.0f calls/s' % result['iter_unhtml_calls_s'])
+    print('speedup:       %10.2fx' % result['speedup'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+import time
+import asyncio
+import logging
+
+from urllib.parse import urlparse
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from parselab import metrics
+from parselab.network import Response, get_request_headers, check_response, get_text, record_request
+from parselab.proxy import get_proxy_pool
+
+__all__ = ['AsyncNetworkManager', 'Response']
+
+logger = logging.getLogger(__name__)
+
+class AsyncNetworkManager(object):
+    """
+    asyncio counterpart of NetworkManager based on aiohttp. At most
+    concurrency requests are in flight at the same time, and at most
+    host_concurrency of them go to the same host.
+    """
+
+    pageDownloadTriesCount = 3
+
+    def __init__(self, proxies={}, concurrency=100, host_concurrency=8, timeout=60, rate_limiter=None):
+        if aiohttp is None:
+            raise ImportError('aiohttp is required for AsyncNetworkManager, install parselab[async]')
+        self.proxies = proxies
+        self.proxy_pool = get_proxy_pool(proxies)
+        self.concurrency = concurrency
+        self.host_concurrency = host_concurrency
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        self.session = None
+        self.semaphore = None
+        self.host_semaphores = dict()
+        logger.info('AsyncNetworkManager initialized with proxy setting: %s' % self.proxies)
+
+    def get_session(self):
+        # Session and semaphores have to be created inside of the running event loop
+        if self.session is None:
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        return self.session
+
+    def get_host_semaphore(self, url):
+        host = urlparse(url).netloc
+        if host not in self.host_semaphores:
+            self.host_semaphores[host] = asyncio.Semaphore(self.host_concurrency)
+        return self.host_semaphores[host]
+
+    async def close(self):
+        # Semaphores are bound to the loop, the manager can be used in another one after close()
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+        self.semaphore = None
+        self.host_semaphores = dict()
+
+    async def fetch(self, url, cookies=None, binary=False, validators=None):
+        """
+        Returns Response if page was downloaded, raises NotModified
+        if validators are given and page has not been changed
+        """
+        session = self.get_session()
+        host_semaphore = self.get_host_semaphore(url)
+        tries = 0
+
+        while True:
+            if self.proxy_pool is not None:
+                proxy = self.proxy_pool.choose()
+                logger.info('Using proxy: %s' % proxy.url)
+            else:
+                proxy = None
+
+            if self.rate_limiter is not None:
+                delay = self.rate_limiter.reserve(url)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+            try:
+                # Requests waiting for a busy host must not take global slots from other hosts
+                async with host_semaphore, self.semaphore:
+                    started = time.time()
+                    async with session.get(url, headers=get_request_headers(validators), cookies=cookies,
+                                           proxy=proxy.url if proxy is not None else None) as r:
+                        content = await r.read()
+                        response = Response(str(r.url), r.status, r.headers, content)
+                latency = time.time() - started
+                if metrics.registry is not None:
+                    record_request(url, response, latency)
+                if self.rate_limiter is not None:
+                    self.rate_limiter.feedback(url, response.status_code, latency,
+                                               response.headers.get('Retry-After'))
+                if proxy is not None:
+                    self.proxy_pool.report(proxy, response.status_code, latency)
+                break
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                tries += 1
+                if metrics.registry is not None:
+                    metrics.inc('http_connection_errors', host=metrics.get_host(url))
+                if proxy is not None:
+                    self.proxy_pool.report_failure(proxy)
+                if tries >= self.pageDownloadTriesCount:
+                    logger.error('Could not download page in %s tries' % self.pageDownloadTriesCount)
+                    return None
+                if proxy is not None:
+                    logger.info('Connection error using proxy %s' % proxy.url)
+                else:
+                    logger.info('Connection error, sleeping for 10 s')
+                    await asyncio.sleep(10)
+
+        return check_response(response, validators)
+
+    async def download_page(self, url, cookies=None, binary=False, validators=None):
+        response = await self.fetch(url, cookies=cookies, binary=binary, validators=validators)
+        if response is None or binary:
+            return response
+        else:
+            return get_text(response)
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import tempfile
+
+from decimal import Decimal
+
+__all__ = ['BulkLoader', 'CopyBuffer']
+
+logger = logging.getLogger(__name__)
+
+# Special characters of COPY text format
+COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+def format_copy_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (int, float, Decimal)):
+        return str(value)
+    return str(value).translate(COPY_ESCAPES)
+
+class CopyBuffer(object):
+    """
+    Rows in COPY text format, kept in memory until they take more than
+    spool_size bytes and in a temporary file afterwards
+    """
+
+    def __init__(self, spool_size=64 * 2 ** 20):
+        self.file = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        self.count = 0
+
+    def write(self, row):
+        self.file.write(('\t'.join(map(format_copy_value, row)) + '\n').encode('utf-8'))
+        self.count += 1
+
+    def rewind(self):
+        self.file.seek(0)
+        return self.file
+
+    def close(self):
+        self.file.close()
+
+class BulkLoader(object):
+    """
+    Loads categories, products, their categories and attribute values of
+    ParsingDatabase project with COPY into temporary staging tables, and
+    merges them into public tables with one statement for each table, in
+    one transaction. Rows are matched with the existing ones the same way
+    get_category_id() and get_product_id() do it, categories of products
+    are linked by product URL, to the product the URL was matched with.
+    As in get_product_id(), a product with the SKU of another product but
+    different URL is an error, nothing is loaded then. Attribute values are rows of t_attribute_value type, as
+    for set_bulk_attribute_value().
+    """
+
+    # Staging table, its columns and the query which merges it, in order of loading
+    tables = [
+        ('category', 'bulk_category (name text, parent_id bigint, url text)', '''
+        insert into public.category (project_id, name, parent_id, url)
+        select distinct on (s.name, s.parent_id) %(project_id)s, s.name, s.parent_id, s.url
+          from bulk_category s
+         where not exists (
+            select *
+              from public.category c
+             where c.project_id = %(project_id)s
+               and c.name = s.name
+               and c.parent_id is not distinct from s.parent_id
+        )
+        '''),
+        ('product', 'bulk_product (sku text, name text, url text, manufacturer_id bigint, price numeric)', '''
+        insert into public.product (project_id, sku, name, url, manufacturer_id, price)
+        select distinct on (s.url) %(project_id)s, s.sku, s.name, s.url, s.manufacturer_id, s.price
+          from bulk_product s
+         where not exists (
+            select *
+              from public.product p
+             where p.project_id = %(project_id)s
+               and case when s.sku is not null then p.sku = s.sku
+                        when s.manufacturer_id is not null then p.name = s.name and p.manufacturer_id = s.manufacturer_id
+                        else p.name = s.name
+                   end
+        )
+        '''),
+        ('product_category', 'bulk_product_category (url text, category_id bigint)', '''
+        insert into public.product_category (project_id, product_id, category_id)
+        select distinct %(project_id)s, p.id, s.category_id
+          from bulk_product_category s
+          left join bulk_product_id m on m.url = s.url
+          join public.product p on p.project_id = %(project_id)s
+                               and case when m.url is not null then p.id = m.product_id else p.url = s.url end
+         where not exists (
+            select *
+              from public.product_category pc
+             where pc.project_id = %(project_id)s
+               and pc.product_id = p.id
+               and pc.category_id = s.category_id
+        )
+        '''),
+        ('attribute_value', 'bulk_attribute_value of t_attribute_value', '''
+        select public.set_bulk_attribute_value(%(project_id)s,
+                                               array(select row(s.*)::t_attribute_value from bulk_attribute_value s))
+        '''),
+    ]
+
+    # Staged products mapped to the products they were merged with, by the rule of the product merge
+    product_ids_table = 'bulk_product_id (url text, product_id bigint)'
+    product_ids = '''
+    insert into bulk_product_id (url, product_id)
+    select distinct on (s.url) s.url, p.id
+      from bulk_product s
+      join public.product p on p.project_id = %(project_id)s
+                           and case when s.sku is not null then p.sku = s.sku
+                                    when s.manufacturer_id is not null then p.name = s.name and p.manufacturer_id = s.manufacturer_id
+                                    else p.name = s.name
+                               end
+     order by s.url, p.id
+    '''
+
+    # Product with the same SKU but different URL, in the project or among loaded products
+    product_conflict = '''
+    with conflict as (
+        select s.sku, s.url, p.url as conflict_url
+          from bulk_product s
+          join public.product p on p.project_id = %(project_id)s and p.sku = s.sku and p.url != s.url
+         union all
+        select s.sku, s.url, o.url
+          from bulk_product s
+          join bulk_product o on o.sku = s.sku and o.url < s.url
+         limit 1
+    )
+    select (select sku from conflict) as sku,
+           (select url from conflict) as url,
+           (select conflict_url from conflict) as conflict_url
+    '''
+
+    def __init__(self, db, spool_size=64 * 2 ** 20):
+        self.db = db
+        self.buffers = dict((name, CopyBuffer(spool_size)) for name, _, _ in self.tables)
+
+    def add_category(self, name, parent_id=None, url=None):
+        self.buffers['category'].write((name, parent_id, url))
+
+    def add_product(self, sku, name, url, manufacturer_id=None, price=None):
+        self.buffers['product'].write((sku, name, url, manufacturer_id, price))
+
+    def add_product_to_category(self, url, category_id):
+        self.buffers['product_category'].write((url, category_id))
+
+    def add_attribute_value(self, row):
+        self.buffers['attribute_value'].write(row)
+
+    def load(self):
+        """
+        Loads all added rows, returns dictionary which maps URLs of
+        loaded products to their IDs
+        """
+        params = {'project_id': self.db.project_id}
+        with self.db.connection() as conn:
+            return self.load_rows(conn, params)
+
+    def load_rows(self, conn, params):
+        self.db.execute('begin', None)
+        try:
+            if self.buffers['product'].count or self.buffers['product_category'].count:
+                self.db.execute('create temporary table if not exists %s on commit delete rows'
+                                % self.product_ids_table, None)
+            for name, table, merge in self.tables:
+                buf = self.buffers[name]
+                if not buf.count:
+                    continue
+                self.db.execute('create temporary table if not exists %s on commit delete rows' % table, None)
+                self.db.copy_expert('copy %s from stdin' % table.split()[0], buf.rewind())
+                if name == 'product':
+                    self.check_products(params)
+                self.db.execute(merge, params)
+                if name == 'product':
+                    self.db.execute(self.product_ids, params)
+                logger.info('%s rows of %s were loaded' % (buf.count, name))
+            if self.buffers['product'].count:
+                ids = self.db.query_dict('select url, product_id from bulk_product_id', None)
+            else:
+                ids = []
+            self.db.execute('commit', None)
+        except Exception:
+            # Transaction of a broken connection is already gone
+            if not conn.closed:
+                self.db.execute('rollback', None)
+            raise
+        finally:
+            self.close()
+        return dict((row[0], row[1]) for row in ids)
+
+    def check_products(self, params):
+        row = self.db.query_row(self.product_conflict, params)
+        if row['conflict_url'] is not None:
+            raise Exception('Product with the same SKU but different URL has been found. SKU = %s, '
+                            'new URL %s, existing URL %s' % (row['sku'], row['url'], row['conflict_url']))
+
+    def close(self):
+        for buf in self.buffers.values():
+            buf.close()
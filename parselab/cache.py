@@ -1,20 +1,238 @@
 # -*- encoding: utf-8 -*-
 
+import io
 import os
 import sys
+import time
+import errno
+import inspect
+import json
+import mmap
+import zlib
+import struct
 import hashlib
 import logging
+import threading
 
+from collections import OrderedDict
+
+from parselab import metrics
 from parselab.network import PageNotFound
 
-__all__ = ['CacheInterface', 'MockCache', 'FileCache']
+__all__ = ['CacheInterface', 'MockCache', 'FileCache', 'MemoryCache', 'CacheResult', 'Codec',
+           'ZlibCodec', 'GzipCodec', 'register_codec', 'get_codec', 'HIT', 'ERROR', 'MISS']
 
 logger = logging.getLogger(__name__)
 
+# Entries written with a codec start with magic, header length and JSON header,
+# entries without magic are legacy raw files
+ENTRY_MAGIC = b'\x89PLC'
+ENTRY_HEADER_LENGTH = struct.Struct('<H')
+
+CHUNK_SIZE = 1 << 16
+
+# Statuses of cache lookup
+HIT = 'hit'
+ERROR = 'error'
+MISS = 'miss'
+
+class Codec(object):
+    """
+    Compression codec for cache entries. compressor() should return an object
+    with compress() and flush() methods, decompressor() should return an
+    object with decompress() method, like zlib does.
+    """
+    name = None
+
+    def compressor(self):
+        raise NotImplementedError
+
+    def decompressor(self):
+        raise NotImplementedError
+
+class ZlibCodec(Codec):
+
+    name = 'zlib'
+    wbits = zlib.MAX_WBITS
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compressor(self):
+        return zlib.compressobj(self.level, zlib.DEFLATED, self.wbits)
+
+    def decompressor(self):
+        return zlib.decompressobj(self.wbits)
+
+class GzipCodec(ZlibCodec):
+
+    name = 'gzip'
+    wbits = 16 + zlib.MAX_WBITS
+
+codecs = dict()
+
+def register_codec(codec):
+    """
+    Registers codec, so entries compressed with it can be read
+    """
+    codecs[codec.name] = codec
+
+def get_codec(codec):
+    """
+    Returns codec instance by its name, instances are returned as is
+    """
+    if codec is None or isinstance(codec, Codec):
+        return codec
+    if codec not in codecs:
+        raise ValueError('Unknown codec: %s' % codec)
+    return codecs[codec]
+
+register_codec(ZlibCodec())
+register_codec(GzipCodec())
+
+def pack_entry(chunks, codec=None, meta=None):
+    """
+    Generates chunks of cache entry for iterable of data chunks,
+    meta is a dictionary of response metadata saved in entry header
+    """
+    if codec is None and not meta:
+        for chunk in chunks:
+            yield chunk
+        return
+
+    header = dict(meta or {})
+    if codec is not None:
+        header['codec'] = codec.name
+    header = json.dumps(header).encode('utf-8')
+    yield ENTRY_MAGIC + ENTRY_HEADER_LENGTH.pack(len(header)) + header
+    if codec is None:
+        for chunk in chunks:
+            yield chunk
+        return
+
+    compressor = codec.compressor()
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def read_entry_header(f):
+    """
+    Reads header of entry from binary file object, returns None for legacy
+    entries leaving file position at the beginning of the data
+    """
+    magic = f.read(len(ENTRY_MAGIC))
+    if magic != ENTRY_MAGIC:
+        f.seek(0)
+        return None
+    length, = ENTRY_HEADER_LENGTH.unpack(f.read(ENTRY_HEADER_LENGTH.size))
+    return json.loads(f.read(length).decode('utf-8'))
+
+def split_entry(buf):
+    """
+    Returns tuple (header, payload) for buffer which holds the whole entry,
+    payload is a memoryview of the buffer, so nothing is copied
+    """
+    view = memoryview(buf)
+    if view[:len(ENTRY_MAGIC)] != ENTRY_MAGIC:
+        return None, view
+    start = len(ENTRY_MAGIC) + ENTRY_HEADER_LENGTH.size
+    length, = ENTRY_HEADER_LENGTH.unpack(view[len(ENTRY_MAGIC):start])
+    header = json.loads(view[start:start + length].tobytes().decode('utf-8'))
+    return header, view[start + length:]
+
+def get_entry_buffer(buf):
+    """
+    Returns memoryview of decoded data of entry stored in buffer, only
+    compressed entries are copied
+    """
+    header, payload = split_entry(buf)
+    if header is None or not header.get('codec'):
+        return payload
+    return memoryview(b''.join(iter_entry(io.BytesIO(payload), header)))
+
+def iter_entry(f, header, chunk_size=CHUNK_SIZE):
+    """
+    Generates decoded data chunks of entry, file position should be
+    right after the header
+    """
+    codec = get_codec(header.get('codec')) if header else None
+    decompressor = codec.decompressor() if codec else None
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+        if decompressor is not None:
+            chunk = decompressor.decompress(chunk)
+        if chunk:
+            yield chunk
+    if decompressor is not None and hasattr(decompressor, 'flush'):
+        chunk = decompressor.flush()
+        if chunk:
+            yield chunk
+
+def decode_data(data, header):
+    """
+    Decodes text page with encoding saved in entry header, pages saved
+    without it were encoded to utf-8
+    """
+    encoding = header.get('encoding') if header else None
+    if encoding is None:
+        return data.decode('utf-8')
+    return data.decode(encoding, 'replace')
+
+def accepts_meta(cache):
+    """
+    Checks whether write_to_cache() of cache takes meta, caches written
+    before it was added only save decoded text pages
+    """
+    try:
+        parameters = inspect.signature(cache.write_to_cache).parameters
+    except (TypeError, ValueError):
+        return False
+    return 'meta' in parameters or any(p.kind == p.VAR_KEYWORD for p in parameters.values())
+
+class CacheResult(object):
+    """
+    Result of cache lookup: status is HIT with data, ERROR with the error
+    saved in cache, or MISS. filename is where the page is (or would be) stored,
+    meta is response metadata saved with the page, fetched_at is the time
+    when the page was downloaded or revalidated last time.
+    """
+
+    def __init__(self, status, data=None, error=None, filename=None, meta=None, fetched_at=None):
+        self.status = status
+        self.data = data
+        self.error = error
+        self.filename = filename
+        self.meta = meta or dict()
+        self.fetched_at = fetched_at
+
+    def __repr__(self):
+        return '<CacheResult %s %s>' % (self.status, self.filename)
+
 class CacheInterface():
     """
     Interface for cache
     """
+    def lookup(self, url, binary=False):
+        """
+        Returns CacheResult for url, caches may override it to avoid
+        repeated lookups of the same entry
+        """
+        filename = self.get_cached_filename(url)
+        if self.is_in_cache(url):
+            return CacheResult(HIT, data=self.get_file(url, binary), filename=filename)
+        error = self.get_error_from_cache(url)
+        if error is not None:
+            return CacheResult(ERROR, error=error, filename=filename)
+        return CacheResult(MISS, filename=filename)
+
+    def touch(self, url):
+        """
+        Marks page as just fetched, e.g. after server responded that
+        it was not modified
+        """
+        pass
+
     def get_file(url):
         """ Gets file from cache """
         raise NotImplementedError
@@ -32,23 +250,42 @@ class CacheInterface():
 
 class MockCache(CacheInterface):
 
-    def is_in_cache(url):
+    def lookup(self, url, binary=False):
+        return CacheResult(MISS)
+
+    def is_in_cache(self, url):
         return False
 
-    def get_file(url):
+    def get_file(self, url, binary=False):
         """
         Should not be called because is_in_cache() always returns False
         """
         return None
 
+def make_dir(path):
+    """
+    Creates directory, it may be created by another process at the same time
+    """
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
 class FileCache(CacheInterface):
 
     path = None
+    codec = None
 
     def get_cache_path(self):
         return self.path
 
-    def __init__(self, namespace, path):
+    def __init__(self, namespace, path, codec=None):
+        """
+        codec -- compress new entries with codec ('zlib', 'gzip' or Codec
+        instance), entries written without compression are still readable
+        """
+        self.codec = get_codec(codec)
         if path:
             self.path = os.path.join(path, namespace)
         else:
@@ -56,15 +293,15 @@ class FileCache(CacheInterface):
 
         logger.info('Cache initialization, path = %s' % self.get_cache_path())
         if not os.path.isdir(self.get_cache_path()):
-            os.makedirs(self.get_cache_path())
+            make_dir(self.get_cache_path())
 
         for i in range(0,16):
             if not os.path.isdir(os.path.join(self.get_cache_path(), '%x' % i)):
-                os.mkdir(os.path.join(self.get_cache_path(), '%x' % i))
+                make_dir(os.path.join(self.get_cache_path(), '%x' % i))
 
             for j in range(0,16):
                 if not os.path.isdir(os.path.join(self.get_cache_path(), '%x' % i, '%x%x' % (i,j))):
-                    os.mkdir(os.path.join(self.get_cache_path(), '%x' % i, '%x%x' % (i,j)))
+                    make_dir(os.path.join(self.get_cache_path(), '%x' % i, '%x%x' % (i,j)))
 
     def get_cached_filename(self, url):
         if sys.version_info[0] < 3:
@@ -84,8 +321,27 @@ class FileCache(CacheInterface):
         return os.path.exists('%s.error' % self.get_cached_filename(url))
 
     def save_error_in_cache(self, url, error='ERROR'):
-        with open('%s.error' % self.get_cached_filename(url), 'wt') as f:
-            f.write(error)
+        self.write_atomically('%s.error' % self.get_cached_filename(url), [error], 'wt')
+
+    def write_atomically(self, filename, chunks, mode='wb'):
+        """
+        Writes chunks into temporary file which is renamed to filename
+        afterwards, so nobody ever reads partially written file
+        """
+        tmp_filename = '%s.%s.%s.tmp' % (filename, os.getpid(), threading.current_thread().ident)
+        try:
+            with io.open(tmp_filename, mode, buffering=CHUNK_SIZE) as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                # Text mode write() counts characters, bytes are taken from the file
+                f.flush()
+                size = os.fstat(f.fileno()).st_size
+            os.replace(tmp_filename, filename)
+            metrics.inc('cache_bytes_written', size)
+        except BaseException:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            raise
 
     def get_error_from_cache(self, url):
         if not self.is_in_cache_error(url):
@@ -101,24 +357,120 @@ class FileCache(CacheInterface):
                 raise PageNotFound()
             return None
 
-        if binary:
-            return open(self.get_cached_filename(url), 'rb').read()
+        with open(self.get_cached_filename(url), 'rb') as f:
+            return self.read_file(f, binary)
+
+    def read_file(self, f, binary=False):
+        return self.decode_file(f, read_entry_header(f), binary)
+
+    def decode_file(self, f, header, binary=False):
+        if header is None and not binary:
+            # Legacy entries were written in text mode with default encoding
+            return io.TextIOWrapper(f).read()
+        if header is None or not header.get('codec'):
+            data = f.read()
         else:
-            return open(self.get_cached_filename(url)).read()
+            data = b''.join(iter_entry(f, header))
+        return data if binary else decode_data(data, header)
 
-    def write_to_cache(self, url, data, binary=False):
-        if binary:
-            with open(self.get_cached_filename(url), 'wb') as f:
-                # TODO: Think how to avoid requests module dependence
-                for chunk in data.iter_content(chunk_size=1024):
-                    f.write(chunk)
+    def lookup(self, url, binary=False):
+        """
+        Looks up the page hashing URL only once: opens the file directly
+        instead of checking its existence, and checks the error file only
+        if there is no page
+        """
+        filename = self.get_cached_filename(url)
+        try:
+            with open(filename, 'rb') as f:
+                stat = os.fstat(f.fileno())
+                header = read_entry_header(f)
+                data = self.decode_file(f, header, binary)
+            fetched_at = stat.st_mtime
+            metrics.inc('cache_bytes_read', stat.st_size)
+            if data:
+                return CacheResult(HIT, data=data, filename=filename, meta=header, fetched_at=fetched_at)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        try:
+            with open('%s.error' % filename, 'rt') as f:
+                return CacheResult(ERROR, error=f.read(), filename=filename)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        return CacheResult(MISS, filename=filename)
+
+    def iter_file(self, url, chunk_size=CHUNK_SIZE):
+        """
+        Generates decompressed chunks of the file, so large binary files
+        don't have to be loaded into memory
+        """
+        with open(self.get_cached_filename(url), 'rb') as f:
+            header = read_entry_header(f)
+            for chunk in iter_entry(f, header, chunk_size):
+                yield chunk
+
+    def touch(self, url):
+        os.utime(self.get_cached_filename(url), None)
+
+    def get_urls(self):
+        """
+        Generates URLs of cached pages. URL is saved in the entry header
+        by BasicParser, pages saved without it are skipped.
+        """
+        for i in '0123456789abcdef':
+            for j in '0123456789abcdef':
+                directory = os.path.join(self.get_cache_path(), i, i + j)
+                for name in sorted(os.listdir(directory)):
+                    # Skip errors and temporary files
+                    if len(name) != 32:
+                        continue
+                    with open(os.path.join(directory, name), 'rb') as f:
+                        header = read_entry_header(f)
+                    if header and header.get('url'):
+                        yield header['url']
+
+    def write_to_cache(self, url, data, binary=False, meta=None):
+        """
+        Saves page into cache, meta is a dictionary of response metadata
+        (e.g. etag and last_modified) which is returned by lookup(). With
+        binary=True data is a response which content is saved as is, text
+        pages are saved this way too if meta has their encoding.
+        """
+        filename = self.get_cached_filename(url)
+        if self.codec is not None or meta:
+            if binary:
+                chunks = data.iter_content(chunk_size=CHUNK_SIZE)
+            else:
+                chunks = [data.encode('utf-8')]
+            self.write_atomically(filename, pack_entry(chunks, self.codec, meta))
+        elif binary:
+            # TODO: Think how to avoid requests module dependence
+            self.write_atomically(filename, data.iter_content(chunk_size=CHUNK_SIZE))
         else:
-            with open(self.get_cached_filename(url), 'w') as f:
-                if sys.version_info[0] < 3:
-                    f.write(data.encode('utf8'))
-                else:
-                    f.write(data)
-        logging.info('File %s was written' % self.get_cached_filename(url))
+            if sys.version_info[0] < 3:
+                self.write_atomically(filename, [data.encode('utf8')], 'w')
+            else:
+                self.write_atomically(filename, [data], 'w')
+        logger.info('File %s was written' % filename)
+
+    def get_buffer(self, url):
+        """
+        Returns memoryview of the file. Uncompressed files are memory mapped
+        instead of being read, so large binary files are never copied.
+        """
+        if self.is_in_cache_error(url):
+            error = self.get_error_from_cache(url)
+            if error == 'PageNotFound':
+                raise PageNotFound()
+            return None
+
+        with open(self.get_cached_filename(url), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return memoryview(b'')
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return get_entry_buffer(buf)
 
     def get_document(self, url):
         return self.get_file(url, binary=False)
@@ -132,3 +484,130 @@ class FileCache(CacheInterface):
         """
         os.remove(self.get_cached_filename(url))
         logger.warning('File %s has been removed from cache' % self.get_cached_filename(url))
+
+class MemoryCache(CacheInterface):
+    """
+    In-process LRU cache of pages in front of another cache. Pages are kept
+    in memory until total size exceeds max_bytes or number of pages exceeds
+    max_entries, the backend cache is used for everything else.
+    """
+
+    def __init__(self, backend, max_bytes=64 * 2 ** 20, max_entries=10000):
+        self.backend = backend
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __getattr__(self, name):
+        # Everything that is not cached in memory goes directly to backend
+        return getattr(self.backend, name)
+
+    def get_stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self.entries), 'bytes': self.size}
+
+    def put(self, url, binary, data, meta=None, fetched_at=None):
+        size = sys.getsizeof(data)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            self.discard(url)
+            self.entries[(url, binary)] = [data, size, meta, fetched_at or time.time()]
+            self.size += size
+            while self.size > self.max_bytes or len(self.entries) > self.max_entries:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted[1]
+                self.evictions += 1
+
+    def discard(self, url):
+        with self.lock:
+            for key in ((url, False), (url, True)):
+                if key in self.entries:
+                    self.size -= self.entries.pop(key)[1]
+
+    def get_entry(self, url, binary):
+        """
+        Returns cached entry and marks it as recently used, counts hits and misses
+        """
+        key = (url, binary)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return None
+
+    def is_in_cache(self, url):
+        return (url, False) in self.entries or (url, True) in self.entries or \
+            self.backend.is_in_cache(url)
+
+    def get_file(self, url, binary=False):
+        entry = self.get_entry(url, binary)
+        if entry is not None:
+            return entry[0]
+
+        data = self.backend.get_file(url, binary)
+        if data is not None:
+            self.put(url, binary, data)
+        return data
+
+    def lookup(self, url, binary=False):
+        entry = self.get_entry(url, binary)
+        if entry is not None:
+            data, _, meta, fetched_at = entry
+            return CacheResult(HIT, data=data, meta=meta, fetched_at=fetched_at)
+
+        result = self.backend.lookup(url, binary)
+        if result.status == HIT and result.data is not None:
+            self.put(url, binary, result.data, result.meta, result.fetched_at)
+        return result
+
+    def touch(self, url):
+        with self.lock:
+            for key in ((url, False), (url, True)):
+                if key in self.entries:
+                    self.entries[key][3] = time.time()
+        self.backend.touch(url)
+
+    def write_to_cache(self, url, data, binary=False, meta=None):
+        if binary and meta and meta.get('encoding'):
+            # Text page saved undecoded, it's kept as text as the backend would return it
+            text = data.content.decode(meta['encoding'], 'replace')
+            if accepts_meta(self.backend):
+                self.backend.write_to_cache(url, data, binary, meta)
+            else:
+                self.backend.write_to_cache(url, text, False)
+            self.put(url, False, text, meta)
+            return
+        if accepts_meta(self.backend):
+            self.backend.write_to_cache(url, data, binary, meta)
+        else:
+            self.backend.write_to_cache(url, data, binary)
+        if not binary:
+            self.put(url, binary, data, meta)
+        else:
+            # Response body has been consumed by backend, it will be loaded on next read
+            self.discard(url)
+
+    def save_error_in_cache(self, url, error='ERROR'):
+        self.discard(url)
+        self.backend.save_error_in_cache(url, error)
+
+    def get_document(self, url):
+        return self.get_file(url, binary=False)
+
+    def get_binary_file(self, url, force_download=False):
+        return self.get_file(url, binary=True)
+
+    def remove_from_cache(self, url):
+        """
+        Removes file from cache
+        """
+        self.discard(url)
+        self.backend.remove_from_cache(url)
@@ -1,6 +1,10 @@
 # -*- encoding: utf-8 -*-
 
-from functools import reduce
+import re
+import html
+import threading
+
+from collections import OrderedDict
 
 unhtml_map = {
     '&quot;': '"', '&laquo;': '"', '&raquo;': '"', '&#34;': '"', '&#8220;': '"',
@@ -21,8 +25,145 @@ def with_color(c, s):
         color = c
     return "\x1b[%dm%s\x1b[0m" % (color, s)
 
-def unhtml(s):
+def can_create(replacement, key):
+    """
+    Checks whether replacing text with replacement can make a new
+    occurrence of key, e.g. '&amp;' -> '&' makes '&lt;' from '&amp;lt;'
     """
-    Replaces enquoted special HTML charactes with their ASCII analogs
+    if not replacement:
+        # Removed text joins its neighbours
+        return len(key) > 1
+    if replacement in key or key in replacement:
+        return True
+    return any(key.endswith(replacement[:i]) or key.startswith(replacement[i:]) for i in range(1, len(replacement)))
+
+def can_overlap(a, b):
+    return a in b or b in a or \
+        any(a.endswith(b[:i]) or b.endswith(a[:i]) for i in range(1, min(len(a), len(b))))
+
+def get_unhtml_steps(mapping):
+    """
+    Splits keys of mapping into steps which can be replaced in one pass
+    each, giving the same result as replacing the keys one by one
+    """
+    steps = []
+    for key in mapping:
+        kind = 'delete' if len(key) == 1 and not mapping[key] else 'entity' if key.startswith('&') else 'other'
+        if not steps or steps[-1][0] != kind or \
+           any(can_create(mapping[k], key) or can_overlap(k, key) for k in steps[-1][1]):
+            steps.append((kind, []))
+        steps[-1][1].append(key)
+
+    compiled = []
+    for kind, keys in steps:
+        # Patterns capture keys, so re.split() returns them along with the text between
+        if kind == 'delete':
+            compiled.append((kind, keys, None))
+        elif kind == 'entity':
+            pattern = re.compile('(&(?:%s))' % '|'.join(re.escape(key[1:]) for key in keys))
+            compiled.append((kind, keys, pattern))
+        else:
+            compiled.append((kind, keys, re.compile('(%s)' % '|'.join(re.escape(key) for key in keys))))
+    return compiled
+
+unhtml_steps = get_unhtml_steps(unhtml_map)
+
+# Characters which can be a part of entity after '&', and the longest text which
+# can turn into an entity (e.g. '&amp;lsaquo;'), see iter_unhtml()
+unhtml_chars = frozenset(''.join(key[1:] for key in unhtml_map if key.startswith('&')) + '\n\r')
+unhtml_max_length = 2 * max(len(key) for key in unhtml_map)
+# html.unescape() also decodes named references without semicolon and up to 32 characters long
+full_unhtml_chars = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789#;\n\r')
+full_unhtml_max_length = unhtml_max_length + 34
+
+def unhtml(s, full=False):
+    """
+    Replaces enquoted special HTML charactes with their ASCII analogs. The
+    keys of unhtml_map are replaced in a few passes instead of one by one,
+    with exactly the same result, e.g. '&amp;lt;' still becomes '<'. With full=True all other named and
+    numeric character references are decoded afterwards too.
+    """
+    for kind, keys, pattern in unhtml_steps:
+        if kind == 'delete':
+            for key in keys:
+                s = s.replace(key, '')
+        elif kind == 'other' or '&' in s:
+            # Splitting and joining makes no Python call for every entity, unlike re.sub()
+            parts = pattern.split(s)
+            if len(parts) > 1:
+                parts[1::2] = map(unhtml_map.__getitem__, parts[1::2])
+                s = ''.join(parts)
+    if full and '&' in s:
+        s = html.unescape(s)
+    return s
+
+def iter_unhtml(chunks, full=False):
     """
-    return reduce(lambda x, y: x.replace(y, unhtml_map[y]), unhtml_map, s)
+    Generates unhtml() of text which comes in chunks, e.g. of a large
+    description, the result is the same as of unhtml() of the whole text
+    """
+    chars = full_unhtml_chars if full else unhtml_chars
+    max_length = full_unhtml_max_length if full else unhtml_max_length
+    tail = ''
+    for chunk in chunks:
+        text = tail + chunk
+        # Entities never span an '&' of the source text, so text before the last one
+        # can be converted, unless everything after it can't be a part of an entity
+        i = text.rfind('&')
+        if i == -1:
+            tail = ''
+        else:
+            tail = text[i:]
+            text = text[:i]
+            length = len(tail) - tail.count('\n') - tail.count('\r')
+            if length > max_length or not chars.issuperset(tail[1:]):
+                text, tail = text + tail, ''
+        if text:
+            yield unhtml(text, full)
+    if tail:
+        yield unhtml(tail, full)
+
+class LRUDict(object):
+    """
+    Dictionary which holds at most maxsize items, least recently used
+    ones are removed first. It can be shared by threads.
+    """
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                self.items.move_to_end(key)
+            except KeyError:
+                return default
+            return self.items[key]
+
+    def __getitem__(self, key):
+        with self.lock:
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            if len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def update(self, items):
+        for key, value in items:
+            self[key] = value
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
@@ -1,111 +1,507 @@
 # -*- coding: utf-8 -*-
 
+import os
+import re
+import sys
 import time
+import queue
+import weakref
+import itertools
+import logging
+import warnings
+import threading
+import contextlib
 import psycopg2
 import psycopg2.extensions
 import psycopg2.extras
-import logging
+import psycopg2.pool
+
+from parselab import metrics
 
 logger = logging.getLogger(__name__)
 
 psycopg2.extensions.register_type(psycopg2.extensions.UNICODE)
 
+# Named parameter or escaped percent sign
+PARAMETER_RE = re.compile(r'%\((\w+)\)s|%%')
+
+cursor_numbers = itertools.count()
+
+def get_caller():
+    """
+    Returns name of the function which called Database, e.g. a method
+    of ParsingDatabase
+    """
+    frame = sys._getframe(1)
+    while frame is not None and frame.f_code.co_filename == __file__:
+        frame = frame.f_back
+    return frame.f_code.co_name if frame is not None else 'unknown'
+
 
 class Database(object):
+    """
+    Connection to PostgreSQL. By default it's one connection, which must
+    not be used from several threads. If connected with maxconn, every
+    query takes a connection from a thread-safe pool of up to maxconn
+    connections, or uses the one held by connection() block of the
+    current thread. If connected with prepare=True, queries executed with
+    a name are prepared once per connection. Broken connections are
+    replaced, the first retry is immediate. Queries in connection() block
+    are not retried, the error is raised as the block would lose its
+    transaction and temporary tables on another connection.
+    """
 
     conn = None
+    pool = None
+    __conn = None
+    prepare = False
+    # Longest pause between retries of a query on connection errors, seconds
+    retry_delay = 5
 
     def __init__(self):
         pass
 
-    def connect(self, conn):
-        # If we want to reconnect, we need to save conn for further using
-        if self.conn is None:
-            self.conn = conn
-        self.__conn = psycopg2.connect(conn)
-        self.__conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    def connect(self, conn, minconn=None, maxconn=None, prepare=False):
+        """
+        Connects to database, minconn connections of the pool are kept
+        open between queries, so it's better to set it to the number of
+        threads which use the database
+        """
+        # Connecting again switches to another database, the previous connections are closed
+        if self.pool is not None or self.__conn is not None:
+            self.close()
+        # DSN is used to replace broken connections
+        self.conn = conn
+        self.prepare = prepare
+        self.prepared = weakref.WeakKeyDictionary()
+        self.statements = dict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        if maxconn:
+            self.pool = psycopg2.pool.ThreadedConnectionPool(minconn or 1, maxconn, conn)
+            # Pool raises an error when it's exhausted, threads wait for a free connection instead
+            self.slots = threading.BoundedSemaphore(maxconn)
+            self.__conn = None
+        else:
+            self.pool = None
+            self.__conn = self.new_connection()
+
+    def new_connection(self):
+        conn = psycopg2.connect(self.conn)
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        return conn
+
+    def get_pooled(self):
+        conn = self.pool.getconn()
+        if not conn.autocommit:
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        return conn
+
+    def checkout(self):
+        self.slots.acquire()
+        try:
+            return self.get_pooled()
+        except Exception:
+            self.slots.release()
+            raise
+
+    def checkin(self, conn):
+        try:
+            if conn is not None:
+                self.pool.putconn(conn, close=bool(conn.closed))
+        finally:
+            self.slots.release()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Holds one connection for all queries in the block, e.g. for a
+        transaction or temporary tables
+        """
+        if self.is_held():
+            # Nested block, a broken connection is not replaced, the outer block fails
+            self.local.holders += 1
+        else:
+            if self.pool is None:
+                if self.__conn.closed:
+                    self.__conn = self.new_connection()
+                self.local.conn = self.__conn
+            else:
+                self.local.conn = self.checkout()
+            self.local.holders = 1
+        try:
+            yield self.local.conn
+        finally:
+            # Blocks of generators may end in any order, the last one releases the connection
+            self.local.holders -= 1
+            if not self.local.holders:
+                conn, self.local.conn = self.local.conn, None
+                if self.pool is not None:
+                    self.checkin(conn)
+
+    def is_held(self):
+        """
+        Returns True in connection() block of the current thread
+        """
+        return getattr(self.local, 'conn', None) is not None
 
     def close(self):
-        self.__conn.close()
+        if self.pool is not None:
+            self.pool.closeall()
+            self.pool = None
+        elif self.__conn is not None:
+            self.__conn.close()
+        self.__conn = None
 
     def reconnect(self):
         logger.error('Connection error, trying to reconnect')
-        self.connect(self.conn)
+        if self.pool is None:
+            self.__conn.close()
+            self.__conn = self.new_connection()
 
-    def execute_cursor(self, cursor, query, params=None, fetch=True, dict=False):
+    def get_prepared(self, conn, cursor, name, query, params):
+        """
+        Returns EXECUTE statement of query with named parameters, prepares
+        it on conn if it's not prepared yet
+        """
+        if name not in self.statements:
+            names = []
+
+            def replace(match):
+                if match.group(1) is None:
+                    return '%'
+                if match.group(1) not in names:
+                    names.append(match.group(1))
+                return '$%s' % (names.index(match.group(1)) + 1)
+
+            statement = PARAMETER_RE.sub(replace, query)
+            execute = 'execute %s' % name
+            if names:
+                execute += ' (%s)' % ', '.join('%%(%s)s' % n for n in names)
+            self.statements[name] = (statement, execute)
+        statement, execute = self.statements[name]
+
+        with self.lock:
+            prepared = self.prepared.setdefault(conn, set())
+        if name not in prepared:
+            cursor.execute('prepare %s as %s' % (name, statement))
+            prepared.add(name)
+        return execute, params
+
+    def timer(self):
+        # Latency of database calls by caller, when metrics are enabled
+        if metrics.registry is None:
+            return metrics.NULL_TIMER
+        return metrics.timer('db_call_seconds', method=get_caller())
+
+    def run(self, query, params=None, fetch='all', dict=False, name=None):
+        """
+        Executes query and returns all rows (fetch='all'), the first row
+        (fetch='one') or nothing, retries it on connection errors
+        """
+        held = self.is_held()
+        attempt = 0
         while True:
             try:
-                if params is not None:
-                    cursor.execute(query, params)
-                else:
-                    cursor.execute(query)
-
-                if fetch is True:
-                    fetch_result = cursor.fetchall()
-                else:
-                    fetch_result = None
+                with self.connection() as conn:
+                    try:
+                        if dict:
+                            cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+                        else:
+                            cursor = conn.cursor()
+                        if name is not None and self.prepare:
+                            query_, params_ = self.get_prepared(conn, cursor, name, query, params)
+                        else:
+                            query_, params_ = query, params
+                        with self.timer():
+                            if params_ is not None:
+                                cursor.execute(query_, params_)
+                            else:
+                                cursor.execute(query_)
+                            if fetch == 'all':
+                                result = cursor.fetchall()
+                            elif fetch == 'one':
+                                result = cursor.fetchone()
+                            else:
+                                result = None
+                        cursor.close()
+                        return result
+                    except psycopg2.OperationalError:
+                        # Connection is replaced on the next checkout
+                        logger.error('Connection error, trying to reconnect')
+                        conn.close()
+                        raise
             except psycopg2.OperationalError:
-                time.sleep(5)
-                self.reconnect()
-                if dict:
-                    cursor = self.__conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-                else:
-                    cursor = self.__conn.cursor()
-                continue
-            else:
-                break
-        return fetch_result
-
-    def query(self, query):
-        cursor = self.__conn.cursor()
-        data = self.execute_cursor(cursor, query, fetch=True)
-        cursor.close()
-        return data
-
-    def query_dict(self, query, params=None):
-        cursor = self.__conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        data = self.execute_cursor(cursor, query, params, fetch=True, dict=True)
-        cursor.close()
-        return [row for row in data]
-
-    def query_row(self, query, params=None):
-        cursor = self.__conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        data = self.execute_cursor(cursor, query, params, fetch=False, dict=True)
-        row = cursor.fetchone()
-        cursor.close()
-        return row
-
-    def query_value(self, query, params=None):
-        result = self.query_dict(query, params)
-        if result:
-            return result[0][0]
+                if held:
+                    raise
+                if attempt:
+                    time.sleep(min(self.retry_delay, 0.5 * 2 ** attempt))
+                attempt += 1
+
+    def execute_cursor(self, cursor, query, params=None, fetch=True, dict=False):
+        """
+        Deprecated, use run(). Executes query with a cursor of its own,
+        cursor is not used as it may belong to a broken connection.
+        """
+        warnings.warn('execute_cursor() is deprecated, use run()', DeprecationWarning, stacklevel=2)
+        return self.run(query, params, fetch='all' if fetch is True else None, dict=dict)
+
+    def query(self, query, name=None):
+        return self.run(query, fetch='all', name=name)
+
+    def query_dict(self, query, params=None, name=None):
+        return self.run(query, params, fetch='all', dict=True, name=name)
+
+    def query_row(self, query, params=None, name=None, dict=True):
+        """
+        Returns the first row, as DictRow or as tuple if dict is False
+        """
+        return self.run(query, params, fetch='one', dict=dict, name=name)
+
+    def query_value(self, query, params=None, name=None):
+        row = self.run(query, params, fetch='one', name=name)
+        if row:
+            return row[0]
         else:
             return None
 
-    def execute(self, query, params):
-        cursor = self.__conn.cursor()
-        self.execute_cursor(cursor, query, params, fetch=False)
-        cursor.close()
-        return
+    def iter_query(self, query, params=None, fetch_size=2000, dict=False):
+        """
+        Generates rows of query result, which are read from server-side
+        cursor fetch_size rows at a time. The connection is held until the
+        generator is exhausted or closed, as in connection() block, and
+        is in a transaction, so queries made meanwhile in the same thread
+        run in it. Iterations may be nested or interleaved, they share the
+        transaction, which the last one to end commits, or rolls back if
+        it failed. Connection errors are not retried.
+        """
+        with self.connection() as conn:
+            for row in self.iter_cursor(conn, query, params, fetch_size, dict):
+                yield row
+
+    def iter_cursor(self, conn, query, params, fetch_size, dict):
+        # Open iterations of the thread, whether they started the transaction and autocommit
+        # mode to restore; iterations in a transaction of connection() block don't end it
+        iterations = getattr(self.local, 'iterations', None)
+        if iterations is None:
+            started = conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+            iterations = self.local.iterations = [0, started, conn.autocommit]
+            if started:
+                conn.autocommit = False
+        iterations[0] += 1
+        # Cursor names must be unique on the connection
+        cursor_name = 'iter_query_%s' % next(cursor_numbers)
+        cursor = None
+        failed = False
+        try:
+            if dict:
+                cursor = conn.cursor(cursor_name, cursor_factory=psycopg2.extras.DictCursor)
+            else:
+                cursor = conn.cursor(cursor_name)
+            cursor.itersize = fetch_size
+            cursor.execute(query, params)
+            for row in cursor:
+                yield row
+        except psycopg2.OperationalError:
+            logger.error('Connection error while reading query result')
+            failed = True
+            conn.close()
+            raise
+        except Exception:
+            failed = True
+            raise
+        finally:
+            iterations[0] -= 1
+            if not conn.closed and cursor is not None:
+                cursor.close()
+            if not iterations[0]:
+                self.local.iterations = None
+                _, started, autocommit = iterations
+                if started and not conn.closed:
+                    if failed:
+                        conn.rollback()
+                    else:
+                        conn.commit()
+                    conn.autocommit = autocommit
+
+    def iter_dict(self, query, params=None, fetch_size=2000):
+        return self.iter_query(query, params, fetch_size, dict=True)
+
+    def execute(self, query, params, name=None):
+        self.run(query, params, fetch=None, name=name)
+
+    def execute_values(self, query, rows, template=None, page_size=100):
+        """
+        Executes query with VALUES %s for all rows, page_size rows in one
+        statement, see psycopg2.extras.execute_values()
+        """
+        held = self.is_held()
+        if not isinstance(rows, (list, tuple)):
+            rows = list(rows)
+        # Several pages are written in one transaction, so a retry after connection error
+        # doesn't repeat pages which have been written already
+        transaction = not held and len(rows) > page_size
+        attempt = 0
+        while True:
+            try:
+                with self.connection() as conn:
+                    cursor = conn.cursor()
+                    try:
+                        with self.timer():
+                            if transaction:
+                                cursor.execute('begin')
+                            psycopg2.extras.execute_values(cursor, query, rows, template, page_size)
+                            if transaction:
+                                cursor.execute('commit')
+                    except psycopg2.OperationalError:
+                        logger.error('Connection error, trying to reconnect')
+                        conn.close()
+                        raise
+                    except Exception:
+                        if transaction:
+                            cursor.execute('rollback')
+                        raise
+                    finally:
+                        cursor.close()
+                    return
+            except psycopg2.OperationalError:
+                if held:
+                    raise
+                if attempt:
+                    time.sleep(min(self.retry_delay, 0.5 * 2 ** attempt))
+                attempt += 1
+
+    def copy_expert(self, query, file, size=8192):
+        """
+        Executes COPY ... FROM STDIN query reading data from file, see
+        cursor.copy_expert(). It's not retried as file is consumed.
+        """
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            with self.timer():
+                cursor.copy_expert(query, file, size)
+            cursor.close()
 
 db = Database()
 
 class DatabaseHandler(logging.Handler):
+    """
+    Writes log records into core.log from a background thread, up to
+    batch_size records in one statement, at least every flush_interval
+    seconds. At most capacity records wait to be written, when there are
+    more of them new records are dropped (overflow='drop') or the logging
+    thread waits (overflow='block'). Records are written on flush() and
+    on close(), which is also called by logging.shutdown(). A Database
+    connected without a pool is used by the threads which log, so the
+    writing thread opens its own connection with the same DSN.
+    """
 
     sql = '''
-    insert into core.log (message, module, level, traceback)
-    values (%(message)s, %(module)s, %(level)s, %(traceback)s)
+    insert into core.log (message, module, level, traceback) values %s
     '''
 
-    def __init__(self):
+    def __init__(self, database=None, batch_size=500, flush_interval=1, capacity=10000, overflow='drop',
+                 flush_timeout=10):
         logging.Handler.__init__(self)
+        if overflow not in ('drop', 'block'):
+            raise ValueError('Unknown overflow policy: %s' % overflow)
+        self.database = database or db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.flush_timeout = flush_timeout
+        self.records = queue.Queue(capacity)
+        self.thread = None
+        self.pid = None
+        self.dropped = 0
+        self.failed = 0
+
+    def start(self):
+        # Thread doesn't survive fork, so it's started in every process
+        with self.lock:
+            if self.pid != os.getpid():
+                self.records = queue.Queue(self.records.maxsize)
+                self.thread = threading.Thread(target=self.write_records, name='DatabaseHandler', daemon=True)
+                self.thread.start()
+                self.pid = os.getpid()
+
+    def handle(self, record):
+        # Queue is thread-safe, so emit() is not serialized with the handler lock, which
+        # would block the writing thread while emit() waits for a free place in the queue
+        rv = self.filter(record)
+        if rv:
+            self.emit(record)
+        return rv
 
     def emit(self, record):
+        # Records about writing records are not queued
+        if threading.current_thread() is self.thread:
+            return
         self.format(record)
         if record.exc_info:
             traceback = logging._defaultFormatter.formatException(record.exc_info)
         else:
             traceback = ''
+        row = (record.message, record.module, record.levelname.lower(), traceback)
+
+        if self.pid != os.getpid():
+            self.start()
+        try:
+            self.records.put(row, block=self.overflow == 'block')
+        except queue.Full:
+            self.dropped += 1
+
+    def get_writer_database(self):
+        if isinstance(self.database, Database) and self.database.pool is None:
+            database = Database()
+            database.connect(self.database.conn)
+            return database
+        return self.database
 
-        db.execute(self.sql, {'message': record.message, 'module': record.module,
-            'level': record.levelname.lower(), 'traceback': traceback})
+    def write_records(self):
+        records = self.records
+        database = None
+        while True:
+            rows = [records.get()]
+            deadline = time.time() + self.flush_interval
+            while len(rows) < self.batch_size and rows[-1] is not None:
+                try:
+                    rows.append(records.get(timeout=max(deadline - time.time(), 0)))
+                except queue.Empty:
+                    break
+            stop = rows[-1] is None
+            if stop:
+                rows.pop()
+            if rows:
+                try:
+                    # Connected on the first write, as the database may be connected after the handler is added
+                    if database is None:
+                        database = self.get_writer_database()
+                    database.execute_values(self.sql, rows, page_size=self.batch_size)
+                except Exception:
+                    self.failed += len(rows)
+            for _ in range(len(rows) + stop):
+                records.task_done()
+            if stop:
+                if database is not None and database is not self.database:
+                    database.close()
+                return
+
+    def flush(self):
+        """
+        Waits until queued records are written, at most flush_timeout seconds
+        """
+        if self.thread is None or self.pid != os.getpid():
+            return
+        deadline = time.time() + self.flush_timeout
+        while self.records.unfinished_tasks and self.thread.is_alive() and time.time() < deadline:
+            time.sleep(0.01)
+
+    def close(self):
+        if self.thread is not None and self.pid == os.getpid() and self.thread.is_alive():
+            try:
+                self.records.put(None, timeout=self.flush_timeout)
+            except queue.Full:
+                pass
+            self.thread.join(self.flush_timeout)
+        logging.Handler.close(self)
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+import os
+import math
+import time
+import struct
+import hashlib
+import logging
+import sqlite3
+import threading
+
+__all__ = ['Frontier', 'BloomFilter']
+
+logger = logging.getLogger(__name__)
+
+# States of URL in the frontier
+PENDING = 0
+ACTIVE = 1
+DONE = 2
+FAILED = 3
+
+BLOOM_HEADER = struct.Struct('<QIQ')
+
+def get_digest(url):
+    return hashlib.md5(url.encode('utf-8')).digest()
+
+class BloomFilter(object):
+    """
+    Bloom filter of URL digests. It answers most of the questions about
+    URLs which have not been seen without touching the disk.
+    """
+
+    def __init__(self, capacity, error_rate=0.01, size=None, hashes=None):
+        self.size = size or max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = hashes or max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def get_positions(self, digest):
+        h1, h2 = struct.unpack('<QQ', digest)
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, digest):
+        for position in self.get_positions(digest):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, digest):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.get_positions(digest))
+
+    def save(self, filename, count):
+        """
+        Saves filter along with number of URLs it contains
+        """
+        tmp = '%s.tmp' % filename
+        with open(tmp, 'wb') as f:
+            f.write(BLOOM_HEADER.pack(self.size, self.hashes, count))
+            f.write(self.bits)
+        os.replace(tmp, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Returns tuple (filter, count) or (None, None) if file is missing
+        or broken
+        """
+        try:
+            with open(filename, 'rb') as f:
+                size, hashes, count = BLOOM_HEADER.unpack(f.read(BLOOM_HEADER.size))
+                bloom = cls(None, size=size, hashes=hashes)
+                if f.readinto(bloom.bits) != len(bloom.bits):
+                    return None, None
+                return bloom, count
+        except (IOError, OSError, struct.error):
+            return None, None
+
+class Frontier(object):
+    """
+    Disk-backed queue of URLs to crawl. Every URL is queued only once,
+    URLs with lower priority are popped first (e.g. priority can be the
+    depth of the page) and URLs with equal priority in order they were
+    added. Changes are committed to disk every checkpoint_interval
+    seconds, so interrupted crawl is resumed from the last checkpoint and
+    URLs which were being processed are returned to the queue.
+    """
+
+    def __init__(self, path, capacity=10000000, error_rate=0.01, checkpoint_interval=30):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.path = path
+        self.checkpoint_interval = checkpoint_interval
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(os.path.join(path, 'frontier.db'), check_same_thread=False)
+        self.db.execute('pragma journal_mode = wal')
+        self.db.execute('pragma synchronous = normal')
+        self.db.execute('create table if not exists url (digest blob primary key, url text not null, '
+                        'priority integer not null, state integer not null)')
+        self.db.execute('create index if not exists url_queue on url (state, priority)')
+        self.db.execute('update url set state = ? where state = ?', (PENDING, ACTIVE))
+        self.db.commit()
+        self.count = self.db.execute('select count(*) from url').fetchone()[0]
+        self.bloom = self.load_bloom(capacity, error_rate)
+        self.checkpoint_at = time.time()
+
+    def get_bloom_filename(self):
+        return os.path.join(self.path, 'bloom')
+
+    def load_bloom(self, capacity, error_rate):
+        bloom, count = BloomFilter.load(self.get_bloom_filename())
+        if bloom is not None and count == self.count:
+            return bloom
+        logger.info('Rebuilding Bloom filter of %s URLs' % self.count)
+        bloom = BloomFilter(max(capacity, self.count), error_rate)
+        for digest, in self.db.execute('select digest from url'):
+            bloom.add(digest)
+        return bloom
+
+    def is_seen(self, url):
+        digest = get_digest(url)
+        with self.lock:
+            if digest not in self.bloom:
+                return False
+            return self.db.execute('select 1 from url where digest = ?', (digest,)).fetchone() is not None
+
+    __contains__ = is_seen
+
+    def add(self, url, priority=0):
+        """
+        Adds url to the queue, returns False if it has been seen already
+        """
+        return self.add_many([url], priority) == 1
+
+    def add_many(self, urls, priority=0):
+        """
+        Adds urls to the queue, returns number of new ones
+        """
+        added = 0
+        with self.lock:
+            for url in urls:
+                digest = get_digest(url)
+                if digest in self.bloom and \
+                   self.db.execute('select 1 from url where digest = ?', (digest,)).fetchone() is not None:
+                    continue
+                self.db.execute('insert into url (digest, url, priority, state) values (?, ?, ?, ?)',
+                                (digest, url, priority, PENDING))
+                self.bloom.add(digest)
+                self.count += 1
+                added += 1
+            self.checkpoint_if_needed()
+        return added
+
+    def pop(self):
+        """
+        Returns the next URL to crawl or None if the queue is empty
+        """
+        urls = self.pop_many(1)
+        return urls[0] if urls else None
+
+    def pop_many(self, count):
+        """
+        Returns up to count URLs to crawl, they have to be marked with
+        done() or failed() when processed
+        """
+        with self.lock:
+            rows = self.db.execute('select digest, url from url where state = ? order by priority, rowid limit ?',
+                                   (PENDING, count)).fetchall()
+            self.db.executemany('update url set state = ? where digest = ?',
+                                [(ACTIVE, digest) for digest, _ in rows])
+            return [url for _, url in rows]
+
+    def set_state(self, url, state):
+        with self.lock:
+            self.db.execute('update url set state = ? where digest = ?', (state, get_digest(url)))
+            self.checkpoint_if_needed()
+
+    def done(self, url, result=None):
+        self.set_state(url, DONE)
+
+    def failed(self, url, error=None):
+        self.set_state(url, FAILED)
+
+    def __len__(self):
+        """
+        Returns number of URLs waiting in the queue
+        """
+        with self.lock:
+            return self.db.execute('select count(*) from url where state = ?', (PENDING,)).fetchone()[0]
+
+    def get_stats(self):
+        names = {PENDING: 'pending', ACTIVE: 'active', DONE: 'done', FAILED: 'failed'}
+        with self.lock:
+            stats = dict((name, 0) for name in names.values())
+            for state, count in self.db.execute('select state, count(*) from url group by state'):
+                stats[names[state]] = count
+            return stats
+
+    def checkpoint_if_needed(self):
+        if time.time() - self.checkpoint_at >= self.checkpoint_interval:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """
+        Commits changes to disk and saves Bloom filter
+        """
+        with self.lock:
+            self.db.commit()
+            self.bloom.save(self.get_bloom_filename(), self.count)
+            self.checkpoint_at = time.time()
+
+    def close(self):
+        with self.lock:
+            self.checkpoint()
+            self.db.close()
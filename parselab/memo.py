@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import pickle
+import hashlib
+import logging
+import sqlite3
+import threading
+
+__all__ = ['ParseMemo', 'get_content_digest', 'get_callback_name']
+
+logger = logging.getLogger(__name__)
+
+def get_content_digest(page):
+    """
+    Returns md5 digest of page, which is either text or bytes
+    """
+    if not isinstance(page, bytes):
+        page = page.encode('utf-8')
+    return hashlib.md5(page).digest()
+
+def get_callback_name(callback):
+    """
+    Returns name of callback with its module and class, so callbacks of
+    different parsers don't share results
+    """
+    return '%s.%s' % (callback.__module__, getattr(callback, '__qualname__', callback.__name__))
+
+class ParseMemo(object):
+    """
+    Results of parsing callbacks keyed by callback name, parser version
+    and digest of page content. Least recently used results are evicted
+    when there are more than max_entries of them. Changes are committed
+    every commit_interval seconds and on close(). Every process opens
+    its own connection, so the memo can be read from replay workers.
+    """
+
+    def __init__(self, filename, max_entries=1000000, commit_interval=10):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.commit_interval = commit_interval
+        self.lock = threading.RLock()
+        self.db = None
+        self.pid = None
+        db = self.get_db()
+        db.execute('create table if not exists memo (name text not null, version text not null, '
+                   'digest blob not null, result blob not null, used_at real not null, '
+                   'primary key (name, version, digest))')
+        db.execute('create index if not exists memo_used_at on memo (used_at)')
+        db.commit()
+        self.count = db.execute('select count(*) from memo').fetchone()[0]
+        self.committed_at = time.time()
+        self.hits = 0
+        self.misses = 0
+
+    def __getstate__(self):
+        # Memo is passed to replay processes which are not forked without its connection and lock
+        state = self.__dict__.copy()
+        del state['lock'], state['db']
+        state['pid'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+        self.db = None
+
+    def get_db(self):
+        # Connection can't be used by forked process, it opens a new one
+        if self.pid != os.getpid():
+            self.db = sqlite3.connect(self.filename, timeout=60, check_same_thread=False)
+            self.db.execute('pragma journal_mode = wal')
+            self.db.execute('pragma synchronous = normal')
+            self.pid = os.getpid()
+        return self.db
+
+    def get(self, name, version, digest):
+        """
+        Returns tuple (found, result)
+        """
+        with self.lock:
+            row = self.get_db().execute('select result from memo where name = ? and version = ? and digest = ?',
+                                        (name, str(version), digest)).fetchone()
+        if row is None:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        return True, pickle.loads(row[0])
+
+    def has(self, name, version, digest):
+        with self.lock:
+            return self.get_db().execute('select 1 from memo where name = ? and version = ? and digest = ?',
+                                         (name, str(version), digest)).fetchone() is not None
+
+    def touch(self, name, version, digests):
+        """
+        Marks results as recently used
+        """
+        with self.lock:
+            now = time.time()
+            self.get_db().executemany('update memo set used_at = ? where name = ? and version = ? and digest = ?',
+                                      [(now, name, str(version), digest) for digest in digests])
+            self.commit_if_needed()
+
+    def put(self, name, version, digest, result):
+        with self.lock:
+            db = self.get_db()
+            row = (pickle.dumps(result, pickle.HIGHEST_PROTOCOL), time.time(), name, str(version), digest)
+            # Only new entries are counted, replaced ones don't bring eviction closer
+            if not db.execute('update memo set result = ?, used_at = ? where name = ? and version = ? '
+                              'and digest = ?', row).rowcount:
+                # Another process may have added the same entry meanwhile
+                self.count += db.execute('insert or ignore into memo (result, used_at, name, version, digest) '
+                                         'values (?, ?, ?, ?, ?)', row).rowcount
+            if self.count > self.max_entries:
+                self.evict()
+            self.commit_if_needed()
+
+    def call(self, callback, version, url, page):
+        """
+        Returns tuple (result, found), where result of callback(url, page)
+        is taken from memo if the page has not changed
+        """
+        name, digest = get_callback_name(callback), get_content_digest(page)
+        found, result = self.get(name, version, digest)
+        if found:
+            self.touch(name, version, [digest])
+        else:
+            result = callback(url, page)
+            self.put(name, version, digest, result)
+        return result, found
+
+    def evict(self):
+        # Evict a tenth of entries at once, so eviction doesn't happen on every put
+        count = self.count - self.max_entries + self.max_entries // 10
+        self.get_db().execute('delete from memo where rowid in '
+                              '(select rowid from memo order by used_at limit ?)', (count,))
+        self.count = self.get_db().execute('select count(*) from memo').fetchone()[0]
+        logger.info('Evicted %s parse results' % count)
+
+    def invalidate(self, name=None, version=None):
+        """
+        Removes results of callback name and version, None matches any
+        """
+        version = None if version is None else str(version)
+        return self.delete('(name = ? or ? is null) and (version = ? or ? is null)',
+                           (name, name, version, version))
+
+    def invalidate_except(self, version, name=None):
+        """
+        Removes results of all versions but the given one
+        """
+        return self.delete('(name = ? or ? is null) and version != ?', (name, name, str(version)))
+
+    def delete(self, condition, args):
+        with self.lock:
+            count = self.get_db().execute('delete from memo where %s' % condition, args).rowcount
+            self.count -= count
+            self.commit()
+        logger.info('%s parse results were invalidated' % count)
+        return count
+
+    def get_stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': self.count}
+
+    def commit_if_needed(self):
+        if time.time() - self.committed_at >= self.commit_interval:
+            self.commit()
+
+    def commit(self):
+        with self.lock:
+            self.get_db().commit()
+            self.committed_at = time.time()
+
+    def close(self):
+        with self.lock:
+            self.commit()
+            self.db.close()
+            self.db = None
+            self.pid = None
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Counters and latency histograms of parsing phases. Metrics are collected
+only after enable(), until then inc(), observe() and timer() return at
+once, so instrumented code costs nearly nothing.
+"""
+
+import os
+import time
+import bisect
+import logging
+import threading
+
+__all__ = ['Metrics', 'Reporter', 'LogSink', 'PrometheusFileSink',
+           'enable', 'disable', 'get_metrics', 'inc', 'observe', 'timer', 'get_host']
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of histogram buckets, seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+registry = None
+
+def get_host(url):
+    """
+    Returns host of URL, cheaper than urlparse()
+    """
+    start = url.find('//') + 2
+    end = url.find('/', start)
+    return url[start:] if end == -1 else url[start:end]
+
+class Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def get_quantile(self, q):
+        """
+        Returns upper bound of the bucket which holds quantile q
+        """
+        rank, seen = q * self.count, 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+class Timer(object):
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.metrics.observe(self.name, time.time() - self.started, **self.labels)
+
+class NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+NULL_TIMER = NullTimer()
+
+class Metrics(object):
+    """
+    Thread-safe registry of counters and histograms, both are keyed by
+    name and labels, e.g. inc('http_requests', host='example.com')
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = dict()
+        self.histograms = dict()
+        self.started_at = time.time()
+
+    def inc(self, name, value=1, **labels):
+        key = get_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = get_key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def timer(self, name, **labels):
+        return Timer(self, name, labels)
+
+    def get_counter(self, name, **labels):
+        return self.counters.get(get_key(name, labels), 0)
+
+    def snapshot(self):
+        """
+        Returns dictionary of counters and histograms, keys are names
+        with labels as in Prometheus, e.g. 'http_requests{host="a.com"}'
+        """
+        with self.lock:
+            counters = dict((format_key(name, labels), value)
+                            for (name, labels), value in self.counters.items())
+            histograms = dict((format_key(name, labels),
+                               {'count': h.count, 'sum': h.sum,
+                                'p50': h.get_quantile(0.5), 'p99': h.get_quantile(0.99)})
+                              for (name, labels), h in self.histograms.items())
+        return {'elapsed': time.time() - self.started_at, 'counters': counters, 'histograms': histograms}
+
+    def get_prometheus_text(self, prefix='parselab_'):
+        """
+        Returns metrics in Prometheus text exposition format
+        """
+        lines = []
+        with self.lock:
+            for name in sorted(set(name for name, _ in self.counters)):
+                lines.append('# TYPE %s%s counter' % (prefix, name))
+                for (name_, labels), value in sorted(self.counters.items()):
+                    if name_ == name:
+                        lines.append('%s %s' % (format_key(prefix + name, labels), value))
+            for name in sorted(set(name for name, _ in self.histograms)):
+                lines.append('# TYPE %s%s histogram' % (prefix, name))
+                for (name_, labels), h in sorted(self.histograms.items(), key=lambda item: item[0]):
+                    if name_ != name:
+                        continue
+                    total = 0
+                    for bound, count in zip(tuple(self.buckets) + ('+Inf',), h.counts):
+                        total += count
+                        lines.append('%s %s' % (format_key(prefix + name + '_bucket', labels + (('le', bound),)),
+                                                total))
+                    lines.append('%s %s' % (format_key(prefix + name + '_sum', labels), h.sum))
+                    lines.append('%s %s' % (format_key(prefix + name + '_count', labels), h.count))
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.started_at = time.time()
+
+def get_key(name, labels):
+    if not labels:
+        return (name, ())
+    return (name, tuple(sorted((key, str(value)) for key, value in labels.items())))
+
+def format_key(name, labels):
+    if not labels:
+        return name
+    return '%s{%s}' % (name, ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                                      for key, value in labels))
+
+class LogSink(object):
+    """
+    Logs a line of counters and a line of every histogram
+    """
+
+    def __init__(self, log=None, level=logging.INFO):
+        self.log = log or logger
+        self.level = level
+
+    def __call__(self, metrics):
+        snapshot = metrics.snapshot()
+        self.log.log(self.level, 'Metrics for %.0f s: %s' % (snapshot['elapsed'], ', '.join(
+            '%s=%s' % item for item in sorted(snapshot['counters'].items()))))
+        for key, h in sorted(snapshot['histograms'].items()):
+            self.log.log(self.level, '%s: count=%s, sum=%.3f s, p50<=%s s, p99<=%s s' %
+                         (key, h['count'], h['sum'], h['p50'], h['p99']))
+
+class PrometheusFileSink(object):
+    """
+    Writes metrics into text file for node_exporter textfile collector
+    """
+
+    def __init__(self, filename, prefix='parselab_'):
+        self.filename = filename
+        self.prefix = prefix
+
+    def __call__(self, metrics):
+        # Collector must not read partially written file
+        tmp_filename = '%s.%s.tmp' % (self.filename, os.getpid())
+        with open(tmp_filename, 'wt') as f:
+            f.write(metrics.get_prometheus_text(self.prefix))
+        os.replace(tmp_filename, self.filename)
+
+class Reporter(object):
+    """
+    Passes metrics to sinks, callables which take Metrics, every interval
+    seconds from a background thread and once more on stop()
+    """
+
+    def __init__(self, metrics, sinks, interval=60):
+        self.metrics = metrics
+        self.sinks = sinks
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='MetricsReporter', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def report(self):
+        for sink in self.sinks:
+            try:
+                sink(self.metrics)
+            except Exception:
+                logger.exception('Could not report metrics')
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.report()
+
+def enable(metrics=None):
+    """
+    Starts collecting metrics into metrics or a new Metrics, returns it
+    """
+    global registry
+    registry = metrics or Metrics()
+    return registry
+
+def disable():
+    global registry
+    registry = None
+
+def get_metrics():
+    return registry
+
+def inc(name, value=1, **labels):
+    if registry is not None:
+        registry.inc(name, value, **labels)
+
+def observe(name, value, **labels):
+    if registry is not None:
+        registry.observe(name, value, **labels)
+
+def timer(name, **labels):
+    if registry is None:
+        return NULL_TIMER
+    return registry.timer(name, **labels)
@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
 
+import re
+import codecs
 import requests
 import logging
 import pickle
-import random
 import time
 
-from requests.exceptions import ConnectionError
+from requests.exceptions import ConnectionError, Timeout
+
+from parselab import metrics
+from parselab.proxy import get_proxy_pool
 
 headers = {
     'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
@@ -19,55 +23,258 @@ headers = {
 
 logger = logging.getLogger(__name__)
 
+# Only the beginning of the page is searched for declared encoding
+SNIFF_SIZE = 4096
+
+BOMS = ((codecs.BOM_UTF32_LE, 'utf-32'), (codecs.BOM_UTF32_BE, 'utf-32'), (codecs.BOM_UTF8, 'utf-8-sig'),
+        (codecs.BOM_UTF16_LE, 'utf-16'), (codecs.BOM_UTF16_BE, 'utf-16'))
+
+XML_ENCODING_RE = re.compile(br'^\s*<\?xml[^>]+encoding\s*=\s*["\']([\w.:-]+)', re.I)
+META_CHARSET_RE = re.compile(br'<meta[^>]+charset\s*=\s*["\']?\s*([\w.:-]+)', re.I)
+
+# Pages without declared encoding are checked to be valid utf-8 in this many bytes
+# from the first non-ASCII one, the page is decoded only once, when it's read
+NON_ASCII_RE = re.compile(b'[\x80-\xff]')
+UTF8_PROBE_SIZE = 1 << 16
+
 class PageNotFound(Exception):
     pass
 
 class InternalServerError(Exception):
     pass
 
+class NotModified(Exception):
+    """
+    Thrown when server responds that the page was not modified
+    since it was cached
+    """
+    pass
+
+def get_validators(response):
+    """
+    Returns metadata of response which is needed to revalidate it later
+    """
+    validators = dict()
+    if response.headers.get('ETag'):
+        validators['etag'] = response.headers['ETag']
+    if response.headers.get('Last-Modified'):
+        validators['last_modified'] = response.headers['Last-Modified']
+    return validators
+
+def get_request_headers(validators=None):
+    """
+    Returns request headers, validators of the cached page (etag and
+    last_modified) make the request conditional
+    """
+    if not validators:
+        return headers
+    request_headers = dict(headers)
+    if validators.get('etag'):
+        request_headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        request_headers['If-Modified-Since'] = validators['last_modified']
+    return request_headers
+
+def get_content_type(headers):
+    """
+    Returns tuple (content type, charset) from Content-Type header
+    """
+    value = headers.get('Content-Type') or ''
+    params = value.split(';')
+    charset = None
+    for param in params[1:]:
+        name, _, param_value = param.partition('=')
+        if name.strip().lower() == 'charset':
+            charset = param_value.strip().strip('"\'') or None
+    return params[0].strip().lower() or None, charset
+
+def normalize_encoding(name):
+    """
+    Returns canonical name of encoding or None if it is unknown
+    """
+    try:
+        return codecs.lookup(name).name
+    except LookupError:
+        return None
+
+def sniff_encoding(content):
+    """
+    Returns encoding of page from byte order mark, XML declaration or
+    meta tag, utf-8 if the page looks like valid utf-8, or None
+    """
+    for bom, encoding in BOMS:
+        if content.startswith(bom):
+            return encoding
+    head = content[:SNIFF_SIZE]
+    match = XML_ENCODING_RE.search(head) or META_CHARSET_RE.search(head)
+    if match:
+        encoding = normalize_encoding(match.group(1).decode('ascii'))
+        if encoding is not None:
+            return encoding
+    match = NON_ASCII_RE.search(content)
+    if match is None:
+        return 'utf-8'
+    try:
+        # Sequence cut at the end of the probe is not an error
+        codecs.getincrementaldecoder('utf-8')().decode(content[match.start():match.start() + UTF8_PROBE_SIZE])
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return None
+
+def get_encoding(response):
+    """
+    Returns encoding declared in Content-Type header or sniffed from the
+    content. Charset detector of requests, which is slow on large pages,
+    is used only if both fail.
+    """
+    _, charset = get_content_type(response.headers)
+    encoding = normalize_encoding(charset) if charset else None
+    if encoding is None:
+        encoding = sniff_encoding(response.content)
+    if encoding is None:
+        encoding = getattr(response, 'apparent_encoding', None) or 'utf-8'
+    return encoding
+
+def get_content_meta(response, binary=False, encoding=None):
+    """
+    Returns content type and encoding of response which are saved with
+    the raw page, so it can be decoded when it is read from cache.
+    Encoding is detected if it's not given.
+    """
+    meta = dict()
+    content_type, _ = get_content_type(response.headers)
+    if content_type:
+        meta['content_type'] = content_type
+    if not binary:
+        meta['encoding'] = encoding or get_encoding(response)
+    return meta
+
+def get_text(response, encoding=None):
+    """
+    Returns decoded content of response, encoding is detected if it's
+    not given
+    """
+    return response.content.decode(encoding or get_encoding(response), 'replace')
+
+class Response(object):
+    """
+    Downloaded page with the attributes of requests.Response which
+    are used by parselab
+    """
+
+    def __init__(self, url, status_code, headers, content, encoding=None):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.encoding = encoding
+
+    @property
+    def text(self):
+        if self.encoding is None:
+            return get_text(self)
+        return self.content.decode(self.encoding, 'replace')
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+def check_response(response, validators=None):
+    """
+    Returns response if page was downloaded, raises exception for HTTP
+    statuses which have special meaning, returns None for other errors
+    """
+    logger.info('Page fetched with HTTP status code = %s' % response.status_code)
+
+    if response.status_code == 200:
+        return response
+    elif response.status_code == 304 and validators:
+        raise NotModified('Page not modified')
+    elif response.status_code == 404:
+        raise PageNotFound('Page not found')
+    elif response.status_code == 500:
+        raise InternalServerError
+    else:
+        return None
+
+def record_request(url, response, latency):
+    """
+    Records latency, status and size of response into metrics
+    """
+    host = metrics.get_host(url)
+    metrics.observe('http_request_seconds', latency, host=host)
+    metrics.inc('http_requests', host=host, status=response.status_code)
+    metrics.inc('http_bytes_read', len(response.content), host=host)
+
 class NetworkManager(object):
 
     pageDownloadTriesCount = 3
 
-    def __init__(self, proxies={}):
+    def __init__(self, proxies={}, rate_limiter=None, timeout=60):
         self.session = requests.session()
         self.proxies = proxies
+        self.proxy_pool = get_proxy_pool(proxies)
+        self.rate_limiter = rate_limiter
+        # Seconds to wait for connection and for data, so a dead proxy doesn't hang the parser
+        self.timeout = timeout
         logging.info('NetworkManager initialized with proxy setting: %s' % self.proxies)
 
     def load_cookies(self, filename):
         with open(filename, 'rb') as f:
             return pickle.load(f)
 
-    def download_page(self, url, cookies=None, binary=False):
+    def fetch(self, url, cookies=None, binary=False, validators=None):
+        """
+        Returns response object if page was downloaded, raises NotModified
+        if validators are given and page has not been changed
+        """
         tries = 0
 
-        while tries < self.pageDownloadTriesCount:
-            if self.proxies != {}:
-                proxies = dict(https=random.choice(self.proxies))
+        while True:
+            if self.proxy_pool is not None:
+                proxy = self.proxy_pool.choose()
+                session, proxies = proxy.get_session(), proxy.get_proxies()
                 logging.info('Using proxies: %s' % proxies)
             else:
-                proxies = None
+                proxy, session, proxies = None, self.session, None
+
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire(url)
 
             try:
-                response = self.session.get(url, headers=headers, proxies=proxies)
+                started = time.time()
+                response = session.get(url, headers=get_request_headers(validators), cookies=cookies,
+                                       proxies=proxies, timeout=self.timeout)
+                latency = time.time() - started
+                if metrics.registry is not None:
+                    record_request(url, response, latency)
+                if self.rate_limiter is not None:
+                    self.rate_limiter.feedback(url, response.status_code, latency,
+                                               response.headers.get('Retry-After'))
+                if proxy is not None:
+                    self.proxy_pool.report(proxy, response.status_code, latency)
                 break
-            except ConnectionError:
+            except (ConnectionError, Timeout):
                 tries += 1
-                logger.info('Connection error, sleeping for 10 s')
-                time.sleep(10)
-            logging.error('Could not download page in %s tries' % self.pageDownloadTriesCount)
-            return None
+                if metrics.registry is not None:
+                    metrics.inc('http_connection_errors', host=metrics.get_host(url))
+                if proxy is not None:
+                    self.proxy_pool.report_failure(proxy)
+                if tries >= self.pageDownloadTriesCount:
+                    logger.error('Could not download page in %s tries' % self.pageDownloadTriesCount)
+                    return None
+                if proxy is not None:
+                    # Another proxy is likely to work, so there is no need to wait
+                    logger.info('Connection error using proxy %s' % proxy.url)
+                else:
+                    logger.info('Connection error, sleeping for 10 s')
+                    time.sleep(10)
 
-        logger.info('Page fetched with HTTP status code = %s' % response.status_code)
+        return check_response(response, validators)
 
-        if response.status_code == 200:
-            if binary:
-                return response
-            else:
-                return response.text
-        elif response.status_code == 404:
-            raise PageNotFound('Page not found')
-        elif response.status_code == 500:
-            raise InternalServerError
+    def download_page(self, url, cookies=None, binary=False, validators=None):
+        response = self.fetch(url, cookies=cookies, binary=binary, validators=validators)
+        if response is None or binary:
+            return response
         else:
-            return None
+            return get_text(response)
@@ -0,0 +1,530 @@
+# -*- encoding: utf-8 -*-
+
+import io
+import os
+import re
+import sys
+import mmap
+import time
+import struct
+import hashlib
+import logging
+import argparse
+import threading
+
+from parselab.cache import CacheInterface, CacheResult, HIT, ERROR, MISS
+from parselab.cache import get_codec, pack_entry, read_entry_header, iter_entry, get_entry_buffer, decode_data
+from parselab.cache import ENTRY_MAGIC, ENTRY_HEADER_LENGTH
+from parselab.network import PageNotFound
+
+__all__ = ['PackedCache', 'PackedIndex']
+
+logger = logging.getLogger(__name__)
+
+KIND_DATA = 1
+KIND_ERROR = 2
+KIND_DELETED = 3
+
+# Every record in a segment starts with: magic, md5 digest of URL, kind, payload length, fetch time.
+# Records of PLR1 had no fetch time, they are not read.
+RECORD_MAGIC = b'PLR2'
+RECORD_HEADER = struct.Struct('<4s16sBId')
+
+# Index file: header (magic, capacity, used slots) followed by capacity slots of
+# (md5 digest, segment number, record offset, payload length, kind)
+INDEX_MAGIC = b'PLIDX001'
+INDEX_HEADER = struct.Struct('<8sQQ')
+INDEX_SLOT = struct.Struct('<16sIQIB3x')
+INDEX_MAX_LOAD = 0.7
+INDEX_INITIAL_CAPACITY = 1 << 16
+
+EMPTY_DIGEST = b'\x00' * 16
+
+# Files of FileCache pages and errors, named by md5 hash of URL
+FILE_CACHE_NAME_RE = re.compile(r'^([0-9a-f]{32})(\.error)?$')
+
+DEFAULT_SEGMENT_SIZE = 1 << 30
+CHUNK_SIZE = 1 << 16
+
+
+def get_digest(url):
+    if sys.version_info[0] < 3:
+        return hashlib.md5(url).digest()
+    else:
+        return hashlib.md5(url.encode('utf-8')).digest()
+
+
+class PackedIndex(object):
+    """
+    On-disk open addressing hash table which maps md5 digest of URL
+    to the location of the record in segment files. The file is memory
+    mapped, so lookups do not need any system calls at all.
+    """
+
+    def __init__(self, filename, capacity=INDEX_INITIAL_CAPACITY):
+        self.filename = filename
+        self.lock = threading.RLock()
+        if not os.path.exists(filename):
+            self.create(filename, capacity)
+        self.open()
+
+    @staticmethod
+    def create(filename, capacity):
+        with open(filename, 'wb') as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, capacity, 0))
+            f.truncate(INDEX_HEADER.size + capacity * INDEX_SLOT.size)
+
+    def open(self):
+        self.file = open(self.filename, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        magic, self.capacity, self.count = INDEX_HEADER.unpack_from(self.map, 0)
+        if magic != INDEX_MAGIC:
+            raise ValueError('%s is not a packed cache index' % self.filename)
+        self.mask = self.capacity - 1
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        self.file.close()
+
+    def flush(self):
+        self.map.flush()
+
+    def find_slot(self, digest):
+        """
+        Returns offset of the slot which holds digest or of the empty slot
+        where it should be placed
+        """
+        i = int.from_bytes(digest[:8], 'little') & self.mask
+        while True:
+            offset = INDEX_HEADER.size + i * INDEX_SLOT.size
+            slot_digest = self.map[offset:offset + 16]
+            if slot_digest == digest or slot_digest == EMPTY_DIGEST:
+                return offset, slot_digest == digest
+            i = (i + 1) & self.mask
+
+    def get(self, digest):
+        """
+        Returns tuple (segment, offset, length, kind) or None
+        """
+        with self.lock:
+            offset, found = self.find_slot(digest)
+            if not found:
+                return None
+            return INDEX_SLOT.unpack_from(self.map, offset)[1:]
+
+    def put(self, digest, segment, offset, length, kind):
+        with self.lock:
+            slot, found = self.find_slot(digest)
+            if not found:
+                if self.count + 1 > self.capacity * INDEX_MAX_LOAD:
+                    self.grow()
+                    slot, found = self.find_slot(digest)
+                self.count += 1
+                INDEX_HEADER.pack_into(self.map, 0, INDEX_MAGIC, self.capacity, self.count)
+            INDEX_SLOT.pack_into(self.map, slot, digest, segment, offset, length, kind)
+
+    def items(self):
+        """
+        Iterates over (digest, (segment, offset, length, kind)) of all used slots
+        """
+        for i in range(self.capacity):
+            slot = INDEX_SLOT.unpack_from(self.map, INDEX_HEADER.size + i * INDEX_SLOT.size)
+            if slot[0] != EMPTY_DIGEST:
+                yield slot[0], slot[1:]
+
+    def grow(self):
+        """
+        Doubles capacity of the index, drops deleted entries
+        """
+        tmp_filename = '%s.tmp' % self.filename
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        new_index = PackedIndex(tmp_filename, self.capacity * 2)
+        for digest, location in self.items():
+            if location[3] != KIND_DELETED:
+                new_index.put(digest, *location)
+        new_index.close()
+        self.close()
+        os.replace(tmp_filename, self.filename)
+        self.open()
+        logger.info('Index %s has grown to %s slots' % (self.filename, self.capacity))
+
+
+class PackedCache(CacheInterface):
+    """
+    Cache which appends pages to large segment files and keeps an on-disk
+    hash index, so a cache of millions of pages takes a handful of files
+    instead of a file per URL. Only one process may write into the cache
+    at a time, but it can be shared between threads.
+    """
+
+    path = None
+
+    def get_cache_path(self):
+        return self.path
+
+    def __init__(self, namespace, path, segment_size=DEFAULT_SEGMENT_SIZE, codec=None):
+        self.codec = get_codec(codec)
+        if path:
+            self.path = os.path.join(path, namespace)
+        else:
+            self.path = os.path.join(os.path.dirname(sys.path[0]), 'cache')
+        self.segment_size = segment_size
+        self.fds = dict()
+        self.lock = threading.RLock()
+
+        logger.info('Packed cache initialization, path = %s' % self.get_cache_path())
+        if not os.path.isdir(self.get_cache_path()):
+            os.makedirs(self.get_cache_path())
+
+        segments = self.get_segments()
+        self.segment = segments[-1] if segments else 0
+        self.offset = self.get_segment_size(self.segment)
+
+        index_lost = segments and not os.path.exists(self.get_index_filename())
+        self.index = PackedIndex(self.get_index_filename())
+        if index_lost:
+            self.rebuild_index()
+
+    def get_index_filename(self):
+        return os.path.join(self.get_cache_path(), 'index')
+
+    def get_segment_filename(self, segment):
+        return os.path.join(self.get_cache_path(), 'segment-%06d.dat' % segment)
+
+    def get_segments(self):
+        """
+        Returns sorted list of segment numbers
+        """
+        return sorted(int(name[8:14]) for name in os.listdir(self.get_cache_path())
+                      if name.startswith('segment-') and name.endswith('.dat'))
+
+    def get_segment_size(self, segment):
+        filename = self.get_segment_filename(segment)
+        return os.path.getsize(filename) if os.path.exists(filename) else 0
+
+    def get_fd(self, segment):
+        with self.lock:
+            if segment not in self.fds:
+                self.fds[segment] = os.open(self.get_segment_filename(segment), os.O_RDWR | os.O_CREAT, 0o644)
+            return self.fds[segment]
+
+    def close(self):
+        self.index.close()
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds = dict()
+
+    def sync(self):
+        """
+        Flushes index and active segment to disk
+        """
+        self.index.flush()
+        if self.segment in self.fds:
+            os.fsync(self.fds[self.segment])
+
+    def get_cached_filename(self, url):
+        return '%s:%s' % (self.get_cache_path(), get_digest(url).hex())
+
+    def read_record(self, digest, location):
+        """
+        Returns tuple (payload, fetch time) or None if the record is corrupted
+        """
+        segment, offset, length, kind = location
+        buf = os.pread(self.get_fd(segment), RECORD_HEADER.size + length, offset)
+        magic, record_digest, record_kind, record_length, fetched_at = RECORD_HEADER.unpack_from(buf, 0)
+        if magic != RECORD_MAGIC or record_digest != digest or record_length != length \
+                or len(buf) != RECORD_HEADER.size + length:
+            logger.error('Corrupted record in segment %s at offset %s' % (segment, offset))
+            return None
+        return buf[RECORD_HEADER.size:], fetched_at
+
+    def append_record(self, digest, kind, chunks, fetched_at=None):
+        """
+        Appends record built from iterable of byte chunks to the active segment
+        and registers it in the index
+        """
+        if fetched_at is None:
+            fetched_at = time.time()
+        with self.lock:
+            if self.offset >= self.segment_size:
+                self.segment += 1
+                self.offset = 0
+                logger.info('New segment %s was started' % self.get_segment_filename(self.segment))
+
+            fd = self.get_fd(self.segment)
+            length = 0
+            os.lseek(fd, self.offset + RECORD_HEADER.size, os.SEEK_SET)
+            for chunk in chunks:
+                os.write(fd, chunk)
+                length += len(chunk)
+            os.pwrite(fd, RECORD_HEADER.pack(RECORD_MAGIC, digest, kind, length, fetched_at), self.offset)
+
+            self.index.put(digest, self.segment, self.offset, length, kind)
+            self.offset += RECORD_HEADER.size + length
+
+    def get_location(self, url):
+        return self.index.get(get_digest(url))
+
+    def is_in_cache(self, url):
+        location = self.get_location(url)
+        return location is not None and location[3] == KIND_DATA and location[2] > 0
+
+    def is_in_cache_error(self, url):
+        location = self.get_location(url)
+        return location is not None and location[3] == KIND_ERROR
+
+    def save_error_in_cache(self, url, error='ERROR'):
+        self.append_record(get_digest(url), KIND_ERROR, [error.encode('utf-8')])
+
+    def get_error_from_cache(self, url):
+        digest = get_digest(url)
+        location = self.index.get(digest)
+        if location is None or location[3] != KIND_ERROR:
+            return None
+        record = self.read_record(digest, location)
+        return record[0].decode('utf-8') if record is not None else None
+
+    def get_file(self, url, binary=False):
+        digest = get_digest(url)
+        location = self.index.get(digest)
+        if location is None or location[3] == KIND_DELETED:
+            return None
+
+        record = self.read_record(digest, location)
+        if location[3] == KIND_ERROR:
+            if record is not None and record[0] == b'PageNotFound':
+                raise PageNotFound()
+            return None
+
+        if record is None:
+            return None
+        return self.decode_record(record[0], binary)[1]
+
+    def decode_record(self, data, binary=False):
+        """
+        Returns tuple (entry header, decoded data)
+        """
+        f = io.BytesIO(data)
+        header = read_entry_header(f)
+        if header is not None:
+            data = b''.join(iter_entry(f, header))
+        return header, data if binary else decode_data(data, header)
+
+    def lookup(self, url, binary=False):
+        digest = get_digest(url)
+        filename = '%s:%s' % (self.get_cache_path(), digest.hex())
+        location = self.index.get(digest)
+        if location is None or location[3] == KIND_DELETED:
+            return CacheResult(MISS, filename=filename)
+
+        record = self.read_record(digest, location)
+        if location[3] == KIND_ERROR:
+            return CacheResult(ERROR, error=record[0].decode('utf-8') if record is not None else None,
+                               filename=filename)
+        if not record or not record[0]:
+            return CacheResult(MISS, filename=filename)
+        header, data = self.decode_record(record[0], binary)
+        return CacheResult(HIT, data=data, filename=filename, meta=header or dict(), fetched_at=record[1])
+
+    def get_buffer(self, url):
+        """
+        Returns memoryview of the page mapped directly from the segment file,
+        only compressed pages are copied
+        """
+        digest = get_digest(url)
+        location = self.index.get(digest)
+        if location is None or location[3] == KIND_DELETED:
+            return None
+        if location[3] == KIND_ERROR:
+            return self.get_file(url, binary=True)
+
+        segment, offset, length, kind = location
+        start = offset + RECORD_HEADER.size
+        if length == 0:
+            return memoryview(b'')
+        aligned = start - start % mmap.ALLOCATIONGRANULARITY
+        buf = mmap.mmap(self.get_fd(segment), start + length - aligned, offset=aligned,
+                        access=mmap.ACCESS_READ)
+        return get_entry_buffer(memoryview(buf)[start - aligned:])
+
+    def touch(self, url):
+        digest = get_digest(url)
+        location = self.index.get(digest)
+        if location is not None and location[3] != KIND_DELETED:
+            segment, offset, length, kind = location
+            os.pwrite(self.get_fd(segment), RECORD_HEADER.pack(RECORD_MAGIC, digest, kind, length, time.time()),
+                      offset)
+
+    def write_to_cache(self, url, data, binary=False, meta=None):
+        if binary:
+            chunks = data.iter_content(chunk_size=CHUNK_SIZE)
+        else:
+            chunks = [data.encode('utf-8')]
+        self.append_record(get_digest(url), KIND_DATA, pack_entry(chunks, self.codec, meta))
+        logger.info('File %s was written' % self.get_cached_filename(url))
+
+    def get_urls(self):
+        """
+        Generates URLs of cached pages which were saved with URL in the
+        entry header, only headers are read
+        """
+        for digest, (segment, offset, length, kind) in self.index.items():
+            if kind != KIND_DATA:
+                continue
+            offset += RECORD_HEADER.size
+            head = os.pread(self.get_fd(segment), min(length, 4096), offset)
+            if head[:len(ENTRY_MAGIC)] != ENTRY_MAGIC:
+                continue
+            header_length = len(ENTRY_MAGIC) + ENTRY_HEADER_LENGTH.size + \
+                ENTRY_HEADER_LENGTH.unpack_from(head, len(ENTRY_MAGIC))[0]
+            if header_length > len(head):
+                head = os.pread(self.get_fd(segment), header_length, offset)
+            header = read_entry_header(io.BytesIO(head))
+            if header.get('url'):
+                yield header['url']
+
+    def get_document(self, url):
+        return self.get_file(url, binary=False)
+
+    def get_binary_file(self, url, force_download=False):
+        return self.get_file(url, binary=True)
+
+    def remove_from_cache(self, url):
+        """
+        Removes file from cache
+        """
+        self.append_record(get_digest(url), KIND_DELETED, [])
+        logger.warning('File %s has been removed from cache' % self.get_cached_filename(url))
+
+    def scan_segment(self, segment):
+        """
+        Iterates over (digest, offset, length, kind) of valid records in segment
+        """
+        fd = self.get_fd(segment)
+        size = self.get_segment_size(segment)
+        offset = 0
+        while offset + RECORD_HEADER.size <= size:
+            magic, digest, kind, length, _ = RECORD_HEADER.unpack(os.pread(fd, RECORD_HEADER.size, offset))
+            if magic != RECORD_MAGIC or offset + RECORD_HEADER.size + length > size:
+                logger.warning('Segment %s is truncated at offset %s' % (segment, offset))
+                break
+            yield digest, offset, length, kind
+            offset += RECORD_HEADER.size + length
+
+    def rebuild_index(self):
+        """
+        Restores index from segment files, e.g. after the index was lost
+        """
+        logger.warning('Rebuilding index of packed cache %s' % self.get_cache_path())
+        for segment in self.get_segments():
+            for digest, offset, length, kind in self.scan_segment(segment):
+                self.index.put(digest, segment, offset, length, kind)
+                if segment == self.segment:
+                    self.offset = offset + RECORD_HEADER.size + length
+        self.index.flush()
+
+    def compact(self):
+        """
+        Copies live records into new segments and removes the old ones,
+        reclaiming space taken by overwritten and removed pages
+        """
+        old_segments = self.get_segments()
+        live = sum(1 for _, location in self.index.items() if location[3] != KIND_DELETED)
+        capacity = INDEX_INITIAL_CAPACITY
+        while capacity * INDEX_MAX_LOAD / 2 < live:
+            capacity *= 2
+
+        tmp_filename = '%s.tmp' % self.get_index_filename()
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        old_index, self.index = self.index, PackedIndex(tmp_filename, capacity)
+        self.segment = old_segments[-1] + 1 if old_segments else 0
+        self.offset = 0
+
+        for digest, location in old_index.items():
+            if location[3] == KIND_DELETED:
+                continue
+            record = self.read_record(digest, location)
+            if record is not None:
+                self.append_record(digest, location[3], [record[0]], record[1])
+
+        self.sync()
+        old_index.close()
+        self.index.close()
+        os.replace(tmp_filename, self.get_index_filename())
+        self.index = PackedIndex(self.get_index_filename())
+
+        for segment in old_segments:
+            if segment in self.fds:
+                os.close(self.fds.pop(segment))
+            os.remove(self.get_segment_filename(segment))
+        logger.info('Packed cache %s was compacted, %s records kept' % (self.get_cache_path(), live))
+
+    def import_file_cache(self, path):
+        """
+        Imports all pages and errors from FileCache directory. Returns
+        number of imported files, a page and an error of the same URL
+        are imported as the page.
+        """
+        count = 0
+        for i in '0123456789abcdef':
+            for j in '0123456789abcdef':
+                directory = os.path.join(path, i, i + j)
+                if not os.path.isdir(directory):
+                    continue
+                # Page and error of every hash, temporary and foreign files are skipped
+                files = dict()
+                for name in os.listdir(directory):
+                    match = FILE_CACHE_NAME_RE.match(name)
+                    if match is not None:
+                        files.setdefault(match.group(1), [None, None])[bool(match.group(2))] = name
+                for hash, (page, error) in sorted(files.items()):
+                    # A non-empty page wins over the error, as in FileCache.lookup()
+                    if page is not None and os.path.getsize(os.path.join(directory, page)) > 0:
+                        kind, name = KIND_DATA, page
+                    elif error is not None:
+                        kind, name = KIND_ERROR, error
+                    else:
+                        continue
+                    with open(os.path.join(directory, name), 'rb') as f:
+                        self.append_record(bytes.fromhex(hash), kind, iter(lambda: f.read(CHUNK_SIZE), b''),
+                                           os.fstat(f.fileno()).st_mtime)
+                    count += 1
+        self.sync()
+        logger.info('%s files were imported from %s' % (count, path))
+        return count
+
+
+def get_packed_cache(path):
+    path = os.path.abspath(path)
+    return PackedCache(os.path.basename(path), os.path.dirname(path))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Packed cache maintenance')
+    subparsers = parser.add_subparsers(dest='command')
+    parser_import = subparsers.add_parser('import', help='Import FileCache directory into packed cache')
+    parser_import.add_argument('source', help='FileCache directory')
+    parser_import.add_argument('destination', help='Packed cache directory')
+    parser_compact = subparsers.add_parser('compact', help='Reclaim space of removed and overwritten pages')
+    parser_compact.add_argument('path', help='Packed cache directory')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == 'import':
+        cache = get_packed_cache(args.destination)
+        print('%s files were imported' % cache.import_file_cache(args.source))
+    elif args.command == 'compact':
+        cache = get_packed_cache(args.path)
+        cache.compact()
+    else:
+        parser.print_help()
+        return
+    cache.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,28 @@
 # -*- coding: utf-8 -*-
 
+import os
 import sys
 import time
 import logging
 import argparse
+import itertools
+import multiprocessing
 import random
+import asyncio
+import functools
+import threading
 
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+
+from parselab import metrics
 from parselab.db import Database
-from parselab.cache import CacheInterface
-from parselab.network import PageNotFound
+from parselab.bulk import BulkLoader
+from parselab.common import LRUDict
+from parselab.cache import CacheInterface, HIT, ERROR, MISS, accepts_meta
+from parselab.memo import get_content_digest, get_callback_name
+from parselab.network import PageNotFound, NotModified, Response, get_validators, get_content_meta, get_encoding, \
+    get_text
 
 logger = logging.getLogger(__name__)
 
@@ -19,6 +33,16 @@ class BasicParser(object):
 
     # Is previous page was fetched from cache?
     is_cache_used = True
+    # Seconds after which cached pages are revalidated, None means never
+    cache_ttl = None
+    # Queue of URLs to crawl (parselab.frontier.Frontier), see crawl()
+    frontier = None
+    # Pages are never downloaded in offline mode, see replay()
+    offline = False
+    # Memo of parse results (parselab.memo.ParseMemo) and version of parsing code, results
+    # of unchanged pages are taken from memo by replay() while the version is the same
+    memo = None
+    parser_version = None
 
     def __init__(self, args=sys.argv):
         self.parser = argparse.ArgumentParser()
@@ -30,9 +54,14 @@ class BasicParser(object):
         return dict()
 
     def sleep(self):
+        if getattr(self.net, 'rate_limiter', None) is not None:
+            # Requests are scheduled by rate limiter of network manager
+            return
         time_to_sleep = self.get_sleep_time()
-        logger.info('Sleeping for %s s' % time_to_sleep)
-        time.sleep(time_to_sleep)
+        if time_to_sleep:
+            logger.info('Sleeping for %s s' % time_to_sleep)
+            metrics.inc('sleep_seconds', time_to_sleep)
+            time.sleep(time_to_sleep)
 
     def get_sleep_time(self):
         return 0 if self.is_cache_used else random.randint(0, 10)
@@ -40,52 +69,369 @@ class BasicParser(object):
     def is_captcha_required(self, data):
         return False
 
+    def get_cache_ttl(self, url):
+        """
+        Returns number of seconds after which cached page should be
+        revalidated, None means that cached pages never expire
+        """
+        return self.cache_ttl
+
+    def is_fresh(self, url, result):
+        ttl = self.get_cache_ttl(url)
+        return ttl is None or result.fetched_at is None or time.time() - result.fetched_at < ttl
+
     def get_page(self, url, binary=False):
-        self.sleep()
         if sys.version_info[0] < 3:
             url = url.encode('utf-8')
         logger.info('Getting page "%s"...' % url)
-        if self.cache.is_in_cache(url):
-            logger.info('Page found in cache: %s' % self.cache.get_cached_filename(url))
-            data = self.cache.get_file(url, binary)
-            if data is None:
-                raise PageDownloadException('Cache error, filename: %s' % self.cache.get_cached_filename(url))
-            self.is_cache_used = True
-            return data
-        elif self.cache.is_in_cache_error(url):
-            if self.cache.get_error_from_cache(url) == 'PageNotFound':
+        with metrics.timer('cache_lookup_seconds'):
+            result = self.cache.lookup(url, binary)
+        status = self.check_lookup(url, result)
+        if status == HIT:
+            return self.get_cached_data(result)
+        elif status == MISS:
+            return self.fetch_page(url, binary, result)
+
+    def check_lookup(self, url, result):
+        """
+        Returns HIT if the cached page can be used, MISS if page has to
+        be downloaded, ERROR otherwise. Raises PageNotFound if page was
+        not found before.
+        """
+        if result.status == HIT and self.is_fresh(url, result):
+            metrics.inc('cache_lookups', result='hit')
+            return HIT
+        elif result.status == ERROR:
+            metrics.inc('cache_lookups', result='negative')
+            if result.error == 'PageNotFound':
                 raise PageNotFound()
-        else:
-            logger.info('Page was not found in cache')
-            tries = 3
-            while tries > 0:
-                try:
-                    data = self.net.download_page(url, cookies=self.get_cookies(), binary=binary)
-                except PageNotFound:
-                    # We report this error to cache in order to save time in the future
-                    self.cache.save_error_in_cache(url, 'PageNotFound')
-                    raise
+            return ERROR
+        metrics.inc('cache_lookups', result='stale' if result.status == HIT else 'miss')
+        return MISS
 
-                if self.is_captcha_required(data):
-                    self.solve_captcha(data)
-                    continue
+    def fetch_page(self, url, binary, result):
+        """
+        Downloads page which is missing or stale in cache and saves it
+        """
+        steps = self.download_steps(url, binary, result)
+        validators = next(steps)
+        self.sleep()
+        finish = None
+        while finish is None:
+            try:
+                response = self.fetch(url, binary, validators)
+            except Exception as e:
+                finish, validators = send_step(steps, error=e)
+            else:
+                finish, validators = send_step(steps, response)
+        return finish()
+
+    def download_steps(self, url, binary, result):
+        """
+        Download attempts of fetch_page() and get_page_async(): generator
+        which yields validators of the next request and gets its response
+        or error back. It returns a function which saves the outcome into
+        cache and returns the page, so cache I/O is done by the caller.
+        """
+        if self.offline:
+            raise PageDownloadException('Page "%s" is not in cache' % url)
+        validators = self.get_validators(result)
+        # Host label is computed only when metrics are collected
+        host = metrics.get_host(url) if metrics.registry is not None else None
+        tries = 3
+        while True:
+            try:
+                with metrics.timer('fetch_seconds', host=host):
+                    response = yield validators
+            except NotModified:
+                return functools.partial(self.on_not_modified, url, result)
+            except PageNotFound as e:
+                return functools.partial(self.on_page_not_found, url, result, e)
+
+            encoding = self.get_response_encoding(response, binary)
+            data = self.get_response_data(response, binary, encoding)
+            if self.is_captcha_required(data):
+                metrics.inc('captchas', host=host)
+                self.solve_captcha(data)
+                continue
+
+            if data:
+                return functools.partial(self.save_page, url, data, binary, response, result, encoding)
+
+            logger.warning('Network error, trying again...')
+            metrics.inc('page_retries', host=host)
+            tries -= 1
+            if tries == 0:
+                return functools.partial(self.on_download_failed, url, result)
+
+    def fetch(self, url, binary, validators):
+        """
+        Returns response of self.net, network managers without fetch()
+        only download pages, which are not revalidated then
+        """
+        if hasattr(self.net, 'fetch'):
+            return self.net.fetch(url, cookies=self.get_cookies(), binary=binary, validators=validators)
+        page = self.net.download_page(url, cookies=self.get_cookies(), binary=binary)
+        if page is None or binary:
+            return page
+        return Response(url, 200, {'Content-Type': 'text/html; charset=utf-8'}, page.encode('utf-8'), 'utf-8')
+
+    def get_pages(self, urls, binary=False, max_workers=4, ordered=True, return_exceptions=False):
+        """
+        Generates tuples (url, page) for urls. Pages found in cache are
+        returned right away, the others are downloaded by max_workers
+        threads. With ordered=False pages are generated as soon as they
+        are ready. With return_exceptions=True exceptions are generated
+        instead of pages, otherwise the first one is raised.
+        """
+        window = max_workers * 4
+        pending = deque()
+
+        def submit(url):
+            if sys.version_info[0] < 3:
+                url = url.encode('utf-8')
+            result = self.cache.lookup(url, binary)
+            future = Future()
+            try:
+                status = self.check_lookup(url, result)
+            except PageNotFound as e:
+                future.set_exception(e)
+            else:
+                if status == HIT:
+                    future.set_result(self.get_cached_data(result))
+                elif status == MISS:
+                    future = executor.submit(self.fetch_page, url, binary, result)
+                else:
+                    future.set_result(None)
+            pending.append((url, future))
+
+        def get_result(url, future):
+            try:
+                return url, future.result()
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                return url, e
+
+        def get_ready(block):
+            """
+            Generates results which are ready, waits for one if block is True
+            """
+            if ordered:
+                while pending and (block or pending[0][1].done()):
+                    block = False
+                    yield get_result(*pending.popleft())
+            else:
+                if block:
+                    wait([future for _, future in pending], return_when=FIRST_COMPLETED)
+                for item in [item for item in pending if item[1].done()]:
+                    pending.remove(item)
+                    yield get_result(*item)
 
-                if data:
-                    break
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            for url in urls:
+                submit(url)
+                for item in get_ready(len(pending) > window):
+                    yield item
+            while pending:
+                for item in get_ready(True):
+                    yield item
+        finally:
+            for _, future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def enqueue(self, url, priority=0):
+        """
+        Adds url to the frontier unless it has been seen already
+        """
+        return self.frontier.add(url, priority)
 
-                logger.warning('Network error, trying again...')
-                tries -= 1
-                if tries == 0:
-                    self.cache.save_error_in_cache(url, 'PageDownloadException')
-                    raise PageDownloadException('Could not get page')
+    def crawl(self, callback, urls=(), binary=False, max_workers=1, batch_size=100):
+        """
+        Downloads pages from self.frontier with get_pages() and calls
+        callback(url, page) for every page, the callback adds found links
+        with enqueue(). If the crawl was interrupted, it is resumed from
+        the frontier, as urls have been seen already. Value returned by
+        callback is passed to the frontier, see parselab.sharding.
+        """
+        self.frontier.add_many(urls)
+        while True:
+            batch = self.frontier.pop_many(batch_size)
+            if not batch:
+                break
+            for url, page in self.get_pages(batch, binary, max_workers, return_exceptions=True):
+                if isinstance(page, Exception):
+                    logger.warning('Could not get page "%s": %r' % (url, page))
+                    self.frontier.failed(url, page)
+                    continue
+                with metrics.timer('parse_seconds'):
+                    result = callback(url, page)
+                self.frontier.done(url, result)
+        self.frontier.checkpoint()
 
-            if not self.is_captcha_required(data):
-                self.cache.write_to_cache(url, data, binary)
-                logger.info('Page saved into cache as: %s' % self.cache.get_cached_filename(url))
-                self.is_cache_used = False
+    def replay(self, callback, urls=None, binary=False, processes=None, chunksize=100,
+               on_result=None, report_interval=10, context=None):
+        """
+        Calls callback(url, page) for cached pages of urls, or for all pages
+        in cache, in a pool of processes without touching the network.
+        Values returned by callback are passed to on_result(url, result) in
+        this process, so only it writes to the database. If the parser has
+        memo and parser_version, pages which have not changed since the
+        last replay are skipped. Returns statistics. context is the start
+        method of processes, fork by default where it's available; with
+        other ones parser and callback have to be picklable.
+        """
+        if urls is None:
+            urls = self.cache.get_urls()
+        urls = iter(urls)
+        processes = processes or os.cpu_count() or 1
+        stats = {'pages': 0, 'unchanged': 0, 'missing': 0, 'failed': 0}
+        started = reported = time.time()
+        memo = self.memo if self.parser_version is not None else None
+
+        state = (self, callback, binary, memo)
+        offline, pool = self.offline, None
+        try:
+            if processes == 1:
+                results = (replay_page(state, url) for url in urls)
+            else:
+                if context is None:
+                    # Parser and callback are inherited by forked processes, so they don't have to be pickled
+                    context = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else None
+                pool = multiprocessing.get_context(context).Pool(processes, init_replay_worker, state)
+                window = processes * chunksize * 4
+                batches = iter(lambda: list(itertools.islice(urls, window)), [])
+                results = itertools.chain.from_iterable(pool.imap_unordered(replay_worker_page, batch, chunksize)
+                                                        for batch in batches)
+            for url, result, error, digest in results:
+                if error == REPLAY_MISSING:
+                    stats['missing'] += 1
+                elif error == REPLAY_UNCHANGED:
+                    stats['unchanged'] += 1
+                    memo.touch(get_callback_name(callback), self.parser_version, [digest])
+                elif error is not None:
+                    logger.warning('Could not replay page "%s": %s' % (url, error))
+                    stats['failed'] += 1
+                else:
+                    stats['pages'] += 1
+                    if memo is not None:
+                        memo.put(get_callback_name(callback), self.parser_version, digest, result)
+                    if on_result is not None:
+                        on_result(url, result)
+                if time.time() - reported >= report_interval:
+                    reported = time.time()
+                    logger.info('Replayed %s pages, %.1f pages/s, %s unchanged, %s missing, %s failed' %
+                                (stats['pages'], (stats['pages'] + stats['unchanged']) / (reported - started),
+                                 stats['unchanged'], stats['missing'], stats['failed']))
+            if pool is not None:
+                pool.close()
+                pool.join()
+        finally:
+            if pool is not None:
+                pool.terminate()
+            self.offline = offline
+            if memo is not None:
+                memo.commit()
+
+        stats['elapsed'] = time.time() - started
+        stats['rate'] = (stats['pages'] + stats['unchanged']) / stats['elapsed'] if stats['elapsed'] else 0.0
+        logger.info('Replay finished: %s pages in %.1f s' % (stats['pages'], stats['elapsed']))
+        return stats
+
+    async def get_page_async(self, url, binary=False):
+        """
+        Coroutine version of get_page() which downloads pages with
+        self.async_net (AsyncNetworkManager), so a lot of pages can be
+        downloaded concurrently. Its concurrency limits are used instead
+        of sleeping between requests, cache is read and written in the
+        default executor of the loop.
+        """
+        logger.info('Getting page "%s"...' % url)
+        loop = asyncio.get_event_loop()
+        with metrics.timer('cache_lookup_seconds'):
+            result = await loop.run_in_executor(None, self.cache.lookup, url, binary)
+        status = self.check_lookup(url, result)
+        if status == HIT:
+            return self.get_cached_data(result)
+        elif status != MISS:
+            return None
+
+        steps = self.download_steps(url, binary, result)
+        validators = next(steps)
+        finish = None
+        while finish is None:
+            try:
+                response = await self.async_net.fetch(url, cookies=self.get_cookies(), binary=binary,
+                                                      validators=validators)
+            except Exception as e:
+                finish, validators = send_step(steps, error=e)
             else:
-                logger.warning('File has not been saved into the cache as it contains captcha data')
-            return data
+                finish, validators = send_step(steps, response)
+        return await loop.run_in_executor(None, finish)
+
+    def get_cached_data(self, result):
+        logger.info('Page found in cache: %s' % (result.filename or 'memory'))
+        if result.data is None:
+            raise PageDownloadException('Cache error, filename: %s' % result.filename)
+        self.is_cache_used = True
+        return result.data
+
+    def get_validators(self, result):
+        if result.status == HIT:
+            logger.info('Page in cache is stale, revalidating')
+            return dict((key, value) for key, value in result.meta.items() if key in ('etag', 'last_modified'))
+        logger.info('Page was not found in cache')
+        return None
+
+    def get_response_encoding(self, response, binary):
+        # Encoding is detected once, for decoding the page and for saving it with the page
+        if response is None or binary:
+            return None
+        return get_encoding(response)
+
+    def get_response_data(self, response, binary, encoding=None):
+        if response is None or binary:
+            return response
+        return get_text(response, encoding)
+
+    def on_not_modified(self, url, result):
+        logger.info('Page was not modified, using cached one')
+        self.cache.touch(url)
+        self.is_cache_used = False
+        return result.data
+
+    def on_page_not_found(self, url, result, error):
+        if result.status == HIT:
+            self.cache.remove_from_cache(url)
+        # We report this error to cache in order to save time in the future
+        self.cache.save_error_in_cache(url, 'PageNotFound')
+        raise error
+
+    def on_download_failed(self, url, result):
+        if result.status == HIT:
+            logger.warning('Could not revalidate page, using stale one')
+            return result.data
+        self.cache.save_error_in_cache(url, 'PageDownloadException')
+        raise PageDownloadException('Could not get page')
+
+    def save_page(self, url, data, binary, response, result, encoding=None):
+        if not self.is_captcha_required(data):
+            with metrics.timer('cache_write_seconds'):
+                if accepts_meta(self.cache):
+                    # Text pages are saved undecoded along with their encoding
+                    meta = get_validators(response)
+                    meta.update(get_content_meta(response, binary, encoding))
+                    meta['url'] = url
+                    self.cache.write_to_cache(url, response, True, meta=meta)
+                else:
+                    self.cache.write_to_cache(url, data, binary)
+            logger.info('Page saved into cache as: %s' % result.filename)
+            self.is_cache_used = False
+        else:
+            logger.warning('File has not been saved into the cache as it contains captcha data')
+        return data
 
     def setup_project(self, db, project_name):
         try:
@@ -97,6 +443,56 @@ class BasicParser(object):
                 print('Project "%s" was not found, use argument --init if you want to create one' % project_name)
 
 
+def send_step(steps, response=None, error=None):
+    """
+    Passes response or error of a download attempt to download_steps(),
+    returns tuple (finish, validators): finish is the function which
+    completes the download, or None if validators of the next attempt
+    are returned
+    """
+    try:
+        if error is not None:
+            return None, steps.throw(error)
+        return None, steps.send(response)
+    except StopIteration as e:
+        return e.value, None
+
+
+# Errors of replay_page() which are not failures
+REPLAY_MISSING = 'missing'
+REPLAY_UNCHANGED = 'unchanged'
+
+# Parser, callback, binary flag and memo of replay in a pool process
+worker_state = None
+
+def init_replay_worker(*state):
+    global worker_state
+    worker_state = state
+
+def replay_worker_page(url):
+    return replay_page(worker_state, url)
+
+def replay_page(state, url):
+    """
+    Returns tuple (url, result of callback, error, digest of page) for
+    cached page, error is REPLAY_MISSING if page is not in cache and
+    REPLAY_UNCHANGED if its result is in memo already
+    """
+    parser, callback, binary, memo = state
+    parser.offline = True
+    digest = None
+    try:
+        result = parser.cache.lookup(url, binary)
+        if result.status != HIT or result.data is None:
+            return url, None, REPLAY_MISSING, None
+        if memo is not None:
+            digest = get_content_digest(result.data)
+            if memo.has(get_callback_name(callback), parser.parser_version, digest):
+                return url, None, REPLAY_UNCHANGED, digest
+        return url, callback(url, result.data), None, digest
+    except Exception as e:
+        return url, None, repr(e), digest
+
 class InvalidProjectException(Exception):
     """
     Thrown when project not found
@@ -105,18 +501,71 @@ class InvalidProjectException(Exception):
 
 class ParsingDatabase(Database):
     """
-    Implements integration with parsing database
+    Implements integration with parsing database. IDs of categories,
+    attribute categories, attributes, manufacturers and options are cached,
+    at most id_cache_size of each kind, existing categories and attributes
+    of the project are loaded on setup_project().
     """
-    cache = {'attributes': dict()}
+
+    # Queries which preload caches, they return rows (key, ..., id)
+    preload = {
+        'categories': 'select name, parent_id, id from public.category where project_id = %(project_id)s',
+        'attribute_categories': '''
+        select name, min(id) from public.attribute_category where project_id = %(project_id)s group by name
+        ''',
+        'attributes': '''
+        select name, attribute_category_id, min(id)
+          from public.attribute
+         where project_id = %(project_id)s
+         group by name, attribute_category_id
+        ''',
+    }
+
+    id_cache_size = 100000
+
+    def __init__(self, id_cache_size=100000):
+        Database.__init__(self)
+        self.id_cache_size = id_cache_size
+
+    @property
+    def cache(self):
+        # Created on first use, so subclasses don't have to call __init__()
+        if '_cache' not in self.__dict__:
+            # setdefault, so threads which came here together share the same caches
+            self.__dict__.setdefault('_cache', dict((name, LRUDict(self.id_cache_size)) for name in (
+                'categories', 'attribute_categories', 'attributes', 'manufacturers', 'options')))
+        return self._cache
+
+    def connect(self, conn, minconn=None, maxconn=None, prepare=False):
+        # IDs stay valid after reconnect, but not in another database
+        if conn != self.conn:
+            self.clear_cache()
+        Database.connect(self, conn, minconn, maxconn, prepare)
+
+    def clear_cache(self):
+        for cache in self.cache.values():
+            cache.clear()
+
+    def preload_cache(self):
+        """
+        Loads IDs of existing categories and attributes of the project
+        """
+        self.clear_cache()
+        for name, query in self.preload.items():
+            rows = self.query_dict(query, {'project_id': self.project_id})
+            self.cache[name].update((row[0] if len(row) == 2 else tuple(row[:-1]), row[-1]) for row in rows)
+            logger.debug('%s IDs of %s were preloaded' % (len(rows), name))
 
     def setup_project(self, project_name):
         id = self.query_value('select id from public.project where name = %s', [project_name])
         if not id:
             raise InvalidProjectException('Invalid project name')
         self.project_id = id
+        self.preload_cache()
 
     def create_project(self, project_name):
         self.project_id = self.query_value('insert into public.project (name) values (%s) returning id', [project_name])
+        self.clear_cache()
 
     def get_category_id(self, category_name, parent_id=None, url=None):
         qInsert = '''
@@ -139,10 +588,16 @@ class ParsingDatabase(Database):
             '''
             args = [category_name, self.project_id]
 
+        key = (category_name, parent_id or None)
+        id = self.cache['categories'].get(key)
+        if id:
+            return id
         id = self.query_value(qSelect, args)
         if not id:
             id = self.query_value(qInsert, {'name': category_name, 'parent_id': parent_id,
                                             'project_id': self.project_id, 'url': url})
+        if id:
+            self.cache['categories'][key] = id
         return id
 
     def get_attribute_category_id(self, name, description=None):
@@ -157,11 +612,16 @@ class ParsingDatabase(Database):
          where project_id = %(project_id)s
            and name = %(name)s
         '''
+        id = self.cache['attribute_categories'].get(name)
+        if id:
+            return id
         id = self.query_value(qSelect, {'project_id': self.project_id, 'name': name})
 
         if not id:
             id = self.query_value(qInsert, {'project_id': self.project_id, 'name': name,
                                             'description': description})
+        if id:
+            self.cache['attribute_categories'][name] = id
         return id
 
     def update_product_name(self, sku, name):
@@ -171,45 +631,71 @@ class ParsingDatabase(Database):
         self.execute(qUpdate, {'name': name, 'sku': sku, 'product_id': self.project_id})
 
     def get_product_id(self, product_name, categories, sku, url, manufacturer_id=None, price=None):
-        qInsert = '''
-        insert into public.product (project_id, sku, name, url, manufacturer_id, price)
-        values (%(project_id)s, %(sku)s, %(name)s, %(url)s, %(manufacturer_id)s, %(price)s)
-        returning id
-        '''
-        bAlreadyExists = True
-
-        # Do we have a product with the same SKU but different URL? If yes, raise the error
-        if sku is not None:
-            product_ = self.query_row('select sku, url from product where project_id = %s and url != %s and sku = %s', [self.project_id, url, sku])
-            if product_ is not None:
-                raise Exception('Product with the same SKU but different URL has been found. SKU = %s, ' \
-                                'new URL %s, existing URL %s' % (sku, url, product_['url']))
-
+        """
+        Returns tuple (id, already_exists) of product, creates it if it's not
+        found and adds it to categories, all in one statement
+        """
         # Product search algorithm
         # 1. Use SKU if it is provided
         # 2. If we don't know the SKU try to use name and manufactirer
         # 3. If manufacturer is not provided we use only product name
+        # Nothing is changed if there is a product with the same SKU but different URL
+        qUpsert = '''
+        with conflict as (
+            select url
+              from public.product
+             where project_id = %(project_id)s::bigint
+               and %(sku)s::text is not null
+               and sku = %(sku)s
+               and url != %(url)s::text
+             limit 1
+        ), found as (
+            select id
+              from public.product
+             where project_id = %(project_id)s
+               and case when %(sku)s is not null then sku = %(sku)s
+                        when %(manufacturer_id)s::bigint is not null
+                        then name = %(name)s::text and manufacturer_id = %(manufacturer_id)s
+                        else name = %(name)s
+                   end
+               and not exists (select * from conflict)
+             limit 1
+        ), inserted as (
+            insert into public.product (project_id, sku, name, url, manufacturer_id, price)
+            select %(project_id)s, %(sku)s, %(name)s, %(url)s, %(manufacturer_id)s, %(price)s::numeric
+             where not exists (select * from found)
+               and not exists (select * from conflict)
+            returning id
+        ), result as (
+            select id, true as already_exists from found
+             union all
+            select id, false from inserted
+        ), linked as (
+            insert into public.product_category (project_id, product_id, category_id)
+            select distinct %(project_id)s, r.id, c.category_id
+              from result r, unnest(%(categories)s::bigint[]) as c (category_id)
+             where not exists (
+                select *
+                  from public.product_category pc
+                 where pc.project_id = %(project_id)s
+                   and pc.product_id = r.id
+                   and pc.category_id = c.category_id
+            )
+        )
+        select (select id from result) as id,
+               (select already_exists from result) as already_exists,
+               (select url from conflict) as conflict_url
+        '''
+        row = self.query_row(qUpsert, {'project_id': self.project_id, 'sku': sku,
+                                       'name': product_name, 'url': url,
+                                       'manufacturer_id': manufacturer_id,
+                                       'price': price, 'categories': list(categories)},
+                             name='get_product_id')
+        if row['conflict_url'] is not None:
+            raise Exception('Product with the same SKU but different URL has been found. SKU = %s, ' \
+                            'new URL %s, existing URL %s' % (sku, url, row['conflict_url']))
 
-        if sku is not None:
-            id = self.query_value('select id from public.product where project_id = %s and sku = %s',
-                                  [self.project_id, sku])
-        elif manufacturer_id is not None:
-            id = self.query_value('select id from public.product where project_id = %s and name = %s and manufacturer_id = %s',
-                                  [self.project_id, product_name, manufacturer_id])
-        else:
-            id = self.query_value('select id from public.product where project_id = %s and name = %s',
-                                  [self.project_id, product_name])
-        if not id:
-            bAlreadyExists = False
-            id = self.query_value(qInsert, {'project_id': self.project_id, 'sku': sku,
-                                            'name': product_name, 'url': url,
-                                            'manufacturer_id': manufacturer_id,
-                                            'price': price})
-        # Update product to category link even if it is found in the database
-        for category_id in categories:
-            self.add_product_to_category(id, category_id)
-
-        return (id, bAlreadyExists,)
+        return (row['id'], row['already_exists'],)
 
     def add_product_to_category(self, product_id, category_id):
         """
@@ -217,7 +703,7 @@ class ParsingDatabase(Database):
         """
         qInsert = '''
         insert into public.product_category (project_id, product_id, category_id)
-        select %(project_id)s, %(product_id)s, %(category_id)s
+        select %(project_id)s::bigint, %(product_id)s::bigint, %(category_id)s::bigint
         where not exists (
             select *
               from public.product_category
@@ -228,7 +714,7 @@ class ParsingDatabase(Database):
         '''
         self.execute(qInsert, {'project_id': self.project_id,
                                'product_id': product_id,
-                               'category_id': category_id})
+                               'category_id': category_id}, name='add_product_to_category')
 
     def add_product_image(self, product_id, url, priority):
         """
@@ -236,7 +722,8 @@ class ParsingDatabase(Database):
         """
         qSet = '''select public.set_product_image(%(project_id)s, %(product_id)s, %(url)s, %(priority)s)'''
         id = self.query_value(qSet, {'project_id': self.project_id, 'url': url,
-                                     'priority': priority, 'product_id': product_id})
+                                     'priority': priority, 'product_id': product_id},
+                              name='add_product_image')
 
         return id
 
@@ -251,7 +738,7 @@ class ParsingDatabase(Database):
         select public.set_product_description (%(project_id)s, %(product_id)s, %(description)s)
         '''
         id = self.query_value(qSet, {'project_id': self.project_id, 'product_id': product_id,
-                                     'description': description})
+                                     'description': description}, name='add_product_description')
         return id
 
     def get_attribute_id(self, attribute_name, attribute_category_id=None, description=None, use_cache=False):
@@ -283,7 +770,7 @@ class ParsingDatabase(Database):
             if id is None:
                 logger.warning('%s, %s, %s', attribute_name, attribute_category_id, description)
                 raise Exception('Trying to insert NULL!')
-            self.cache['attributes'].update({(attribute_name, attribute_category_id,): id})
+            self.cache['attributes'][(attribute_name, attribute_category_id,)] = id
 
         return id
 
@@ -296,22 +783,23 @@ class ParsingDatabase(Database):
         '''
         id = self.query_value(qUpdate, {'project_id': self.project_id, 'product_id': product_id,
                                         'attribute_id': attribute_id, 'value': str(value),
-                                        'priority': priority})
+                                        'priority': priority}, name='set_attribute_value')
         return id
 
     def set_bulk_attribute_value(self, values):
         """
-        Set bulk attribute value
+        Set bulk attribute value, values are rows of t_attribute_value type
         """
-        # TODO: Use adapter to bind variables into cursor
-        def escape(s):
-            return s.replace("'", "''")
+        loader = self.bulk_loader()
+        for row in values:
+            loader.add_attribute_value(row)
+        loader.load()
 
-        qQuery = '''
-        select public.set_bulk_attribute_value(%s, %s::t_attribute_value[])
-        '''
-        avalues = 'array[%s]' % ', '.join('(%s)' % ','.join("'%s'" % escape(str(i)) for i in row) for row in values)
-        self.execute(qQuery % (self.project_id, avalues), None)
+    def bulk_loader(self, spool_size=64 * 2 ** 20):
+        """
+        Returns BulkLoader, which loads whole catalog with COPY
+        """
+        return BulkLoader(self, spool_size)
 
     def add_product_option(self, product_id, option_id):
         """
@@ -321,7 +809,7 @@ class ParsingDatabase(Database):
 
         self.execute(qAddOption, {'project_id': self.project_id,
                                   'product_id': product_id,
-                                  'option_id': option_id})
+                                  'option_id': option_id}, name='add_product_option')
 
     def get_manufacturer_id(self, name):
         """
@@ -329,8 +817,13 @@ class ParsingDatabase(Database):
         """
         qGetManufacturerId = 'select public.get_manufacturer_id(%(project_id)s, %(name)s)'
 
-        return self.query_value(qGetManufacturerId, {'project_id': self.project_id,
-                                                     'name': name})
+        id = self.cache['manufacturers'].get(name)
+        if not id:
+            id = self.query_value(qGetManufacturerId, {'project_id': self.project_id,
+                                                       'name': name}, name='get_manufacturer_id')
+            if id:
+                self.cache['manufacturers'][name] = id
+        return id
 
     def get_option_id(self, name):
         """
@@ -338,8 +831,13 @@ class ParsingDatabase(Database):
         """
         qGetOptionId = 'select public.get_option_id(%(project_id)s, %(name)s)'
 
-        return self.query_value(qGetOptionId, {'project_id': self.project_id,
-                                               'name': name})
+        id = self.cache['options'].get(name)
+        if not id:
+            id = self.query_value(qGetOptionId, {'project_id': self.project_id,
+                                                 'name': name}, name='get_option_id')
+            if id:
+                self.cache['options'][name] = id
+        return id
 
     def update_product_at_diagram(self, product_id, diagram, lookup_no):
         """
@@ -372,3 +870,153 @@ class ParsingDatabase(Database):
         '''
         return self.query_value(qId, {'partnumber': partnumber, 'vehicle_id': vehicle_id,
                                       'diagram': diagram, 'lookup_no': lookup_no})
+
+class BufferedParsingDatabase(ParsingDatabase):
+    """
+    ParsingDatabase which queues product categories, attribute values,
+    images, options and descriptions and writes them in batches: when
+    batch_size of them are queued, when flush_interval seconds have passed
+    since the first one, on flush() and on close(). When connected with a
+    pool, a background thread flushes rows every flush_interval seconds,
+    without a pool the connection can't be shared with it, so rows wait
+    for the next queued one or flush(). Methods which return IDs in
+    ParsingDatabase still do, they flush queued rows and write at once,
+    their queued variants are queue_attribute_value(), queue_product_image()
+    and queue_product_description().
+    """
+
+    # Queries which write queued rows, in order they are flushed
+    batches = OrderedDict([
+        ('product_category', '''
+        insert into public.product_category (project_id, product_id, category_id)
+        select distinct v.project_id, v.product_id, v.category_id
+          from (values %s) as v (project_id, product_id, category_id)
+         where not exists (
+            select *
+              from public.product_category pc
+             where pc.project_id = v.project_id and
+                   pc.product_id = v.product_id and
+                   pc.category_id = v.category_id
+        )
+        '''),
+        ('attribute_value', '''
+        select public.set_attribute_value(v.project_id, v.product_id, v.attribute_id, v.value, v.priority)
+          from (values %s) as v (project_id, product_id, attribute_id, value, priority)
+        '''),
+        ('product_image', '''
+        select public.set_product_image(v.project_id, v.product_id, v.url, v.priority)
+          from (values %s) as v (project_id, product_id, url, priority)
+        '''),
+        ('product_option', '''
+        select public.add_product_option(v.project_id, v.product_id, v.option_id)
+          from (values %s) as v (project_id, product_id, option_id)
+        '''),
+        ('product_description', '''
+        select public.set_product_description(v.project_id, v.product_id, v.description)
+          from (values %s) as v (project_id, product_id, description)
+        '''),
+    ])
+
+    def __init__(self, batch_size=1000, flush_interval=5, page_size=500, id_cache_size=100000):
+        ParsingDatabase.__init__(self, id_cache_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.page_size = page_size
+        self.queues = dict((name, []) for name in self.batches)
+        self.queued = 0
+        self.queued_at = None
+        # Rows are queued by several threads when connected with a pool, queue_lock guards
+        # the queues, flush_lock keeps batches in order while rows are written
+        self.queue_lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.flusher = None
+
+    def connect(self, conn, minconn=None, maxconn=None, prepare=False):
+        ParsingDatabase.connect(self, conn, minconn, maxconn, prepare)
+        if self.pool is not None and self.flush_interval:
+            self.stopped = threading.Event()
+            self.flusher = threading.Thread(target=self.flush_periodically, name='BufferedParsingDatabase',
+                                            daemon=True)
+            self.flusher.start()
+
+    def flush_periodically(self):
+        while not self.stopped.wait(self.flush_interval):
+            if self.queued:
+                try:
+                    self.flush()
+                except Exception:
+                    # Already logged by flush()
+                    pass
+
+    def queue(self, name, row):
+        with self.queue_lock:
+            self.queues[name].append(row)
+            self.queued += 1
+            if self.queued_at is None:
+                self.queued_at = time.time()
+            full = self.queued >= self.batch_size or time.time() - self.queued_at >= self.flush_interval
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes all queued rows, rows queued meanwhile are written by the next
+        flush. Rows of a batch which could not be written are dropped, so
+        they don't fail every next flush, the first error is raised after
+        the other batches are written.
+        """
+        error = None
+        with self.flush_lock:
+            with self.queue_lock:
+                queues = self.queues
+                self.queues = dict((name, []) for name in self.batches)
+                self.queued = 0
+                self.queued_at = None
+            for name, query in self.batches.items():
+                rows = queues[name]
+                if not rows:
+                    continue
+                try:
+                    self.execute_values(query, rows, page_size=self.page_size)
+                except Exception as e:
+                    logger.exception('%s rows of %s were dropped' % (len(rows), name))
+                    error = error or e
+                    continue
+                logger.debug('%s rows of %s were written' % (len(rows), name))
+        if error is not None:
+            raise error
+
+    def close(self):
+        if self.flusher is not None:
+            self.stopped.set()
+            self.flusher.join()
+            self.flusher = None
+        self.flush()
+        ParsingDatabase.close(self)
+
+    def add_product_to_category(self, product_id, category_id):
+        self.queue('product_category', (self.project_id, product_id, category_id))
+
+    def queue_attribute_value(self, product_id, attribute_id, value, priority=0):
+        self.queue('attribute_value', (self.project_id, product_id, attribute_id, str(value), priority))
+
+    def queue_product_image(self, product_id, url, priority):
+        self.queue('product_image', (self.project_id, product_id, url, priority))
+
+    def add_product_option(self, product_id, option_id):
+        self.queue('product_option', (self.project_id, product_id, option_id))
+
+    def queue_product_description(self, product_id, description):
+        self.queue('product_description', (self.project_id, product_id, description))
+
+    def set_attribute_value(self, product_id, attribute_id, value, priority=0):
+        self.flush()
+        return ParsingDatabase.set_attribute_value(self, product_id, attribute_id, value, priority)
+
+    def add_product_image(self, product_id, url, priority):
+        self.flush()
+        return ParsingDatabase.add_product_image(self, product_id, url, priority)
+
+    def add_product_description(self, product_id, description):
+        self.flush()
+        return ParsingDatabase.add_product_description(self, product_id, description)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+import time
+import random
+import logging
+import threading
+
+import requests
+
+__all__ = ['Proxy', 'ProxyPool', 'get_proxy_pool']
+
+logger = logging.getLogger(__name__)
+
+# Statuses which mean that the proxy is banned by the site or by itself
+BAN_STATUSES = (403, 407)
+
+class Proxy(object):
+    """
+    Proxy with its health statistics and its own session, so every proxy
+    keeps its own pool of keep-alive connections
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.session = None
+        self.requests = 0
+        self.errors = 0
+        self.bans = 0
+        self.failures = 0
+        self.quarantines = 0
+        self.latency = None
+        self.error_rate = 0.0
+        self.quarantined_until = 0.0
+
+    def get_session(self):
+        if self.session is None:
+            self.session = requests.session()
+        return self.session
+
+    def get_proxies(self):
+        return dict(http=self.url, https=self.url)
+
+    def get_weight(self):
+        """
+        Healthy and fast proxies get more requests
+        """
+        latency = self.latency if self.latency is not None else 1.0
+        return max(0.01, 1.0 - self.error_rate) / max(latency, 0.05)
+
+    def is_available(self, now):
+        return self.quarantined_until <= now
+
+    def get_stats(self):
+        return {'url': self.url, 'requests': self.requests, 'errors': self.errors, 'bans': self.bans,
+                'latency': self.latency, 'error_rate': self.error_rate,
+                'quarantined_until': self.quarantined_until or None}
+
+class ProxyPool(object):
+    """
+    Pool of proxies which chooses proxy for every request with probability
+    proportional to its health. A proxy which fails max_failures times in
+    a row or gets banned is quarantined for backoff seconds, and the
+    backoff doubles every time up to max_backoff.
+    """
+
+    def __init__(self, proxies, max_failures=3, backoff=30, max_backoff=3600):
+        self.proxies = [proxy if isinstance(proxy, Proxy) else Proxy(proxy) for proxy in proxies]
+        self.max_failures = max_failures
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.proxies)
+
+    def choose(self):
+        """
+        Returns proxy for the next request
+        """
+        now = time.time()
+        with self.lock:
+            available = [proxy for proxy in self.proxies if proxy.is_available(now)]
+            if not available:
+                proxy = min(self.proxies, key=lambda proxy: proxy.quarantined_until)
+                logger.warning('All proxies are quarantined, using %s' % proxy.url)
+                return proxy
+            weights = [proxy.get_weight() for proxy in available]
+            point = random.uniform(0, sum(weights))
+            for proxy, weight in zip(available, weights):
+                point -= weight
+                if point <= 0:
+                    return proxy
+            return available[-1]
+
+    def report_success(self, proxy, latency):
+        with self.lock:
+            proxy.requests += 1
+            proxy.failures = 0
+            proxy.quarantines = 0
+            proxy.latency = latency if proxy.latency is None else 0.8 * proxy.latency + 0.2 * latency
+            proxy.error_rate = 0.9 * proxy.error_rate
+
+    def report_failure(self, proxy, ban=False):
+        """
+        Reports connection error or ban (e.g. 403 or 407 response) of proxy
+        """
+        with self.lock:
+            proxy.requests += 1
+            proxy.errors += 1
+            proxy.failures += 1
+            proxy.error_rate = 0.9 * proxy.error_rate + 0.1
+            if ban:
+                proxy.bans += 1
+            if ban or proxy.failures >= self.max_failures:
+                backoff = min(self.max_backoff, self.backoff * 2 ** proxy.quarantines)
+                proxy.quarantines += 1
+                proxy.quarantined_until = time.time() + backoff
+                logger.warning('Proxy %s is quarantined for %s s' % (proxy.url, backoff))
+
+    def report(self, proxy, status_code, latency):
+        """
+        Reports result of request made through proxy
+        """
+        if status_code in BAN_STATUSES:
+            self.report_failure(proxy, ban=True)
+        else:
+            self.report_success(proxy, latency)
+
+    def get_stats(self):
+        with self.lock:
+            return [proxy.get_stats() for proxy in self.proxies]
+
+def get_proxy_pool(proxies):
+    """
+    Returns ProxyPool for list of proxy urls, or None if there are no proxies
+    """
+    if isinstance(proxies, ProxyPool):
+        return proxies
+    if not proxies:
+        return None
+    return ProxyPool(proxies)
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+import time
+import logging
+import threading
+
+from email.utils import parsedate_tz, mktime_tz
+from urllib.parse import urlparse
+
+__all__ = ['RateLimiter', 'TokenBucket', 'parse_retry_after']
+
+logger = logging.getLogger(__name__)
+
+# Statuses which mean that we are going too fast
+THROTTLE_STATUSES = (429, 503)
+
+def parse_retry_after(value):
+    """
+    Returns number of seconds from Retry-After header, which is either
+    a number of seconds or HTTP date
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0.0, mktime_tz(date) - time.time())
+
+class TokenBucket(object):
+    """
+    Token bucket of one host. Instead of counting tokens it keeps the
+    time when the next request is allowed, so a request can reserve its
+    slot without waiting while the lock is held.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.target_rate = rate
+        self.burst = burst
+        self.next_at = 0.0
+        self.blocked_until = 0.0
+        self.latency = None
+        self.min_latency = None
+        self.requests = 0
+        self.throttled = 0
+        self.waited = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self, now):
+        """
+        Reserves a slot for request and returns number of seconds to wait
+        """
+        with self.lock:
+            interval = 1.0 / self.rate
+            allowed_at = max(now, self.next_at - (self.burst - 1) * interval, self.blocked_until)
+            self.next_at = max(self.next_at, allowed_at) + interval
+            self.requests += 1
+            self.waited += allowed_at - now
+            return allowed_at - now
+
+class RateLimiter(object):
+    """
+    Per-host request scheduler. Each host gets its own token bucket with
+    rate requests per second (or the one from rates dictionary), so slow
+    hosts don't hold requests to other hosts. Rate is halved when the host
+    responds with 429 or 503 and Retry-After is respected, it grows back
+    to the target rate while responses are fine, and slows down when
+    latency becomes much higher than the best one observed.
+    """
+
+    # Rate is decreased when latency exceeds the best one this many times
+    latency_factor = 3.0
+    # Latencies below this number of seconds are never considered slow
+    latency_floor = 0.2
+    # Share of the target rate restored after every successful request
+    recovery = 0.1
+
+    def __init__(self, rate=1.0, burst=1, rates=None, min_rate=0.05):
+        self.rate = rate
+        self.burst = burst
+        self.rates = rates or dict()
+        self.min_rate = min_rate
+        self.buckets = dict()
+        self.lock = threading.Lock()
+
+    def get_host(self, url):
+        return urlparse(url).netloc
+
+    def get_bucket(self, host):
+        with self.lock:
+            if host not in self.buckets:
+                rate = self.rates.get(host, self.rate)
+                self.buckets[host] = TokenBucket(rate, self.burst)
+            return self.buckets[host]
+
+    def reserve(self, url):
+        """
+        Reserves a slot for request to url, returns number of seconds
+        the caller has to wait before sending it
+        """
+        return self.get_bucket(self.get_host(url)).reserve(time.time())
+
+    def acquire(self, url):
+        """
+        Blocks until request to url is allowed
+        """
+        delay = self.reserve(url)
+        if delay > 0:
+            logger.info('Waiting %.2f s before request to %s' % (delay, self.get_host(url)))
+            time.sleep(delay)
+
+    def feedback(self, url, status_code, latency=None, retry_after=None):
+        """
+        Adjusts rate of host using result of the request
+        """
+        bucket = self.get_bucket(self.get_host(url))
+        with bucket.lock:
+            if status_code in THROTTLE_STATUSES:
+                bucket.throttled += 1
+                bucket.rate = max(self.min_rate, bucket.rate / 2)
+                delay = parse_retry_after(retry_after)
+                if delay is not None:
+                    bucket.blocked_until = max(bucket.blocked_until, time.time() + delay)
+                logger.warning('Host %s asked to slow down, new rate is %.2f requests/s' %
+                               (self.get_host(url), bucket.rate))
+                return
+
+            if latency is not None:
+                bucket.latency = latency if bucket.latency is None else 0.8 * bucket.latency + 0.2 * latency
+                bucket.min_latency = latency if bucket.min_latency is None else min(bucket.min_latency, latency)
+                if bucket.latency > self.latency_factor * max(bucket.min_latency, self.latency_floor):
+                    bucket.rate = max(self.min_rate, bucket.rate * 0.9)
+                    return
+
+            if bucket.rate < bucket.target_rate:
+                bucket.rate = min(bucket.target_rate, bucket.rate + bucket.target_rate * self.recovery)
+
+    def get_stats(self):
+        """
+        Returns current rate, latency and counters for each host
+        """
+        with self.lock:
+            buckets = list(self.buckets.items())
+        return dict((host, {'rate': bucket.rate, 'target_rate': bucket.target_rate,
+                            'latency': bucket.latency, 'requests': bucket.requests,
+                            'throttled': bucket.throttled, 'waited': bucket.waited})
+                    for host, bucket in buckets)
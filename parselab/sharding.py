@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import heapq
+import hashlib
+import logging
+import ipaddress
+import threading
+
+from multiprocessing.connection import Listener, Client
+
+from parselab.frontier import BloomFilter, get_digest
+
+__all__ = ['Coordinator', 'RemoteFrontier', 'get_shard', 'run_worker']
+
+logger = logging.getLogger(__name__)
+
+# Number of shards, one for each directory FileCache.get_cached_filename() puts pages to
+SHARDS = 256
+
+def get_shard(url):
+    """
+    Returns shard of url, which is the first byte of its md5 hash, the
+    same prefix which names cache directory of the page
+    """
+    return int(hashlib.md5(url.encode('utf-8')).hexdigest()[0:2], 16)
+
+def is_loopback(address):
+    """
+    Checks whether address of listener can be reached only from this
+    machine, addresses which are not tuples are Unix sockets
+    """
+    if not isinstance(address, tuple):
+        return True
+    if address[0] == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(address[0]).is_loopback
+    except ValueError:
+        return False
+
+class Coordinator(object):
+    """
+    Hands out URLs to workers which connect to address, every worker
+    owns a disjoint set of shards, so workers never download pages into
+    the same cache directory. Pages found by workers are queued to the
+    shards they belong to, results are passed to on_result(url, result)
+    or kept in results, and errors are kept in failures. When a worker
+    disconnects or does not respond for timeout seconds its shards are
+    given to the others and its unfinished URLs are queued again. Seen
+    URLs are remembered by a Bloom filter, so memory doesn't grow with the
+    crawl, about seen_error_rate of new URLs are taken for seen ones and
+    skipped while there are less than seen_capacity of them.
+
+    Workers send pickled messages, so only those which know authkey are
+    accepted. It's required unless address is loopback, then a random
+    one is generated, workers take it from authkey attribute.
+    """
+
+    def __init__(self, address=('127.0.0.1', 0), authkey=None, timeout=600, on_result=None,
+                 seen_capacity=10000000, seen_error_rate=1e-6):
+        if authkey is None:
+            if not is_loopback(address):
+                raise ValueError('authkey is required to listen on %s:%s' % address)
+            authkey = os.urandom(32)
+        self.authkey = authkey
+        self.listener = Listener(address, authkey=authkey)
+        self.address = self.listener.address
+        self.timeout = timeout
+        self.on_result = on_result
+        self.results = dict()
+        self.failures = dict()
+        self.queues = [[] for i in range(SHARDS)]
+        self.seen = BloomFilter(seen_capacity, seen_error_rate)
+        self.seq = 0
+        self.finished = 0
+        # Queue items given to workers, by worker and URL
+        self.active = dict()
+        self.owners = [None] * SHARDS
+        self.next_worker_id = 0
+        self.lock = threading.Condition()
+        self.thread = None
+        self.closed = False
+
+    def add(self, url, priority=0):
+        return self.add_many([url], priority) == 1
+
+    def add_many(self, urls, priority=0):
+        added = 0
+        with self.lock:
+            for url in urls:
+                digest = get_digest(url)
+                if digest in self.seen:
+                    continue
+                self.seen.add(digest)
+                self.seq += 1
+                heapq.heappush(self.queues[get_shard(url)], (priority, self.seq, url))
+                added += 1
+            self.lock.notify_all()
+        return added
+
+    def start(self):
+        self.thread = threading.Thread(target=self.accept)
+        self.thread.daemon = True
+        self.thread.start()
+        logger.info('Coordinator is listening on %s:%s' % self.address)
+
+    def accept(self):
+        while not self.closed:
+            try:
+                conn = self.listener.accept()
+            except (OSError, EOFError):
+                if self.closed:
+                    break
+                logger.exception('Could not accept worker connection')
+                continue
+            thread = threading.Thread(target=self.serve, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def rebalance(self):
+        workers = sorted(self.active)
+        for shard in range(SHARDS):
+            self.owners[shard] = workers[shard % len(workers)] if workers else None
+        logger.info('Shards are distributed between %s workers' % len(workers))
+
+    def add_worker(self):
+        with self.lock:
+            worker_id = self.next_worker_id
+            self.next_worker_id += 1
+            self.active[worker_id] = dict()
+            self.rebalance()
+            return worker_id
+
+    def remove_worker(self, worker_id):
+        with self.lock:
+            items = self.active.pop(worker_id)
+            if items:
+                logger.warning('Worker %s is lost, queueing its %s URLs again' % (worker_id, len(items)))
+            for url, item in items.items():
+                heapq.heappush(self.queues[get_shard(url)], item)
+            self.rebalance()
+            self.lock.notify_all()
+
+    def pop_many(self, worker_id, count):
+        """
+        Returns URLs from shards of worker, an empty list if the crawl is
+        finished or None if worker has to wait for URLs from others
+        """
+        with self.lock:
+            shards = [queue for shard, queue in enumerate(self.queues) if self.owners[shard] == worker_id]
+            urls = []
+            while len(urls) < count:
+                queue = min((queue for queue in shards if queue), key=lambda queue: queue[0], default=None)
+                if queue is None:
+                    break
+                item = heapq.heappop(queue)
+                self.active[worker_id][item[2]] = item
+                urls.append(item[2])
+            if urls:
+                return urls
+            if self.is_finished():
+                return []
+            return None
+
+    def is_finished(self):
+        return not any(self.queues) and not any(self.active.values())
+
+    def done(self, worker_id, url, result):
+        with self.lock:
+            self.active[worker_id].pop(url, None)
+            self.finished += 1
+            if self.on_result is None:
+                self.results[url] = result
+            self.lock.notify_all()
+        if self.on_result is not None:
+            self.on_result(url, result)
+
+    def failed(self, worker_id, url, error):
+        with self.lock:
+            self.active[worker_id].pop(url, None)
+            self.failures[url] = error
+            self.lock.notify_all()
+
+    def serve(self, conn):
+        worker_id = self.add_worker()
+        logger.info('Worker %s connected' % worker_id)
+        try:
+            while True:
+                if not conn.poll(self.timeout):
+                    logger.warning('Worker %s does not respond' % worker_id)
+                    break
+                message = conn.recv()
+                command, args = message[0], message[1:]
+                if command == 'add':
+                    conn.send(self.add_many(*args))
+                elif command == 'pop':
+                    conn.send(self.pop_many(worker_id, *args))
+                elif command == 'done':
+                    self.done(worker_id, *args)
+                    conn.send(None)
+                elif command == 'failed':
+                    self.failed(worker_id, *args)
+                    conn.send(None)
+                elif command == 'bye':
+                    conn.send(None)
+                    break
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+            self.remove_worker(worker_id)
+            logger.info('Worker %s disconnected' % worker_id)
+
+    def join(self, timeout=None):
+        """
+        Waits until all URLs are processed, returns False on timeout
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.lock:
+            while not self.is_finished():
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.lock.wait(remaining)
+        return True
+
+    def get_stats(self):
+        with self.lock:
+            return {'pending': sum(len(queue) for queue in self.queues),
+                    'active': sum(len(items) for items in self.active.values()),
+                    'done': self.finished, 'failed': len(self.failures), 'workers': len(self.active)}
+
+    def close(self):
+        self.closed = True
+        self.listener.close()
+
+class RemoteFrontier(object):
+    """
+    Frontier of a worker which gets URLs from Coordinator, so
+    BasicParser.crawl() runs as a worker of sharded crawl
+    """
+
+    # Seconds to wait before asking for URLs again
+    poll_interval = 0.1
+
+    def __init__(self, address, authkey):
+        self.conn = Client(tuple(address), authkey=authkey)
+        self.lock = threading.Lock()
+
+    def call(self, *message):
+        with self.lock:
+            self.conn.send(message)
+            return self.conn.recv()
+
+    def add(self, url, priority=0):
+        return self.call('add', [url], priority) == 1
+
+    def add_many(self, urls, priority=0):
+        return self.call('add', list(urls), priority)
+
+    def pop_many(self, count):
+        while True:
+            urls = self.call('pop', count)
+            if urls is not None:
+                return urls
+            time.sleep(self.poll_interval)
+
+    def pop(self):
+        urls = self.pop_many(1)
+        return urls[0] if urls else None
+
+    def done(self, url, result=None):
+        self.call('done', url, result)
+
+    def failed(self, url, error=None):
+        self.call('failed', url, None if error is None else repr(error))
+
+    def checkpoint(self):
+        pass
+
+    def close(self):
+        self.call('bye')
+        self.conn.close()
+
+def run_worker(parser, callback, address, authkey, binary=False, max_workers=1, batch_size=100):
+    """
+    Runs parser.crawl() as a worker of Coordinator listening on address,
+    authkey is the one of Coordinator
+    """
+    parser.frontier = RemoteFrontier(address, authkey)
+    try:
+        parser.crawl(callback, binary=binary, max_workers=max_workers, batch_size=batch_size)
+    finally:
+        parser.frontier.close()
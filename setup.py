@@ -24,5 +24,6 @@ setup(name="parselab",
       maintainer_email="pensnarik@gmail.com",
       url="http://parselab.ru",
       packages=['parselab'],
-      install_requires=["psycopg2", "requests", "requests[socks]"]
+      install_requires=["psycopg2", "requests", "requests[socks]"],
+      extras_require={"async": ["aiohttp"]}
 )
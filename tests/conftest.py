@@ -0,0 +1,12 @@
+import psycopg2
+
+import pytest
+
+from tests.fakedb import RecordingConnection
+
+
+@pytest.fixture
+def connection(monkeypatch):
+    connection = RecordingConnection()
+    monkeypatch.setattr(psycopg2, 'connect', lambda dsn: connection)
+    return connection
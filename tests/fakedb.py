@@ -0,0 +1,166 @@
+# -*- encoding: utf-8 -*-
+"""
+Stand-in for psycopg2 connections which builds statements as psycopg2
+does and records them instead of sending them to PostgreSQL. It's used
+by tests and by the database benchmark.
+"""
+
+import contextlib
+
+import psycopg2
+import psycopg2.extensions
+
+
+class Row(tuple):
+    """
+    Row which is also a dictionary of the columns ParsingDatabase reads by name
+    """
+
+    columns = {'id': 1, 'already_exists': True, 'conflict_url': None}
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.columns[key]
+        return tuple.__getitem__(self, key)
+
+
+# Result of every query in the benchmark
+ROWS = [Row((1, 1))]
+
+
+class RecordingCursor(object):
+
+    def __init__(self, connection, name=None):
+        self.connection = connection
+        self.name = name
+        self.itersize = 2000
+        self.rows = []
+
+    def mogrify(self, query, args):
+        if isinstance(query, str):
+            query = query.encode('utf-8')
+        if isinstance(args, dict):
+            return query % dict((key.encode('utf-8'), psycopg2.extensions.adapt(arg).getquoted())
+                                for key, arg in args.items())
+        return query % tuple(psycopg2.extensions.adapt(arg).getquoted() for arg in args)
+
+    def execute(self, query, params=None):
+        connection = self.connection
+        if connection.broken:
+            connection.closed = 2
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+        if params is not None:
+            query = self.mogrify(query, params)
+        if connection.failing is not None and connection.failing in as_text(query):
+            raise psycopg2.DataError('invalid input syntax')
+        if not connection.autocommit or as_text(query).lstrip().startswith('begin'):
+            connection.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+        elif as_text(query).lstrip().startswith(('commit', 'rollback')):
+            connection.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        connection.record(query)
+        self.rows = connection.results.pop(0) if connection.results else connection.rows
+
+    def copy_expert(self, query, file, size=8192):
+        self.connection.record(query)
+        chunks = []
+        while True:
+            chunk = file.read(size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            self.connection.bytes += len(chunk)
+        self.connection.copies.append(b''.join(chunks).decode('utf-8'))
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def __iter__(self):
+        # Named cursor fetches rows in batches of itersize
+        for i in range(0, len(self.rows), self.itersize):
+            self.connection.fetches.append(len(self.rows[i:i + self.itersize]))
+            for row in self.rows[i:i + self.itersize]:
+                yield row
+
+    def close(self):
+        if self.name is not None:
+            self.connection.cursors_closed += 1
+
+
+class RecordingConnection(object):
+    """
+    Records statements and COPY data. Queries return rows of results in
+    order they were added, and rows when results are exhausted. Setting
+    broken makes queries fail with a connection error, and failing makes
+    queries which contain it fail with a data error.
+    """
+
+    encoding = 'UTF8'
+
+    def __init__(self, dsn=None, rows=()):
+        self.dsn = dsn
+        self.rows = list(rows)
+        self.results = []
+        self.queries = []
+        self.copies = []
+        self.bytes = 0
+        self.autocommit = False
+        self.closed = 0
+        self.broken = False
+        self.failing = None
+        self.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        self.fetches = []
+        self.cursors_closed = 0
+
+    @property
+    def statements(self):
+        # Queries are normalized on access, so recording doesn't slow the benchmark down
+        return [' '.join(as_text(query).split()) for query in self.queries]
+
+    def record(self, query):
+        self.queries.append(query)
+        self.bytes += len(query)
+
+    @property
+    def info(self):
+        # psycopg2.pool reads info.transaction_status
+        return self
+
+    def get_transaction_status(self):
+        return self.transaction_status
+
+    def set_isolation_level(self, level):
+        self.autocommit = True
+
+    def cursor(self, name=None, cursor_factory=None):
+        return RecordingCursor(self, name)
+
+    def commit(self):
+        self.record('commit')
+        self.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def rollback(self):
+        self.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = self.closed or 1
+
+
+def as_text(query):
+    return query.decode('utf-8') if isinstance(query, bytes) else query
+
+
+@contextlib.contextmanager
+def recording_connection():
+    """
+    Makes psycopg2.connect() return RecordingConnection in the block
+    """
+    connection = RecordingConnection(rows=ROWS)
+    connect = psycopg2.connect
+    psycopg2.connect = lambda *args, **kwargs: connection
+    try:
+        yield connection
+    finally:
+        psycopg2.connect = connect
@@ -0,0 +1,107 @@
+import time
+import asyncio
+import threading
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+import pytest
+
+pytest.importorskip('aiohttp')
+
+from parselab.aionetwork import AsyncNetworkManager
+from parselab.cache import FileCache
+from parselab.network import PageNotFound
+from parselab.parsing import BasicParser
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    active = 0
+    max_active = 0
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        server.active += 1
+        server.max_active = max(server.max_active, server.active)
+        time.sleep(0.05)
+        server.active -= 1
+        if self.path.startswith('/404'):
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = (u'<html>%s</html>' % self.path).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+
+
+class Parser(BasicParser):
+
+    def __init__(self, cache):
+        BasicParser.__init__(self)
+        self.cache = cache
+        self.async_net = AsyncNetworkManager(host_concurrency=4)
+
+
+def test_get_page_async(server, tmpdir):
+    base = 'http://127.0.0.1:%s' % server.server_port
+    parser = Parser(FileCache('test', str(tmpdir)))
+    urls = ['%s/%s' % (base, i) for i in range(20)]
+
+    async def run():
+        try:
+            pages = await asyncio.gather(*[parser.get_page_async(url) for url in urls])
+            with pytest.raises(PageNotFound):
+                await parser.get_page_async('%s/404' % base)
+            return pages
+        finally:
+            await parser.async_net.close()
+
+    loop = asyncio.new_event_loop()
+    try:
+        pages = loop.run_until_complete(run())
+    finally:
+        loop.close()
+    assert pages == [u'<html>/%s</html>' % i for i in range(20)]
+    assert 1 < server.max_active <= 4
+    assert parser.cache.get_file(urls[0]) == pages[0]
+    assert parser.cache.get_error_from_cache('%s/404' % base) == 'PageNotFound'
+
+
+def test_reuse_after_close(server):
+    base = 'http://127.0.0.1:%s' % server.server_port
+    net = AsyncNetworkManager(host_concurrency=2)
+
+    async def run(i):
+        try:
+            pages = await asyncio.gather(*[net.download_page('%s/%s/%s' % (base, i, j)) for j in range(4)])
+        finally:
+            await net.close()
+        assert net.session is None and net.semaphore is None and not net.host_semaphores
+        return pages
+
+    for i in range(2):
+        loop = asyncio.new_event_loop()
+        try:
+            assert loop.run_until_complete(run(i)) == [u'<html>/%s/%s</html>' % (i, j) for j in range(4)]
+        finally:
+            loop.close()
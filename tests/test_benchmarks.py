@@ -0,0 +1,28 @@
+# -*- encoding: utf-8 -*-
+import requests
+
+from parselab.network import NetworkManager
+
+from benchmarks import suite
+from benchmarks.stub import StubServer
+
+
+def test_stub_server():
+    with StubServer(size=1000) as server:
+        net = NetworkManager()
+        page = net.download_page(server.get_url('/p/1?charset=cp1251&declare=meta'))
+        assert page.startswith('<html><head><meta charset="cp1251">')
+        assert page == net.download_page(server.get_url('/p/1?charset=koi8-r&declare=meta')).replace(
+            'koi8-r', 'cp1251')
+        assert requests.get(server.get_url('/missing?status=404')).status_code == 404
+
+
+def test_suite():
+    report = suite.run(['database', 'unhtml'], quick=True)
+    assert set(report['results']) == {'database', 'unhtml'}
+    assert report['results']['database']['row_by_row']['statements_per_product'] > 1
+
+    baseline = {'results': {'database': {'row_by_row': {'statements_per_product': 1, 'products_s': 1}}}}
+    assert suite.compare(report, baseline) == [
+        ('database.row_by_row.statements_per_product', 1, report['results']['database']['row_by_row']
+         ['statements_per_product'])]
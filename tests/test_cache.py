@@ -0,0 +1,101 @@
+import os
+
+import pytest
+
+from parselab.cache import FileCache, MemoryCache
+from parselab.network import PageNotFound
+
+from tests.helpers import Response
+
+
+def test_write_and_read(tmpdir):
+    cache = FileCache('test', str(tmpdir))
+    cache.write_to_cache('http://example.com/', '<html></html>')
+    cache.write_to_cache('http://example.com/a.png', Response(b'\x89PNG' * 1000), binary=True)
+
+    assert cache.is_in_cache('http://example.com/')
+    assert not cache.is_in_cache('http://example.com/missing')
+    assert cache.get_file('http://example.com/') == '<html></html>'
+    assert cache.get_file('http://example.com/a.png', binary=True) == b'\x89PNG' * 1000
+
+
+def test_errors(tmpdir):
+    cache = FileCache('test', str(tmpdir))
+    cache.save_error_in_cache('http://example.com/404', 'PageNotFound')
+    assert cache.is_in_cache_error('http://example.com/404')
+    with pytest.raises(PageNotFound):
+        cache.get_file('http://example.com/404')
+
+
+@pytest.mark.parametrize('codec', ['zlib', 'gzip'])
+def test_compression(tmpdir, codec):
+    page = u'<html>%s</html>' % (u'<p>Привет</p>' * 1000)
+    cache = FileCache('test', str(tmpdir), codec=codec)
+    cache.write_to_cache('http://example.com/', page)
+    cache.write_to_cache('http://example.com/a.bin', Response(os.urandom(100000)), binary=True)
+
+    assert os.path.getsize(cache.get_cached_filename('http://example.com/')) < len(page) / 10
+    assert cache.get_file('http://example.com/') == page
+    binary = cache.get_file('http://example.com/a.bin', binary=True)
+    assert b''.join(cache.iter_file('http://example.com/a.bin', chunk_size=1000)) == binary
+
+
+def test_mixed_legacy_and_compressed_entries(tmpdir):
+    FileCache('test', str(tmpdir)).write_to_cache('http://example.com/old', 'old page')
+    cache = FileCache('test', str(tmpdir), codec='zlib')
+    cache.write_to_cache('http://example.com/new', 'new page')
+
+    assert cache.get_file('http://example.com/old') == 'old page'
+    assert cache.get_file('http://example.com/new') == 'new page'
+    assert FileCache('test', str(tmpdir)).get_file('http://example.com/new') == 'new page'
+
+
+def test_memory_cache(tmpdir):
+    backend = FileCache('test', str(tmpdir))
+    cache = MemoryCache(backend, max_entries=2)
+    for i in range(3):
+        cache.write_to_cache('http://example.com/%s' % i, 'page %s' % i)
+
+    assert cache.get_file('http://example.com/2') == 'page 2'
+    assert cache.get_file('http://example.com/0') == 'page 0'
+    assert cache.get_stats() == {'hits': 1, 'misses': 1, 'evictions': 2, 'entries': 2,
+                                 'bytes': cache.size}
+    assert cache.get_cached_filename('http://example.com/0') == \
+        backend.get_cached_filename('http://example.com/0')
+
+    cache.remove_from_cache('http://example.com/0')
+    assert not cache.is_in_cache('http://example.com/0')
+
+
+def test_memory_cache_size_bound(tmpdir):
+    cache = MemoryCache(FileCache('test', str(tmpdir)), max_bytes=10000)
+    for i in range(10):
+        cache.write_to_cache('http://example.com/%s' % i, 'x' * 3000)
+    assert cache.size <= 10000
+    assert len(cache.entries) == 3
+
+
+@pytest.mark.parametrize('codec', [None, 'zlib'])
+def test_get_buffer(tmpdir, codec):
+    content = os.urandom(300000)
+    cache = FileCache('test', str(tmpdir), codec=codec)
+    cache.write_to_cache('http://example.com/a.bin', Response(content), binary=True)
+
+    buf = cache.get_buffer('http://example.com/a.bin')
+    assert isinstance(buf, memoryview)
+    assert buf.tobytes() == content
+
+
+def test_interrupted_write_is_not_visible(tmpdir):
+    class BrokenResponse(Response):
+        def iter_content(self, chunk_size=1):
+            yield b'partial'
+            raise IOError('Connection reset')
+
+    cache = FileCache('test', str(tmpdir))
+    with pytest.raises(IOError):
+        cache.write_to_cache('http://example.com/a.bin', BrokenResponse(b''), binary=True)
+
+    assert not cache.is_in_cache('http://example.com/a.bin')
+    directory = os.path.dirname(cache.get_cached_filename('http://example.com/a.bin'))
+    assert os.listdir(directory) == []
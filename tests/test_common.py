@@ -0,0 +1,43 @@
+# -*- encoding: utf-8 -*-
+import html
+import random
+
+from functools import reduce
+
+from parselab.common import unhtml, iter_unhtml, unhtml_map, LRUDict
+
+
+def legacy_unhtml(s):
+    return reduce(lambda x, y: x.replace(y, unhtml_map[y]), unhtml_map, s)
+
+
+def test_unhtml():
+    assert unhtml(u'&laquo;Кабель&raquo; 5&nbsp;м &copy;\r\n') == u'"Кабель" 5 м (c)'
+    # '&amp;' is replaced before '&lt;' but after '&quot;'
+    assert unhtml('&amp;lt;b&amp;gt; &amp;quot;') == '<b> &quot;'
+    # Line breaks are removed before '&#124;' is replaced, but after '&lt;'
+    assert unhtml('&#12\n4; &l\nt;') == '| &lt;'
+    assert unhtml('&eacute; &amp;eacute;', full=True) == u'é é'
+
+
+def test_unhtml_matches_legacy():
+    rnd = random.Random(0)
+    pieces = list(unhtml_map) + ['&', 'amp;', '#', '12', '4;', 'lt;', 'copy;', 'x3a;', ' ', 'eacute;']
+    for i in range(20000):
+        s = ''.join(rnd.choice(pieces) for _ in range(rnd.randint(0, 10)))
+        assert unhtml(s) == legacy_unhtml(s)
+        assert unhtml(s, full=True) == html.unescape(legacy_unhtml(s))
+
+        cuts = sorted(rnd.sample(range(len(s) + 1), min(len(s) + 1, 3)))
+        chunks = [s[a:b] for a, b in zip([0] + cuts, cuts + [len(s)])]
+        assert ''.join(iter_unhtml(chunks)) == legacy_unhtml(s)
+        assert ''.join(iter_unhtml(chunks, full=True)) == unhtml(s, full=True)
+
+
+def test_lru_dict():
+    d = LRUDict(2)
+    d['a'], d['b'] = 1, 2
+    assert d.get('a') == 1
+    d['c'] = 3
+    assert 'b' not in d and len(d) == 2
+    assert d.get('b', 0) == 0 and d['a'] == 1
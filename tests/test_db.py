@@ -0,0 +1,425 @@
+import re
+import time
+import logging
+import threading
+
+import psycopg2
+
+import pytest
+
+from concurrent.futures import ThreadPoolExecutor
+
+from tests.fakedb import RecordingConnection
+from parselab.db import DatabaseHandler
+from parselab.parsing import ParsingDatabase, BufferedParsingDatabase
+
+
+def test_buffered_writes(connection):
+    db = BufferedParsingDatabase(batch_size=5, flush_interval=3600)
+    db.connect('dbname=test')
+    db.project_id = 1
+
+    db.add_product_to_category(10, 100)
+    db.add_product_to_category(10, 101)
+    db.queue_attribute_value(10, 5, 42)
+    db.queue_product_image(10, 'http://example.com/1.jpg', 0)
+    assert connection.statements == []
+
+    db.add_product_option(10, 7)
+    assert len(connection.statements) == 4
+    assert 'from (values (1,10,100),(1,10,101)) as v' in connection.statements[0]
+    assert "(1,10,5,'42',0)" in connection.statements[1]
+
+    db.queue_product_description(10, 'text')
+    db.close()
+    assert 'set_product_description' in connection.statements[-1]
+
+
+def test_buffered_methods_return_ids(connection):
+    db = BufferedParsingDatabase(batch_size=1000, flush_interval=3600)
+    db.connect('dbname=test')
+    db.project_id = 1
+    connection.rows = [(42,)]
+
+    db.add_product_to_category(10, 100)
+    # Queued rows are written first, then the row whose ID is returned
+    assert db.add_product_image(10, 'http://example.com/1.jpg', 0) == 42
+    assert 'from (values (1,10,100)) as v' in connection.statements[0]
+    assert connection.statements[1].startswith('select public.set_product_image(1, 10, ')
+    assert db.set_attribute_value(10, 5, 'red') == 42
+    assert db.set_product_description(10, 'text') == 42
+    assert len(connection.statements) == 4
+
+
+def test_flush_by_time(connection):
+    db = BufferedParsingDatabase(batch_size=1000, flush_interval=0)
+    db.connect('dbname=test')
+    db.project_id = 1
+    db.add_product_to_category(10, 100)
+    assert len(connection.statements) == 1
+
+
+def test_flush_failed_batch(connection):
+    db = BufferedParsingDatabase(batch_size=1000, flush_interval=3600, page_size=2)
+    db.connect('dbname=test')
+    db.project_id = 1
+    for product_id in range(3):
+        db.add_product_to_category(product_id, 100)
+    db.add_product_option(10, 7)
+    connection.failing = 'product_category'
+    with pytest.raises(psycopg2.DataError):
+        db.flush()
+    # Pages of the batch are written in one transaction, which is rolled back
+    assert connection.statements == ['begin', 'rollback', 'select public.add_product_option(v.project_id, '
+                                     'v.product_id, v.option_id) from (values (1,10,7)) as v (project_id, '
+                                     'product_id, option_id)']
+
+    connection.failing = None
+    db.add_product_to_category(3, 100)
+    db.flush()
+    assert 'from (values (1,3,100)) as v' in connection.statements[-1]
+
+
+def test_flush_in_background(monkeypatch):
+    connections = []
+
+    def connect(dsn):
+        connections.append(RecordingConnection(dsn))
+        return connections[-1]
+
+    monkeypatch.setattr(psycopg2, 'connect', connect)
+    db = BufferedParsingDatabase(batch_size=1000, flush_interval=0.05)
+    db.connect('dbname=test', maxconn=2)
+    db.project_id = 1
+    db.add_product_to_category(10, 100)
+    time.sleep(0.3)
+    assert len([s for conn in connections for s in conn.statements]) == 1
+    db.close()
+    assert not db.flusher
+
+
+def test_buffered_writes_from_threads(connection):
+    db = BufferedParsingDatabase(batch_size=7, flush_interval=3600)
+    db.connect('dbname=test')
+    db.project_id = 1
+
+    def add(first):
+        for product_id in range(first, first + 250):
+            db.add_product_to_category(product_id, 100)
+
+    with ThreadPoolExecutor(4) as executor:
+        list(executor.map(add, range(0, 1000, 250)))
+    db.close()
+    rows = re.findall(r'\(1,(\d+),100\)', ' '.join(connection.statements))
+    assert sorted(int(row) for row in rows) == list(range(1000))
+
+
+def test_bulk_load(connection):
+    db = ParsingDatabase()
+    db.connect('dbname=test')
+    db.project_id = 1
+
+    loader = db.bulk_loader(spool_size=64)
+    loader.add_category('Cables')
+    for i in range(10):
+        loader.add_product('SKU%s' % i, 'Cable\t"%s"\n' % i, 'http://example.com/%s' % i, price=1.5)
+        loader.add_product_to_category('http://example.com/%s' % i, 100)
+    connection.results = [[]] * 5 + [[{'conflict_url': None}]] + [[]] * 4 + [[('http://example.com/0', 10)]]
+    assert loader.load() == {'http://example.com/0': 10}
+
+    assert connection.statements[0] == 'begin'
+    assert connection.statements[-1] == 'commit'
+    assert 'copy bulk_product from stdin' in connection.statements
+    assert len(connection.copies) == 3
+    assert connection.copies[0] == 'Cables\t\\N\t\\N\n'
+    assert connection.copies[1].splitlines()[0] == 'SKU0\tCable\\t"0"\\n\thttp://example.com/0\t\\N\t1.5'
+    assert not any('bulk_attribute_value' in s for s in connection.statements)
+
+
+def test_bulk_load_sku_conflict(connection):
+    db = ParsingDatabase()
+    db.connect('dbname=test')
+    db.project_id = 1
+
+    loader = db.bulk_loader()
+    loader.add_product('SKU1', 'Cable', 'http://example.com/new')
+    connection.results = [[], [], [], [{'sku': 'SKU1', 'url': 'http://example.com/new',
+                                         'conflict_url': 'http://example.com/1'}]]
+    with pytest.raises(Exception) as e:
+        loader.load()
+    assert 'existing URL http://example.com/1' in str(e.value)
+    assert not any(s.startswith('insert into public.product ') for s in connection.statements)
+    assert connection.statements[-1] == 'rollback'
+
+
+def test_bulk_load_matched_by_name(connection):
+    db = ParsingDatabase()
+    db.connect('dbname=test')
+    db.project_id = 1
+
+    # Existing product named Cable has another URL, it gets the category and is returned
+    loader = db.bulk_loader()
+    loader.add_product(None, 'Cable', 'http://example.com/new')
+    loader.add_product_to_category('http://example.com/new', 100)
+    connection.results = [[]] * 3 + [[{'conflict_url': None}]] + [[]] * 4 + [[('http://example.com/new', 10)]]
+    assert loader.load() == {'http://example.com/new': 10}
+
+    mapping = [s for s in connection.statements if s.startswith('insert into bulk_product_id')][0]
+    assert 'when s.manufacturer_id is not null then p.name = s.name and p.manufacturer_id = s.manufacturer_id ' \
+           'else p.name = s.name end' in mapping
+    merge = [s for s in connection.statements if s.startswith('insert into public.product_category')][0]
+    assert 'left join bulk_product_id m on m.url = s.url' in merge
+    assert 'when m.url is not null then p.id = m.product_id else p.url = s.url' in merge
+    assert connection.statements.index(mapping) < connection.statements.index(merge)
+    assert 'select url, product_id from bulk_product_id' in connection.statements
+
+
+def test_connection_block_not_retried(connection):
+    db = ParsingDatabase()
+    db.connect('dbname=test')
+
+    with pytest.raises(psycopg2.OperationalError):
+        with db.connection():
+            db.execute('begin', None)
+            connection.broken = True
+            db.execute('insert into public.product_option values (1, 2)', None)
+    assert connection.statements == ['begin']
+
+    connection.broken = False
+    connection.closed = 0
+    db.execute('select 1', None)
+    assert connection.statements == ['begin', 'select 1']
+
+
+def test_execute_cursor(connection):
+    db = ParsingDatabase()
+    db.connect('dbname=test')
+    connection.results = [[(1,)]]
+
+    with pytest.warns(DeprecationWarning):
+        assert db.execute_cursor(None, 'select %s', (1,)) == [(1,)]
+    with pytest.warns(DeprecationWarning):
+        assert db.execute_cursor(None, 'select 2', fetch=False) is None
+    assert connection.statements == ['select 1', 'select 2']
+
+
+def test_set_bulk_attribute_value(connection):
+    db = ParsingDatabase()
+    db.connect('dbname=test')
+    db.project_id = 1
+
+    db.set_bulk_attribute_value([(10, 5, "it's", 0)])
+    assert connection.copies == ["10\t5\tit's\t0\n"]
+    assert 'select public.set_bulk_attribute_value(1, array(select row(s.*)::t_attribute_value ' \
+           'from bulk_attribute_value s))' in connection.statements
+
+
+def test_id_cache(connection):
+    db = ParsingDatabase(id_cache_size=2)
+    db.connect('dbname=test')
+    connection.results = [[(1,)], [('Cables', None, 100), ('USB', 100, 101)], [('Size', 5)], []]
+    db.setup_project('test')
+    statements = len(connection.statements)
+
+    assert db.get_category_id('USB', 100) == 101
+    assert db.get_attribute_category_id('Size') == 5
+    assert len(connection.statements) == statements
+
+    connection.results = [[(7,)]]
+    assert db.get_manufacturer_id('Acme') == 7
+    assert db.get_manufacturer_id('Acme') == 7
+    assert len(connection.statements) == statements + 1
+
+    db.reconnect()
+    assert db.get_manufacturer_id('Acme') == 7
+    assert len(connection.statements) == statements + 1
+    connection.results = [[(102,)]]
+    assert db.get_category_id('HDMI', 100) == 102
+    # Only two recently used categories are kept
+    assert ('Cables', None) not in db.cache['categories']
+    assert ('USB', 100) in db.cache['categories']
+
+
+def test_get_product_id(connection):
+    db = ParsingDatabase()
+    db.connect('dbname=test')
+    db.project_id = 1
+
+    connection.results = [[{'id': 10, 'already_exists': False, 'conflict_url': None}]]
+    assert db.get_product_id('Cable', (100, 101), 'SKU1', 'http://example.com/1') == (10, False)
+    assert len(connection.statements) == 1
+    assert 'unnest(ARRAY[100,101]::bigint[])' in connection.statements[0]
+
+    connection.results = [[{'id': None, 'already_exists': None, 'conflict_url': 'http://example.com/2'}]]
+    with pytest.raises(Exception, match='existing URL http://example.com/2'):
+        db.get_product_id('Cable', [], 'SKU1', 'http://example.com/1')
+
+
+def test_pool(monkeypatch):
+    connections = []
+
+    def connect(dsn):
+        connections.append(RecordingConnection(dsn))
+        return connections[-1]
+
+    monkeypatch.setattr(psycopg2, 'connect', connect)
+    db = ParsingDatabase()
+    db.connect('dbname=test', minconn=2, maxconn=4, prepare=True)
+    db.project_id = 1
+
+    def add_options(product_id):
+        for option_id in range(10):
+            db.add_product_option(product_id, option_id)
+
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(add_options, range(8)))
+    statements = [s for conn in connections for s in conn.statements]
+    assert len([s for s in statements if s.startswith('execute add_product_option')]) == 80
+    prepared = [s for s in statements if s.startswith('prepare')]
+    assert prepared[0] == 'prepare add_product_option as select public.add_product_option($1, $2, $3)'
+    assert len(prepared) <= len(connections) <= 4
+
+    for conn in connections:
+        conn.broken = not conn.closed
+    count = len(connections)
+    db.add_product_option(1, 2)
+    assert len(connections) == count + 1
+    assert connections[-1].statements == ['prepare add_product_option as select public.add_product_option($1, $2, $3)',
+                                          'execute add_product_option (1, 1, 2)']
+    db.close()
+
+
+def test_iter_query(connection):
+    db = ParsingDatabase()
+    db.connect('dbname=test')
+    connection.results = [[(i, 'product %s' % i) for i in range(25)], [(42,)]]
+
+    rows = db.iter_query('select id, name from public.product where project_id = %s', [1], fetch_size=10)
+    assert next(rows) == (0, 'product 0')
+    assert not connection.autocommit
+    assert [row[0] for row in rows] == list(range(1, 25))
+    assert connection.fetches == [10, 10, 5]
+    assert connection.statements[-1] == 'commit'
+    assert connection.autocommit
+
+    assert db.query_value('select 42') == 42
+
+
+def test_nested_iter_query(connection):
+    db = ParsingDatabase()
+    db.connect('dbname=test')
+    connection.results = [[(1,), (2,)], [(3,)], [(3,)]]
+    pairs = [(a[0], b[0]) for a in db.iter_query('select 1') for b in db.iter_query('select 3')]
+    assert pairs == [(1, 3), (2, 3)]
+    # Iterations read through the shared connection, only the outer one commits
+    assert connection.statements.count('commit') == 1
+    assert connection.cursors_closed == 3
+    assert connection.autocommit
+
+    with db.connection():
+        db.execute('begin', None)
+        connection.results = [[(1,), (2,)]]
+        assert [row[0] for row in db.iter_query('select 1')] == [1, 2]
+        # Transaction of the block is not ended by the iteration
+        assert connection.statements[-2:] == ['begin', 'select 1']
+        assert connection.autocommit
+
+
+def test_interleaved_iter_query(monkeypatch):
+    connections = []
+
+    def connect(dsn):
+        connections.append(RecordingConnection(dsn, rows=[(1,), (2,), (3,)]))
+        return connections[-1]
+
+    monkeypatch.setattr(psycopg2, 'connect', connect)
+    db = ParsingDatabase()
+    db.connect('dbname=test', maxconn=2)
+    first = db.iter_query('select 1')
+    second = db.iter_query('select 2')
+    assert (next(first), next(second)) == ((1,), (1,))
+    # The first one to end doesn't commit nor return the connection, the other one still reads
+    assert list(first) == [(2,), (3,)]
+    conn = connections[0]
+    assert 'commit' not in conn.statements and db.is_held()
+    assert list(second) == [(2,), (3,)]
+    assert conn.statements.count('commit') == 1 and conn.autocommit
+    assert not db.is_held() and len(connections) == 1
+
+
+class SlowDatabase(object):
+
+    def __init__(self):
+        self.rows = []
+        self.statements = 0
+        self.ready = threading.Event()
+
+    def execute_values(self, query, rows, template=None, page_size=100):
+        self.ready.wait()
+        self.rows.extend(rows)
+        self.statements += 1
+
+
+def test_log_handler(monkeypatch):
+    connections = []
+
+    def connect(dsn):
+        connections.append(RecordingConnection(dsn))
+        return connections[-1]
+
+    monkeypatch.setattr(psycopg2, 'connect', connect)
+    db = ParsingDatabase()
+    db.connect('dbname=test')
+    handler = DatabaseHandler(db, batch_size=100, flush_interval=3600)
+    logger = logging.getLogger('test_log_handler')
+    logger.addHandler(handler)
+    try:
+        for i in range(3):
+            logger.warning('Page %s', i)
+        handler.close()
+    finally:
+        logger.removeHandler(handler)
+    # Connection of db is not shared with the writing thread
+    assert len(connections) == 2
+    assert connections[0].statements == []
+    assert len(connections[1].statements) == 1
+    assert "('Page 0','test_db','warning','')" in connections[1].statements[0]
+    assert connections[1].closed
+
+
+def test_log_handler_overflow():
+    db = SlowDatabase()
+    handler = DatabaseHandler(db, batch_size=1, flush_interval=0, capacity=2)
+    logger = logging.getLogger('test_log_handler_overflow')
+    logger.addHandler(handler)
+    try:
+        for i in range(10):
+            logger.warning('Page %s', i)
+        assert handler.dropped >= 7
+        db.ready.set()
+        handler.flush()
+        assert len(db.rows) == 10 - handler.dropped
+        handler.close()
+    finally:
+        logger.removeHandler(handler)
+    assert not handler.thread.is_alive()
+
+
+def test_connect_again(monkeypatch):
+    connections = []
+
+    def connect(dsn):
+        connections.append(RecordingConnection(dsn))
+        connections[-1].dsn = dsn
+        return connections[-1]
+
+    monkeypatch.setattr(psycopg2, 'connect', connect)
+    db = ParsingDatabase()
+    db.connect('dbname=a')
+    db.cache['manufacturers']['Acme'] = 7
+    db.connect('dbname=b')
+    assert connections[0].closed
+    assert len(db.cache['manufacturers']) == 0
+
+    db.reconnect()
+    assert [conn.dsn for conn in connections] == ['dbname=a', 'dbname=b', 'dbname=b']
@@ -0,0 +1,67 @@
+import pytest
+
+from parselab.cache import FileCache
+from parselab.frontier import Frontier
+
+from tests.helpers import Network, Parser
+
+
+def test_priorities_and_dedup(tmpdir):
+    frontier = Frontier(str(tmpdir), capacity=1000)
+    assert frontier.add('http://example.com/b', priority=1)
+    assert frontier.add('http://example.com/a')
+    assert not frontier.add('http://example.com/a', priority=5)
+    assert frontier.add_many(['http://example.com/c', 'http://example.com/b']) == 1
+    assert 'http://example.com/b' in frontier
+    assert 'http://example.com/missing' not in frontier
+    assert len(frontier) == 3
+
+    assert frontier.pop_many(2) == ['http://example.com/a', 'http://example.com/c']
+    assert frontier.pop() == 'http://example.com/b'
+    assert frontier.pop() is None
+
+
+def test_resume(tmpdir):
+    frontier = Frontier(str(tmpdir), capacity=1000)
+    frontier.add_many(['http://example.com/%s' % i for i in range(10)])
+    for url in frontier.pop_many(3):
+        frontier.done(url)
+    frontier.pop()
+    frontier.checkpoint()
+    frontier.add('http://example.com/lost')
+    # Simulate crash: changes after checkpoint are lost
+    frontier.db.close()
+
+    frontier = Frontier(str(tmpdir), capacity=1000)
+    assert frontier.get_stats() == {'pending': 7, 'active': 0, 'done': 3, 'failed': 0}
+    assert frontier.pop() == 'http://example.com/3'
+    assert 'http://example.com/lost' not in frontier
+    frontier.close()
+
+    # Bloom filter is rebuilt when it does not match the database
+    with open(frontier.get_bloom_filename(), 'wb') as f:
+        f.write(b'broken')
+    frontier = Frontier(str(tmpdir), capacity=1000)
+    assert 'http://example.com/0' in frontier
+
+
+def test_crawl(tmpdir):
+    pages = {'http://example.com/': 'http://example.com/1 http://example.com/2',
+             'http://example.com/1': 'http://example.com/2 http://example.com/404',
+             'http://example.com/2': 'http://example.com/'}
+    net = Network(pages)
+    parser = Parser(FileCache('test', str(tmpdir)), net)
+    parser.frontier = Frontier(str(tmpdir.join('frontier')))
+    visited = []
+
+    def callback(url, page):
+        visited.append(url)
+        for link in page.split():
+            parser.enqueue(link)
+
+    parser.crawl(callback, ['http://example.com/'], max_workers=2)
+    assert visited == ['http://example.com/', 'http://example.com/1', 'http://example.com/2']
+    assert parser.frontier.get_stats()['failed'] == 1
+
+    parser.crawl(callback, ['http://example.com/'])
+    assert len(visited) == 3
@@ -0,0 +1,109 @@
+import pytest
+
+from parselab.cache import FileCache
+from parselab.memo import ParseMemo
+
+from tests.helpers import Network, Parser, parse_length
+
+
+def test_call_and_invalidation(tmpdir):
+    memo = ParseMemo(str(tmpdir.join('memo.db')))
+    calls = []
+
+    def parse(url, page):
+        calls.append(url)
+        return {'length': len(page)}
+
+    assert memo.call(parse, 1, 'http://example.com/', 'page') == ({'length': 4}, False)
+    assert memo.call(parse, 1, 'http://example.com/copy', 'page') == ({'length': 4}, True)
+    assert memo.call(parse, 2, 'http://example.com/', 'page') == ({'length': 4}, False)
+    assert memo.call(parse, 1, 'http://example.com/', 'new page') == ({'length': 8}, False)
+    assert len(calls) == 3
+
+    assert memo.invalidate_except(2) == 2
+    assert memo.call(parse, 2, 'http://example.com/', 'page')[1]
+    assert memo.invalidate(version=2) == 1
+    assert memo.get_stats()['entries'] == 0
+
+    memo.close()
+    memo = ParseMemo(str(tmpdir.join('memo.db')))
+    assert not memo.call(parse, 2, 'http://example.com/', 'page')[1]
+
+
+def test_eviction(tmpdir):
+    memo = ParseMemo(str(tmpdir.join('memo.db')), max_entries=10)
+    for i in range(10):
+        memo.put('parse', 1, b'%d' % i, i)
+    memo.touch('parse', 1, [b'0'])
+    memo.put('parse', 1, b'10', 10)
+    assert memo.get_stats()['entries'] == 9
+    assert memo.get('parse', 1, b'0') == (True, 0)
+    assert memo.get('parse', 1, b'1') == (False, None)
+
+    for i in range(20):
+        memo.put('parse', 1, b'0', i)
+    assert memo.get_stats()['entries'] == 9
+    assert memo.get('parse', 1, b'3') == (True, 3)
+
+
+def test_callback_name(tmpdir):
+    memo = ParseMemo(str(tmpdir.join('memo.db')))
+
+    class First(object):
+        def parse(self, url, page):
+            return 1
+
+    class Second(object):
+        def parse(self, url, page):
+            return 2
+
+    assert memo.call(First().parse, 1, 'http://example.com/', 'page') == (1, False)
+    assert memo.call(Second().parse, 1, 'http://example.com/', 'page') == (2, False)
+    assert memo.get_stats()['entries'] == 2
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_replay_with_memo(tmpdir, processes):
+    urls = ['http://example.com/%s' % i for i in range(10)]
+    net = Network(dict((url, 'page %s' % i) for i, url in enumerate(urls)))
+    parser = Parser(FileCache('test', str(tmpdir)), net)
+    parser.memo = ParseMemo(str(tmpdir.join('memo.db')))
+    parser.parser_version = 1
+    for url in urls:
+        parser.get_page(url)
+
+    results = dict()
+    stats = parser.replay(parse_length, processes=processes, on_result=results.__setitem__)
+    assert (stats['pages'], stats['unchanged'], stats['failed']) == (9, 0, 1)
+
+    results.clear()
+    stats = parser.replay(parse_length, processes=processes, on_result=results.__setitem__)
+    assert (stats['pages'], stats['unchanged'], stats['failed']) == (0, 9, 1)
+    assert results == {}
+
+    parser.parser_version = 2
+    stats = parser.replay(parse_length, processes=processes, on_result=results.__setitem__)
+    assert (stats['pages'], stats['unchanged']) == (9, 0)
+    assert len(results) == 9
+
+
+class PicklableParser(Parser):
+
+    def __init__(self, cache, net):
+        Parser.__init__(self, cache, net)
+        # Command line parser can't be pickled
+        del self.parser
+
+
+def test_replay_spawn(tmpdir):
+    urls = ['http://example.com/%s' % i for i in range(10)]
+    parser = PicklableParser(FileCache('test', str(tmpdir)), Network(dict((url, 'page %s' % url) for url in urls)))
+    parser.memo = ParseMemo(str(tmpdir.join('memo.db')))
+    parser.parser_version = 1
+    for url in urls:
+        parser.get_page(url)
+
+    stats = parser.replay(parse_length, processes=2, context='spawn')
+    assert (stats['pages'], stats['unchanged'], stats['failed']) == (9, 0, 1)
+    stats = parser.replay(parse_length, processes=2, context='spawn')
+    assert (stats['pages'], stats['unchanged'], stats['failed']) == (0, 9, 1)
@@ -0,0 +1,85 @@
+import os
+import logging
+
+import pytest
+
+from parselab import metrics
+from parselab.cache import FileCache
+from parselab.parsing import ParsingDatabase
+
+from tests.helpers import Network, Parser
+
+
+@pytest.fixture
+def registry():
+    yield metrics.enable()
+    metrics.disable()
+
+
+def test_disabled():
+    assert metrics.get_metrics() is None
+    metrics.inc('pages')
+    with metrics.timer('parse_seconds'):
+        pass
+
+
+def test_get_page(tmpdir, registry):
+    net = Network({'http://example.com/': 'page'})
+    parser = Parser(FileCache('test', str(tmpdir)), net)
+    for i in range(3):
+        parser.get_page('http://example.com/')
+    parser.cache.save_error_in_cache('http://example.com/404', 'PageNotFound')
+    with pytest.raises(Exception):
+        parser.get_page('http://example.com/404')
+
+    assert registry.get_counter('cache_lookups', result='miss') == 1
+    assert registry.get_counter('cache_lookups', result='hit') == 2
+    assert registry.get_counter('cache_lookups', result='negative') == 1
+    assert registry.get_counter('cache_bytes_read') > 0
+    snapshot = registry.snapshot()
+    assert snapshot['histograms']['fetch_seconds{host="example.com"}']['count'] == 1
+    assert snapshot['histograms']['cache_lookup_seconds']['count'] == 4
+
+
+def test_cache_bytes_written(tmpdir, registry):
+    cache = FileCache('test', str(tmpdir))
+    cache.write_to_cache('http://example.com/', u'Привет')
+    # Text is counted in bytes, not characters
+    size = os.path.getsize(cache.get_cached_filename('http://example.com/'))
+    assert size > len(u'Привет')
+    assert registry.get_counter('cache_bytes_written') == size
+
+
+def test_db_calls(connection, registry):
+    db = ParsingDatabase()
+    db.connect('dbname=test')
+    db.project_id = 1
+    connection.results = [[(7,)], [(8,)]]
+    db.get_manufacturer_id('Acme')
+    db.get_option_id('Red')
+    histograms = registry.snapshot()['histograms']
+    assert histograms['db_call_seconds{method="get_manufacturer_id"}']['count'] == 1
+    assert histograms['db_call_seconds{method="get_option_id"}']['count'] == 1
+
+
+def test_sinks(tmpdir, registry, caplog):
+    registry.inc('http_requests', host='example.com', status=200)
+    registry.observe('http_request_seconds', 0.2, host='example.com')
+
+    filename = str(tmpdir.join('parselab.prom'))
+    reporter = metrics.Reporter(registry, [metrics.LogSink(), metrics.PrometheusFileSink(filename)], 3600)
+    with caplog.at_level(logging.INFO):
+        reporter.start().stop()
+    assert 'http_requests{host="example.com",status="200"}=1' in caplog.text
+
+    text = open(filename).read()
+    assert 'parselab_http_requests{host="example.com",status="200"} 1\n' in text
+    assert 'parselab_http_request_seconds_bucket{host="example.com",le="0.1"} 0\n' in text
+    assert 'parselab_http_request_seconds_bucket{host="example.com",le="0.25"} 1\n' in text
+    assert 'parselab_http_request_seconds_count{host="example.com"} 1\n' in text
+
+
+def test_list_buckets():
+    registry = metrics.Metrics(buckets=[0.1, 1])
+    registry.observe('parse_seconds', 0.5)
+    assert 'parselab_parse_seconds_bucket{le="+Inf"} 1\n' in registry.get_prometheus_text()
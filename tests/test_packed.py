@@ -0,0 +1,116 @@
+import os
+
+import pytest
+
+from parselab.cache import FileCache
+from parselab.network import PageNotFound
+
+from tests.helpers import Response
+from parselab.packed import PackedCache
+
+
+def test_write_and_read(tmpdir):
+    cache = PackedCache('test', str(tmpdir))
+    cache.write_to_cache('http://example.com/', u'<html>Привет</html>')
+    cache.write_to_cache('http://example.com/a.png', Response(b'\x89PNG' * 1000), binary=True)
+
+    assert cache.is_in_cache('http://example.com/')
+    assert not cache.is_in_cache('http://example.com/missing')
+    assert cache.get_file('http://example.com/') == u'<html>Привет</html>'
+    assert cache.get_file('http://example.com/a.png', binary=True) == b'\x89PNG' * 1000
+
+    cache.close()
+    cache = PackedCache('test', str(tmpdir))
+    assert cache.get_file('http://example.com/') == u'<html>Привет</html>'
+
+
+def test_errors_and_removal(tmpdir):
+    cache = PackedCache('test', str(tmpdir))
+    cache.save_error_in_cache('http://example.com/404', 'PageNotFound')
+    assert not cache.is_in_cache('http://example.com/404')
+    assert cache.is_in_cache_error('http://example.com/404')
+    assert cache.get_error_from_cache('http://example.com/404') == 'PageNotFound'
+    with pytest.raises(PageNotFound):
+        cache.get_file('http://example.com/404')
+
+    cache.write_to_cache('http://example.com/', 'data')
+    cache.remove_from_cache('http://example.com/')
+    assert not cache.is_in_cache('http://example.com/')
+
+
+def test_index_growth_and_compaction(tmpdir):
+    cache = PackedCache('test', str(tmpdir), segment_size=4096)
+    capacity = cache.index.capacity
+    count = int(capacity * 0.8)
+    for i in range(count):
+        cache.write_to_cache('http://example.com/%s' % i, 'page %s' % i)
+    for i in range(0, count, 2):
+        cache.remove_from_cache('http://example.com/%s' % i)
+    assert cache.index.capacity > capacity
+    assert len(cache.get_segments()) > 1
+
+    cache.compact()
+    for i in range(count):
+        expected = None if i % 2 == 0 else 'page %s' % i
+        assert cache.get_file('http://example.com/%s' % i) == expected
+
+
+def test_rebuild_index(tmpdir):
+    cache = PackedCache('test', str(tmpdir))
+    cache.write_to_cache('http://example.com/1', 'one')
+    cache.write_to_cache('http://example.com/1', 'two')
+    cache.close()
+    os.remove(os.path.join(str(tmpdir), 'test', 'index'))
+
+    cache = PackedCache('test', str(tmpdir))
+    assert cache.get_file('http://example.com/1') == 'two'
+
+
+def test_import_file_cache(tmpdir):
+    file_cache = FileCache('files', str(tmpdir))
+    file_cache.write_to_cache('http://example.com/', 'page')
+    file_cache.save_error_in_cache('http://example.com/404', 'PageNotFound')
+
+    # Page downloaded after an error and a stray file
+    file_cache.save_error_in_cache('http://example.com/retried', 'PageDownloadException')
+    file_cache.write_to_cache('http://example.com/retried', 'retried')
+    directory = os.path.dirname(file_cache.get_cached_filename('http://example.com/'))
+    with open(os.path.join(directory, 'README'), 'w') as f:
+        f.write('notes')
+
+    cache = PackedCache('packed', str(tmpdir))
+    assert cache.import_file_cache(file_cache.get_cache_path()) == 3
+    assert cache.get_file('http://example.com/') == 'page'
+    assert cache.get_error_from_cache('http://example.com/404') == 'PageNotFound'
+    assert cache.lookup('http://example.com/retried').data == 'retried'
+
+
+def test_metadata_and_touch(tmpdir):
+    cache = PackedCache('test', str(tmpdir), codec='zlib')
+    cache.write_to_cache('http://example.com/', 'page', meta={'etag': '"v1"'})
+
+    result = cache.lookup('http://example.com/')
+    assert result.data == 'page'
+    assert result.meta['etag'] == '"v1"'
+    fetched_at = result.fetched_at
+
+    cache.touch('http://example.com/')
+    assert cache.lookup('http://example.com/').fetched_at >= fetched_at
+
+
+def test_get_buffer(tmpdir):
+    cache = PackedCache('test', str(tmpdir))
+    cache.write_to_cache('http://example.com/', 'x' * 100000)
+    content = os.urandom(100000)
+    cache.write_to_cache('http://example.com/a.bin', Response(content), binary=True)
+    assert cache.get_buffer('http://example.com/a.bin').tobytes() == content
+
+
+def test_get_urls(tmpdir):
+    cache = PackedCache('test', str(tmpdir))
+    cache.write_to_cache('http://example.com/', 'page', meta={'url': 'http://example.com/'})
+    cache.write_to_cache('http://example.com/long', 'page', meta={'url': 'http://example.com/long',
+                                                                  'etag': 'x' * 5000})
+    cache.write_to_cache('http://example.com/legacy', 'page')
+    cache.save_error_in_cache('http://example.com/404', 'PageNotFound')
+    assert sorted(cache.get_urls()) == ['http://example.com/', 'http://example.com/long']
@@ -0,0 +1,258 @@
+import os
+import time
+import codecs
+import asyncio
+import threading
+
+import pytest
+
+import parselab.network
+import parselab.parsing
+
+from parselab.cache import FileCache, MemoryCache, HIT, ERROR, MISS
+from parselab.network import PageNotFound, NotModified, sniff_encoding
+from parselab.parsing import PageDownloadException
+
+from tests.helpers import Response, Network, Parser, parse_length
+
+
+def test_lookup(tmpdir):
+    cache = FileCache('test', str(tmpdir))
+    cache.write_to_cache('http://example.com/', 'page')
+    cache.save_error_in_cache('http://example.com/404', 'PageNotFound')
+
+    result = cache.lookup('http://example.com/')
+    assert (result.status, result.data) == (HIT, 'page')
+    assert result.filename == cache.get_cached_filename('http://example.com/')
+    result = cache.lookup('http://example.com/404')
+    assert (result.status, result.error) == (ERROR, 'PageNotFound')
+    assert cache.lookup('http://example.com/missing').status == MISS
+
+
+def test_get_page(tmpdir):
+    net = Network({'http://example.com/': 'page'})
+    parser = Parser(FileCache('test', str(tmpdir)), net)
+
+    assert parser.get_page('http://example.com/') == 'page'
+    assert not parser.is_cache_used
+    assert parser.get_page('http://example.com/') == 'page'
+    assert parser.is_cache_used
+
+    for i in range(2):
+        with pytest.raises(PageNotFound):
+            parser.get_page('http://example.com/404')
+    assert net.downloads == [('http://example.com/', None), ('http://example.com/404', None)]
+
+
+def test_revalidation(tmpdir):
+    net = Network({'http://example.com/': 'page'}, etag='"v1"')
+    parser = Parser(FileCache('test', str(tmpdir)), net)
+    parser.cache_ttl = 3600
+
+    assert parser.get_page('http://example.com/') == 'page'
+    assert parser.get_page('http://example.com/') == 'page'
+    assert len(net.downloads) == 1
+
+    filename = parser.cache.get_cached_filename('http://example.com/')
+    os.utime(filename, (time.time() - 7200, time.time() - 7200))
+    assert parser.get_page('http://example.com/') == 'page'
+    assert net.downloads[-1] == ('http://example.com/', {'etag': '"v1"'})
+    assert time.time() - os.stat(filename).st_mtime < 60
+
+    net.etag = '"v2"'
+    net.pages['http://example.com/'] = 'new page'
+    os.utime(filename, (time.time() - 7200, time.time() - 7200))
+    assert parser.get_page('http://example.com/') == 'new page'
+    assert parser.cache.lookup('http://example.com/').meta == {'etag': '"v2"', 'encoding': 'utf-8',
+                                                                   'url': 'http://example.com/'}
+
+
+class RawNetwork(Network):
+
+    def fetch(self, url, cookies=None, binary=False, validators=None):
+        self.downloads.append((url, validators))
+        return Response(*self.pages[url])
+
+
+def test_raw_pages(tmpdir):
+    page = u'<html><head><meta charset="windows-1251"></head>Привет</html>'
+    net = RawNetwork({'http://example.com/': (page.encode('cp1251'), {'Content-Type': 'text/html'}),
+                      'http://example.com/koi8': (u'Привет'.encode('koi8-r'),
+                                                  {'Content-Type': 'text/plain; charset="KOI8-R"'})})
+    parser = Parser(FileCache('test', str(tmpdir)), net)
+
+    for i in range(2):
+        assert parser.get_page('http://example.com/') == page
+        assert parser.get_page('http://example.com/koi8') == u'Привет'
+    assert len(net.downloads) == 2
+
+    result = parser.cache.lookup('http://example.com/', binary=True)
+    assert result.data == page.encode('cp1251')
+    assert result.meta == {'content_type': 'text/html', 'encoding': 'cp1251', 'url': 'http://example.com/'}
+
+
+def test_encoding_detected_once(tmpdir, monkeypatch):
+    calls = []
+
+    def get_encoding(response):
+        calls.append(response)
+        return 'cp1251'
+
+    monkeypatch.setattr(parselab.network, 'get_encoding', get_encoding)
+    monkeypatch.setattr(parselab.parsing, 'get_encoding', get_encoding)
+    net = RawNetwork({'http://example.com/': (u'Привет'.encode('cp1251'), {'Content-Type': 'text/html'})})
+    parser = Parser(MemoryCache(FileCache('test', str(tmpdir))), net)
+
+    assert parser.get_page('http://example.com/') == u'Привет'
+    assert len(calls) == 1
+    # Fresh text page is kept in memory
+    assert parser.cache.get_entry('http://example.com/', False)[0] == u'Привет'
+    assert parser.get_page('http://example.com/') == u'Привет'
+    assert parser.cache.get_stats()['misses'] == 1
+
+
+class LegacyCache(FileCache):
+
+    def write_to_cache(self, url, data, binary=False):
+        self.written = data
+        FileCache.write_to_cache(self, url, data, binary)
+
+
+def test_cache_without_meta(tmpdir):
+    page = u'<html><head><meta charset="windows-1251"></head>Привет</html>'
+    net = RawNetwork({'http://example.com/': (page.encode('cp1251'), {'Content-Type': 'text/html'}),
+                      'http://example.com/koi8': (u'Привет'.encode('koi8-r'),
+                                                  {'Content-Type': 'text/plain; charset="KOI8-R"'})})
+    cache = LegacyCache('test', str(tmpdir))
+    parser = Parser(cache, net)
+
+    assert parser.get_page('http://example.com/') == page
+    assert cache.written == page
+    with open(cache.get_cached_filename('http://example.com/'), 'rb') as f:
+        assert f.read() == page.encode('utf-8')
+
+    # Memory cache in front of it passes decoded text pages too
+    parser = Parser(MemoryCache(cache), net)
+    assert parser.get_page('http://example.com/koi8') == u'Привет'
+    assert cache.written == u'Привет'
+    assert parser.cache.get_entry('http://example.com/koi8', False)[0] == u'Привет'
+
+
+class AsyncNetwork(Network):
+
+    async def fetch(self, url, cookies=None, binary=False, validators=None):
+        return Network.fetch(self, url, cookies, binary, validators)
+
+
+class ThreadCache(FileCache):
+    """
+    Remembers threads which read and write the cache
+    """
+
+    def __init__(self, *args):
+        FileCache.__init__(self, *args)
+        self.threads = set()
+
+    def lookup(self, url, binary=False):
+        self.threads.add(threading.current_thread())
+        return FileCache.lookup(self, url, binary)
+
+    def write_to_cache(self, url, data, binary=False, meta=None):
+        self.threads.add(threading.current_thread())
+        FileCache.write_to_cache(self, url, data, binary, meta)
+
+
+def test_get_page_async_offline(tmpdir):
+    net = AsyncNetwork({'http://example.com/': 'page'})
+    cache = ThreadCache('test', str(tmpdir))
+    parser = Parser(cache, None)
+    parser.async_net = net
+
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(parser.get_page_async('http://example.com/')) == 'page'
+        # Cache is used from executor threads, not from the event loop
+        assert cache.threads and threading.current_thread() not in cache.threads
+
+        parser.offline = True
+        assert loop.run_until_complete(parser.get_page_async('http://example.com/')) == 'page'
+        with pytest.raises(PageDownloadException):
+            loop.run_until_complete(parser.get_page_async('http://example.com/new'))
+        with pytest.raises(PageDownloadException):
+            parser.get_page('http://example.com/new')
+    finally:
+        loop.close()
+    assert net.downloads == [('http://example.com/', None)]
+
+
+class DownloadOnlyNetwork(object):
+
+    def download_page(self, url, cookies=None, binary=False):
+        return u'Привет'
+
+
+def test_download_page_fallback(tmpdir):
+    parser = Parser(FileCache('test', str(tmpdir)), DownloadOnlyNetwork())
+    assert parser.get_page('http://example.com/') == u'Привет'
+    assert parser.cache.lookup('http://example.com/').data == u'Привет'
+
+
+def test_sniff_encoding():
+    assert sniff_encoding(u'Привет'.encode('utf-8')) == 'utf-8'
+    assert sniff_encoding(codecs.BOM_UTF16_LE + u'Привет'.encode('utf-16-le')) == 'utf-16'
+    assert sniff_encoding(b'<?xml version="1.0" encoding="ISO-8859-1"?><a>\xe9</a>') == 'iso8859-1'
+    assert sniff_encoding(u'<meta http-equiv="Content-Type" content="text/html; charset=koi8-r">'
+                          u'Привет'.encode('koi8-r')) == 'koi8-r'
+    assert sniff_encoding(u'Привет'.encode('cp1251')) is None
+    # Only a part from the first non-ASCII byte is checked, a character cut at its end is fine
+    assert sniff_encoding(b'<html>' * 100000 + u'Привет'.encode('cp1251')) is None
+    assert sniff_encoding(b'<html>' * 100000 + u'\u20ac'.encode('utf-8') * 100000) == 'utf-8'
+    assert sniff_encoding(b'<html>' * 100000) == 'utf-8'
+
+
+class SlowNetwork(Network):
+
+    def fetch(self, url, cookies=None, binary=False, validators=None):
+        time.sleep(0.01 * (10 - int(url.rsplit('/', 1)[1]) % 10))
+        return Network.fetch(self, url, cookies, binary, validators)
+
+
+@pytest.mark.parametrize('ordered', [True, False])
+def test_get_pages(tmpdir, ordered):
+    urls = ['http://example.com/%s' % i for i in range(30)]
+    net = SlowNetwork(dict((url, 'page %s' % i) for i, url in enumerate(urls)))
+    parser = Parser(FileCache('test', str(tmpdir)), net)
+    parser.get_page(urls[3])
+
+    pages = list(parser.get_pages(urls + ['http://example.com/404'], max_workers=8, ordered=ordered,
+                                  return_exceptions=True))
+    assert len(net.downloads) == 31
+    if ordered:
+        assert [url for url, _ in pages] == urls + ['http://example.com/404']
+    pages = dict(pages)
+    assert [pages[url] for url in urls] == ['page %s' % i for i in range(30)]
+    assert isinstance(pages['http://example.com/404'], PageNotFound)
+
+    with pytest.raises(PageNotFound):
+        list(parser.get_pages(['http://example.com/404']))
+    assert len(net.downloads) == 31
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_replay(tmpdir, processes):
+    urls = ['http://example.com/%s' % i for i in range(10)]
+    net = Network(dict((url, 'page %s' % i) for i, url in enumerate(urls)))
+    parser = Parser(FileCache('test', str(tmpdir)), net)
+    for url in urls[:8]:
+        parser.get_page(url)
+    downloads = len(net.downloads)
+
+    results = dict()
+    stats = parser.replay(parse_length, processes=processes, on_result=results.__setitem__)
+    assert results == dict((url, 6) for url in urls[:8] if url != urls[3])
+    assert (stats['pages'], stats['missing'], stats['failed']) == (7, 0, 1)
+
+    stats = parser.replay(parse_length, urls, processes=processes)
+    assert (stats['pages'], stats['missing'], stats['failed']) == (7, 2, 1)
+    assert len(net.downloads) == downloads
+    assert not parser.offline
@@ -0,0 +1,85 @@
+import time
+
+from requests.exceptions import ConnectionError, ReadTimeout
+
+from parselab.network import NetworkManager
+from parselab.proxy import ProxyPool
+
+from tests.helpers import Response
+
+
+def test_choice_depends_on_health():
+    pool = ProxyPool(['http://a:3128', 'http://b:3128'])
+    a, b = pool.proxies
+    for i in range(10):
+        pool.report_success(a, 0.1)
+        pool.report_success(b, 2.0)
+    chosen = [pool.choose() for i in range(1000)]
+    assert chosen.count(a) > chosen.count(b) * 5
+
+
+def test_quarantine_and_backoff():
+    pool = ProxyPool(['http://a:3128', 'http://b:3128'], max_failures=2, backoff=10)
+    a, b = pool.proxies
+    pool.report_failure(a)
+    assert a.is_available(time.time())
+    pool.report_failure(a)
+    assert not a.is_available(time.time())
+    assert all(pool.choose() is b for i in range(100))
+    first = a.quarantined_until
+
+    pool.report_failure(a)
+    assert a.quarantined_until - first >= 9
+
+    pool.report_failure(b, ban=True)
+    assert pool.get_stats()[1]['bans'] == 1
+    # All proxies are quarantined, the one which is released first is used
+    assert pool.choose() is b
+
+    pool.report_success(a, 0.1)
+    assert a.failures == 0 and a.quarantines == 0
+
+
+class Session(object):
+
+    def __init__(self, fail, error=ConnectionError):
+        self.fail = fail
+        self.error = error
+        self.calls = 0
+        self.proxies = None
+        self.timeout = None
+
+    def get(self, url, headers=None, cookies=None, proxies=None, timeout=None):
+        self.calls += 1
+        self.proxies, self.timeout = proxies, timeout
+        if self.fail:
+            raise self.error()
+        return Response()
+
+
+def test_network_manager_retries_another_proxy():
+    net = NetworkManager(proxies=ProxyPool(['http://bad:3128', 'http://good:3128'], max_failures=1))
+    bad, good = net.proxy_pool.proxies
+    bad.session, good.session = Session(True), Session(False)
+    bad.latency = 0.01
+    good.latency = 100.0
+
+    started = time.time()
+    assert net.fetch('http://example.com/').status_code == 200
+    assert time.time() - started < 5
+    assert bad.session.calls == 1
+    assert good.session.calls == 1
+    assert net.proxy_pool.get_stats()[1]['requests'] == 1
+
+
+def test_proxy_timeout():
+    net = NetworkManager(proxies=ProxyPool(['http://slow:3128', 'http://good:3128'], max_failures=1), timeout=5)
+    slow, good = net.proxy_pool.proxies
+    slow.session, good.session = Session(True, ReadTimeout), Session(False)
+    slow.latency = 0.01
+    good.latency = 100.0
+
+    assert net.fetch('http://example.com/').status_code == 200
+    assert slow.session.timeout == 5
+    assert good.session.proxies == {'http': 'http://good:3128', 'https': 'http://good:3128'}
+    assert net.proxy_pool.get_stats()[0]['errors'] == 1
@@ -0,0 +1,46 @@
+import time
+
+import pytest
+
+from parselab.ratelimit import RateLimiter, parse_retry_after
+
+
+def test_reserve_spaces_requests():
+    limiter = RateLimiter(rate=10)
+    delays = [limiter.reserve('http://a.example.com/%s' % i) for i in range(3)]
+    assert delays[0] == pytest.approx(0, abs=0.01)
+    assert delays[1] == pytest.approx(0.1, abs=0.01)
+    assert delays[2] == pytest.approx(0.2, abs=0.01)
+    # Other hosts are not affected
+    assert limiter.reserve('http://b.example.com/') == pytest.approx(0, abs=0.01)
+
+
+def test_burst_and_configured_rates():
+    limiter = RateLimiter(rate=1, burst=3, rates={'fast.example.com': 100})
+    delays = [limiter.reserve('http://a.example.com/') for i in range(4)]
+    assert delays[:3] == pytest.approx([0, 0, 0], abs=0.01)
+    assert delays[3] == pytest.approx(1, abs=0.01)
+    assert limiter.reserve('http://fast.example.com/') == pytest.approx(0, abs=0.01)
+    assert limiter.get_stats()['fast.example.com']['rate'] == 100
+
+
+def test_throttling_and_recovery():
+    limiter = RateLimiter(rate=10)
+    limiter.feedback('http://a.example.com/', 429, 0.1, '5')
+    assert limiter.get_stats()['a.example.com']['rate'] == 5
+    assert limiter.reserve('http://a.example.com/') == pytest.approx(5, abs=0.1)
+
+    for i in range(10):
+        limiter.feedback('http://a.example.com/', 200, 0.1)
+    assert limiter.get_stats()['a.example.com']['rate'] == 10
+
+    for i in range(10):
+        limiter.feedback('http://a.example.com/', 200, 2.0)
+    assert limiter.get_stats()['a.example.com']['rate'] < 10
+
+
+def test_parse_retry_after():
+    assert parse_retry_after('120') == 120
+    assert parse_retry_after(None) is None
+    date = time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(time.time() + 60))
+    assert parse_retry_after(date) == pytest.approx(60, abs=2)
@@ -0,0 +1,68 @@
+import os
+import multiprocessing
+
+import pytest
+
+from parselab.cache import FileCache
+from parselab.sharding import Coordinator, get_shard, run_worker
+
+from tests.helpers import Network, Parser
+
+
+PAGES = dict(('http://example.com/%s' % i, ' '.join('http://example.com/%s' % (i * 4 + j) for j in range(1, 5)
+                                                     if i * 4 + j < 40) or '-')
+             for i in range(40))
+
+
+def worker(address, authkey, path, crash):
+    parser = Parser(FileCache('test', path), Network(PAGES))
+
+    def callback(url, page):
+        if crash:
+            # Worker dies in the middle of the crawl
+            os._exit(1)
+        links = [link for link in page.split() if link != '-']
+        for link in links:
+            parser.enqueue(link)
+        return len(links)
+
+    run_worker(parser, callback, address, authkey, max_workers=2, batch_size=3)
+
+
+def test_get_shard(tmpdir):
+    cache = FileCache('test', str(tmpdir))
+    url = 'http://example.com/'
+    assert '%02x' % get_shard(url) == os.path.basename(os.path.dirname(cache.get_cached_filename(url)))
+
+
+def test_sharded_crawl(tmpdir):
+    coordinator = Coordinator()
+    coordinator.add('http://example.com/0')
+    coordinator.start()
+
+    args = (coordinator.address, coordinator.authkey, str(tmpdir))
+    processes = [multiprocessing.Process(target=worker, args=args + (crash,)) for crash in (True, False, False)]
+    for process in processes:
+        process.start()
+    assert coordinator.join(timeout=30)
+    for process in processes:
+        process.join(10)
+    coordinator.close()
+
+    assert sorted(coordinator.results) == sorted(PAGES)
+    assert coordinator.results['http://example.com/0'] == 4
+    assert not coordinator.failures
+    assert coordinator.get_stats() == {'pending': 0, 'active': 0, 'done': 40, 'failed': 0, 'workers': 0}
+
+
+def test_authkey():
+    with pytest.raises(ValueError):
+        Coordinator(address=('0.0.0.0', 0))
+
+    coordinator = Coordinator()
+    other = Coordinator()
+    try:
+        assert len(coordinator.authkey) == 32 and coordinator.authkey != other.authkey
+    finally:
+        coordinator.close()
+        other.close()